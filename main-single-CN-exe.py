@@ -21,6 +21,7 @@
 import os
 import sys
 import json
+import types
 import requests
 import threading
 import subprocess
@@ -28,107 +29,3570 @@ import time
 import base64
 import hashlib
 import re
+import math
+import random
+import itertools
+import contextlib
+import socket
+import ssl
+import http.client
+import http.server
+import urllib.parse
+import queue
+import collections
+import sqlite3
+import uuid
+from collections import deque
 
-# 判断是否需要导入tkinter
-USE_GUI = "--gui" in sys.argv or (not "--cli" in sys.argv)
+# 判断是否需要导入tkinter（基准测试等命令行入口同样不需要界面）
+CLI_ONLY_FLAGS = ("--cli", "--bench", "--bench-sse", "--mock-server", "--usage", "--search")
+USE_GUI = "--gui" in sys.argv or not any(flag in sys.argv for flag in CLI_ONLY_FLAGS)
 
 if USE_GUI:
     import tkinter as tk
     from tkinter import messagebox, simpledialog, scrolledtext, ttk, font  # 添加font导入
-    # 导入加密需要的库
+
+# 导入加密需要的库（图形界面、命令行与基准测试读取已保存的密钥都需要）
+try:
+    from cryptography.fernet import Fernet
+except ImportError:
+    Fernet = None
+    # 提示写到 stderr，基准测试的 stdout 只输出JSON
+    print("cryptography库未安装，API Key将无法加密。请使用 pip install cryptography 安装。", file=sys.stderr)
+    # 继续执行，但加密功能将降级
+
+import openai
+from openai import OpenAI
+
+# httpx 随 openai 一同安装；可用时用于自定义SDK连接池的 keep-alive 时长
+try:
+    import httpx
+    from openai import DefaultHttpxClient
+except ImportError:
+    httpx = None
+
+# tokenizers 为可选依赖：配合 DeepSeek 官方分词器文件在本地精确计算token数，缺失时退回启发式估算
+try:
+    from tokenizers import Tokenizer
+except ImportError:
+    Tokenizer = None
+
+# 接口地址可通过同名环境变量覆盖，例如指向 --mock-server 启动的本地模拟服务器
+DEEPSEEK_API_BASE_URL_V1 = os.environ.get("DEEPSEEK_API_BASE_URL_V1", "https://api.deepseek.com/v1")
+DEEPSEEK_BALANCE_URL = os.environ.get("DEEPSEEK_BALANCE_URL", "https://api.deepseek.com/user/balance")
+# 对话前缀续写（Chat Prefix Completion）仅在 beta 接口上提供
+DEEPSEEK_API_BASE_URL_BETA = os.environ.get("DEEPSEEK_API_BASE_URL_BETA", "https://api.deepseek.com/beta")
+# API Key 存储文件名 - 修改路径到用户主目录
+API_KEY_DIR = os.path.join(os.path.expanduser("~"), ".DS_API_CLI")
+API_KEY_FILENAME = os.path.join(API_KEY_DIR, "API_KEY")
+
+# 备用密钥池文件，与 API_KEY 存放在同一目录
+API_KEY_POOL_FILENAME = os.path.join(os.path.dirname(API_KEY_FILENAME), "API_KEY_POOL")
+
+# 响应缓存：目录与 API_KEY 同级，按总大小淘汰最久未使用的条目
+RESPONSE_CACHE_DIR = os.path.join(os.path.dirname(API_KEY_FILENAME), "response_cache")
+RESPONSE_CACHE_MAX_BYTES = 20 * 1024 * 1024
+RESPONSE_CACHE_TTL = 7 * 24 * 3600  # 秒
+
+# 相似问题缓存：签名长度为 NUM_PERM，分为 BANDS 段做 LSH，估计相似度达到 THRESHOLD 时提供缓存回答
+SIMILAR_CACHE_NUM_PERM = 64
+SIMILAR_CACHE_BANDS = 16
+SIMILAR_CACHE_THRESHOLD = 0.8
+SIMILAR_CACHE_MAX_ENTRIES = 2000
+
+# 模型价格（元/百万tokens）：输入分为命中服务端上下文缓存与未命中两档；
+# 可在 API_KEY 同目录的 model_prices.json 中按相同结构覆盖或补充
+MODEL_PRICES_FILENAME = os.path.join(os.path.dirname(API_KEY_FILENAME), "model_prices.json")
+MODEL_PRICES = {
+    "deepseek-chat": {"input_hit": 0.2, "input_miss": 2.0, "output": 3.0},
+    "deepseek-reasoner": {"input_hit": 0.2, "input_miss": 2.0, "output": 3.0},
+}
+DEFAULT_MODEL_PRICE = MODEL_PRICES["deepseek-chat"]
+
+# 用量账本：每次请求追加一行JSON，只追加不改写
+USAGE_LEDGER_FILENAME = os.path.join(os.path.dirname(API_KEY_FILENAME), "usage_ledger.jsonl")
+
+# 对话存储：SQLite 数据库（WAL 模式），与 API_KEY 存放在同一目录
+CONVERSATION_DB_FILENAME = os.path.join(os.path.dirname(API_KEY_FILENAME), "conversations.db")
+
+# 本地分词器文件（DeepSeek 官方分词器包中的 tokenizer.json），可用环境变量 DEEPSEEK_TOKENIZER_FILE 指定
+TOKENIZER_FILE = os.environ.get("DEEPSEEK_TOKENIZER_FILE",
+                                os.path.join(os.path.dirname(API_KEY_FILENAME), "deepseek_tokenizer", "tokenizer.json"))
+TOKEN_COUNT_MEMO_SIZE = 4096      # 按消息内容记忆计数结果的条数上限
+
+# 上下文窗口预算：各模型的上下文长度（tokens）与历史裁剪策略
+MODEL_CONTEXT_TOKENS = {"deepseek-chat": 128 * 1024, "deepseek-reasoner": 128 * 1024}
+DEFAULT_CONTEXT_TOKENS = 64 * 1024
+CHAT_MAX_TOKENS = 4096            # 聊天回复的 max_tokens，同时作为预算中为回复预留的空间
+CONTEXT_BUDGET_POLICY = {
+    # 提示词上限，None 表示只受模型上下文长度限制；可用环境变量 DEEPSEEK_CONTEXT_BUDGET 设置
+    "max_prompt_tokens": int(os.environ["DEEPSEEK_CONTEXT_BUDGET"]) if os.environ.get("DEEPSEEK_CONTEXT_BUDGET") else None,
+    "trim_ratio": 0.75,           # 超出预算时一次裁剪到预算的该比例，之后若干轮保持前缀不变
+    "keep_recent_messages": 2,    # 最近的若干条消息不丢弃也不截断
+    "truncate_tokens": 1024,      # 超出预算时较早的长消息截断到该长度（0 表示不截断）
+    "compaction": False,          # 压缩模式：历史超过预算的 compact_threshold 时，在后台把较早的轮次总结为摘要
+    "compact_threshold": 0.6,
+    "compact_keep_ratio": 0.3     # 压缩后原样保留的最近轮次约占预算的比例
+}
+# 压缩早期对话使用的模型与摘要长度
+SUMMARY_MODEL = "deepseek-chat"
+SUMMARY_MAX_TOKENS = 800
+SUMMARY_CACHE_SIZE = 256
+
+# 网络健康探测配置
+HEALTH_PROBE_INTERVAL = 30        # 秒，活跃状态下的探测间隔
+HEALTH_PROBE_MAX_INTERVAL = 300   # 秒，空闲或最小化时退避的最大间隔
+USER_IDLE_THRESHOLD = 120         # 秒，超过该时间无操作视为空闲
+POOL_IDLE_TIMEOUT = 60            # 秒，连接池中空闲连接的保留时间
+
+# 连接预热配置
+PREWARM_IDLE_THRESHOLD = 45       # 秒，距上次网络请求超过该时间后的首次按键触发预热
+
+# 客户端限流配置（DeepSeek未公布固定配额，以下为保守默认值，会根据429与响应头自适应调整）
+RATE_LIMIT_RPM = 60               # 每分钟请求数
+RATE_LIMIT_TPM = 200000           # 每分钟token数（估算）
+RATE_LIMIT_REPLY_RESERVE = 1024   # 估算请求token时为回复预留的数量
+
+# 密钥池配置：认证失败或余额不足的密钥按类别隔离的秒数
+KEY_QUARANTINE_SECONDS = {"auth": 600, "payment": 1800}
+
+# 请求调度配置：priority 越小优先级越高；聊天属于交互类，其余请求属于后台类
+SCHEDULER_CLASSES = {
+    "interactive": {"priority": 0, "max_concurrency": 4},
+    "background": {"priority": 1, "max_concurrency": 2},
+}
+SCHEDULER_MAX_CONCURRENCY = 4     # 所有类别合计的并发上限
+REQUEST_CLASS_BY_OPERATION = {"models": "background", "balance": "background", "summary": "background",
+                              "prewarm": "background"}
+
+# 熔断器配置
+BREAKER_WINDOW = 20               # 统计最近的请求数
+BREAKER_MIN_REQUESTS = 5          # 达到该请求数后才开始评估
+BREAKER_ERROR_RATE = 0.5          # 错误率阈值
+BREAKER_SLOW_CALL_SECONDS = 20    # 秒，超过该耗时（聊天为首个分块耗时，推理内容也算）视为慢请求
+BREAKER_SLOW_CALL_RATE = 0.8      # 慢请求比例阈值
+BREAKER_OPEN_SECONDS = 30         # 秒，打开后进入半开探测前的冷却时间
+BREAKER_QUEUE_TIMEOUT = 0         # 秒，打开期间请求排队等待的最长时间，0表示立即失败
+
+# 流式输出分阶段超时（秒）：连接、首个token、分块间隔、总时长。
+# 键为模型名称片段，"default" 为默认值；推理模型思考时间更长，放宽首token与间隔限制
+STREAM_TIMEOUTS = {
+    "default": {"connect": 10, "first_token": 60, "idle": 30, "total": 600},
+    "reasoner": {"first_token": 300, "idle": 120, "total": 1800}
+}
+
+# 流式回复中断后的自动续传次数上限
+STREAM_RESUME_MAX_ATTEMPTS = 2
+
+# 可选的原始SSE快速路径：绕过SDK逐token构造对象（--raw-sse 或环境变量 DEEPSEEK_RAW_SSE=1 启用）
+RAW_SSE_STREAMING = "--raw-sse" in sys.argv or os.environ.get("DEEPSEEK_RAW_SSE") == "1"
+
+# DNS缓存配置（标准库解析不返回记录TTL，使用固定的缓存时长作为上限）
+DNS_CACHE_TTL = 300               # 秒，解析结果的缓存时长
+HAPPY_EYEBALLS_DELAY = 0.25       # 秒，并发尝试下一个地址前的等待时间
+
+# ===================== API Key 存储加密功能 =====================
+def get_encryption_key():
+    """基于机器特定信息生成稳定的加密密钥"""
+    try:
+        # 使用机器ID作为密钥材料的一部分
+        import uuid
+        machine_id = uuid.getnode()
+        # 使用固定的盐值和机器ID创建密钥材料
+        key_material = f"deepseek-client-{machine_id}-salt-v1".encode()
+        # 生成符合Fernet要求的32字节密钥并进行base64编码
+        key = base64.urlsafe_b64encode(hashlib.sha256(key_material).digest())
+        return key
+    except Exception:
+        # 如果出错，使用一个默认密钥（这不够安全，但比没有加密好）
+        return base64.urlsafe_b64encode(hashlib.sha256(b"default-salt-key").digest())
+
+def encrypt_api_key(api_key):
+    """加密API密钥"""
+    if not api_key:
+        return None
+    try:
+        key = get_encryption_key()
+        f = Fernet(key)
+        return f.encrypt(api_key.encode()).decode()
+    except Exception as e:
+        print(f"加密API密钥时出错: {e}", file=sys.stderr)
+        return None
+
+def decrypt_api_key(encrypted_api_key):
+    """解密API密钥"""
+    if not encrypted_api_key:
+        return None
+    try:
+        key = get_encryption_key()
+        f = Fernet(key)
+        return f.decrypt(encrypted_api_key.encode()).decode()
+    except Exception as e:
+        print(f"解密API密钥时出错: {e}", file=sys.stderr)
+        return None
+
+def save_api_key_to_file(api_key):
+    """将API密钥加密后保存到文件"""
+    try:
+        # 确保目录存在
+        if not os.path.exists(API_KEY_DIR):
+            os.makedirs(API_KEY_DIR)
+            
+        encrypted = encrypt_api_key(api_key)
+        if encrypted:
+            with open(API_KEY_FILENAME, "w") as f:
+                f.write(encrypted)
+            return True
+        return False
+    except Exception as e:
+        print(f"Error saving API key: {e}", file=sys.stderr)
+        return False
+
+def load_api_key_from_file():
+    """从文件加载并解密API密钥"""
+    try:
+        if os.path.exists(API_KEY_FILENAME):
+            with open(API_KEY_FILENAME, "r") as f:
+                encrypted = f.read().strip()
+                return decrypt_api_key(encrypted)
+        return None
+    except Exception as e:
+        print(f"Error loading API key: {e}", file=sys.stderr)
+        return None
+
+def save_api_key_pool_to_file(keys):
+    """将备用密钥列表加密后保存到密钥池文件（主密钥仍保存在 API_KEY 中）"""
+    try:
+        pool_dir = os.path.dirname(API_KEY_POOL_FILENAME)
+        if not os.path.exists(pool_dir):
+            os.makedirs(pool_dir)
+        if not keys:
+            if os.path.exists(API_KEY_POOL_FILENAME):
+                os.remove(API_KEY_POOL_FILENAME)
+            return True
+        encrypted = encrypt_api_key(json.dumps(list(keys)))
+        if encrypted:
+            with open(API_KEY_POOL_FILENAME, "w") as f:
+                f.write(encrypted)
+            return True
+        return False
+    except Exception as e:
+        print(f"Error saving API key pool: {e}", file=sys.stderr)
+        return False
+
+def load_api_key_pool_from_file():
+    """从密钥池文件加载并解密备用密钥列表"""
+    try:
+        if os.path.exists(API_KEY_POOL_FILENAME):
+            with open(API_KEY_POOL_FILENAME, "r") as f:
+                decrypted = decrypt_api_key(f.read().strip())
+                return json.loads(decrypted) if decrypted else []
+        return []
+    except Exception as e:
+        print(f"Error loading API key pool: {e}", file=sys.stderr)
+        return []
+
+def delete_api_key_file():
+    """删除存储API密钥的文件"""
+    if os.path.exists(API_KEY_FILENAME):
+        try:
+            os.remove(API_KEY_FILENAME)
+            return True
+        except Exception as e:
+            print(f"Error deleting API key file: {e}", file=sys.stderr)
+            return False
+    return True
+
+# ===================== DNS 缓存与地址选择 =====================
+class DnsCache:
+    """进程内DNS缓存
+
+    解析结果按TTL缓存，支持启动时后台预解析；连接时以 happy-eyeballs 方式
+    交错竞速 IPv4/IPv6 地址，并记住连接最快的地址供下次优先使用。
+    """
+    def __init__(self, ttl=DNS_CACHE_TTL, attempt_delay=HAPPY_EYEBALLS_DELAY):
+        self.ttl = ttl
+        self.attempt_delay = attempt_delay
+        self._entries = {}        # (host, port) -> (过期时间, 地址列表)
+        self._connect_ewma = {}   # sockaddr -> 平滑后的连接耗时（毫秒）
+        self._stats = {}          # host -> 解析统计
+        self._lock = threading.Lock()
+
+    def resolve(self, host, port):
+        """返回 [(family, sockaddr), ...]，命中缓存时不访问解析器"""
+        key = (host, port)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[0] > now:
+                self._stats.setdefault(host, {"resolve_ms": None, "hits": 0, "misses": 0})["hits"] += 1
+                return list(entry[1])
+
+        start = time.perf_counter()
+        infos = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)
+        resolve_ms = (time.perf_counter() - start) * 1000
+        addresses = []
+        for family, _, _, _, sockaddr in infos:
+            if (family, sockaddr) not in addresses:
+                addresses.append((family, sockaddr))
+
+        with self._lock:
+            self._entries[key] = (now + self.ttl, addresses)
+            stats = self._stats.setdefault(host, {"resolve_ms": None, "hits": 0, "misses": 0})
+            stats["resolve_ms"] = resolve_ms
+            stats["misses"] += 1
+        return list(addresses)
+
+    def prefetch(self, hosts, port=443):
+        """在后台线程中预解析主机名"""
+        def worker():
+            for host in hosts:
+                try:
+                    self.resolve(host, port)
+                except OSError:
+                    pass
+        threading.Thread(target=worker, daemon=True).start()
+
+    def stats(self, host):
+        """返回主机的解析统计：最近一次解析耗时、命中次数与首选地址"""
+        with self._lock:
+            stats = dict(self._stats.get(host, {"resolve_ms": None, "hits": 0, "misses": 0}))
+            preferred = None
+            for (entry_host, _), (_, addresses) in self._entries.items():
+                if entry_host == host and addresses:
+                    preferred = self._order_addresses(addresses)[0][1][0]
+                    break
+        stats["preferred"] = preferred
+        return stats
+
+    def _order_addresses(self, addresses):
+        """已测得耗时的地址按快慢排在前面，其余按地址族交错排列（调用方持有锁）"""
+        known = sorted((a for a in addresses if a[1] in self._connect_ewma),
+                       key=lambda a: self._connect_ewma[a[1]])
+        unknown = [a for a in addresses if a[1] not in self._connect_ewma]
+        v6 = [a for a in unknown if a[0] == socket.AF_INET6]
+        others = [a for a in unknown if a[0] != socket.AF_INET6]
+        interleaved = []
+        for i in range(max(len(v6), len(others))):
+            if i < len(v6):
+                interleaved.append(v6[i])
+            if i < len(others):
+                interleaved.append(others[i])
+        return known + interleaved
+
+    def _record_connect(self, sockaddr, elapsed_ms):
+        with self._lock:
+            previous = self._connect_ewma.get(sockaddr)
+            self._connect_ewma[sockaddr] = elapsed_ms if previous is None else previous * 0.7 + elapsed_ms * 0.3
+
+    def connect(self, host, port, timeout):
+        """竞速连接所有解析到的地址，返回 (socket, 连接耗时毫秒)"""
+        addresses = self.resolve(host, port)
+        with self._lock:
+            addresses = self._order_addresses(addresses)
+        if not addresses:
+            raise OSError(f"无法解析主机: {host}")
+
+        results = queue.Queue()
+
+        def attempt(family, sockaddr):
+            sock = socket.socket(family, socket.SOCK_STREAM)
+            sock.settimeout(timeout)
+            start = time.perf_counter()
+            try:
+                sock.connect(sockaddr)
+            except OSError as e:
+                sock.close()
+                results.put((None, sockaddr, None, e))
+                return
+            results.put((sock, sockaddr, (time.perf_counter() - start) * 1000, None))
+
+        deadline = time.monotonic() + timeout
+        started = 0
+        pending = 0
+        last_error = None
+        while True:
+            if started < len(addresses):
+                threading.Thread(target=attempt, args=addresses[started], daemon=True).start()
+                started += 1
+                pending += 1
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            wait = min(self.attempt_delay, remaining) if started < len(addresses) else remaining
+            try:
+                sock, sockaddr, elapsed_ms, error = results.get(timeout=wait)
+            except queue.Empty:
+                continue
+            pending -= 1
+            if sock is not None:
+                self._record_connect(sockaddr, elapsed_ms)
+                if pending:
+                    threading.Thread(target=self._close_losers, args=(results, pending), daemon=True).start()
+                return sock, elapsed_ms
+            last_error = error
+            self._record_connect(sockaddr, timeout * 1000)
+            if pending == 0 and started == len(addresses):
+                raise last_error
+
+        if pending:
+            threading.Thread(target=self._close_losers, args=(results, pending), daemon=True).start()
+        raise socket.timeout(f"连接 {host}:{port} 超时")
+
+    @staticmethod
+    def _close_losers(results, pending):
+        """关闭竞速中落败但随后连接成功的套接字"""
+        for _ in range(pending):
+            sock = results.get()[0]
+            if sock is not None:
+                sock.close()
+
+# 全局共享的DNS缓存
+DNS_CACHE = DnsCache()
+
+# ===================== 连接池与网络健康探测 =====================
+def _timed_tcp_connect(host, port, timeout):
+    """通过DNS缓存竞速建立TCP连接并返回 (socket, 连接耗时毫秒)"""
+    sock, elapsed_ms = DNS_CACHE.connect(host, port, timeout)
+    try:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    except OSError:
+        pass
+    return sock, elapsed_ms
+
+class TimedHTTPConnection(http.client.HTTPConnection):
+    """记录TCP连接耗时的HTTP连接"""
+    def __init__(self, host, port=None, timeout=10):
+        super().__init__(host, port, timeout=timeout)
+        self.connect_ms = 0.0
+        self.tls_ms = 0.0
+        self.last_used = time.monotonic()
+
+    def connect(self):
+        self.sock, self.connect_ms = _timed_tcp_connect(self.host, self.port, self.timeout)
+
+class TimedHTTPSConnection(http.client.HTTPSConnection):
+    """分别记录TCP连接与TLS握手耗时的HTTPS连接"""
+    def __init__(self, host, port=None, timeout=10, context=None):
+        super().__init__(host, port, timeout=timeout, context=context or ssl.create_default_context())
+        self.connect_ms = 0.0
+        self.tls_ms = 0.0
+        self.last_used = time.monotonic()
+
+    def connect(self):
+        sock, self.connect_ms = _timed_tcp_connect(self.host, self.port, self.timeout)
+        tls_start = time.perf_counter()
+        try:
+            self.sock = self._context.wrap_socket(sock, server_hostname=self.host)
+        except Exception:
+            sock.close()
+            raise
+        self.tls_ms = (time.perf_counter() - tls_start) * 1000
+
+class HttpConnectionPool:
+    """按 (协议, 主机, 端口) 复用 keep-alive 连接的连接池"""
+    def __init__(self, max_idle_per_host=4, idle_timeout=POOL_IDLE_TIMEOUT):
+        self.max_idle_per_host = max_idle_per_host
+        self.idle_timeout = idle_timeout
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _pool_key(url):
+        parsed = urllib.parse.urlsplit(url)
+        scheme = parsed.scheme or "https"
+        port = parsed.port or (443 if scheme == "https" else 80)
+        return (scheme, parsed.hostname, port)
+
+    def acquire(self, url, timeout=10):
+        """取出一个空闲连接，没有可用连接时新建（未连接状态）"""
+        key = self._pool_key(url)
+        now = time.monotonic()
+        with self._lock:
+            idle_list = self._idle.get(key, [])
+            while idle_list:
+                conn = idle_list.pop()
+                if now - conn.last_used < self.idle_timeout and conn.sock is not None:
+                    conn.timeout = timeout
+                    conn.sock.settimeout(timeout)
+                    conn.reused = True
+                    return conn
+                conn.close()
+        scheme, host, port = key
+        if scheme == "https":
+            conn = TimedHTTPSConnection(host, port, timeout=timeout)
+        else:
+            conn = TimedHTTPConnection(host, port, timeout=timeout)
+        conn.reused = False
+        return conn
+
+    def release(self, conn, reusable=True):
+        """归还连接；不可复用的连接直接关闭"""
+        if not reusable or conn.sock is None:
+            conn.close()
+            return
+        conn.last_used = time.monotonic()
+        scheme = "https" if isinstance(conn, TimedHTTPSConnection) else "http"
+        key = (scheme, conn.host, conn.port)
+        with self._lock:
+            idle_list = self._idle.setdefault(key, [])
+            if len(idle_list) >= self.max_idle_per_host:
+                conn.close()
+            else:
+                idle_list.append(conn)
+
+    def request(self, method, url, body=None, headers=None, timeout=10):
+        """发送请求并完整读取响应，返回 (状态码, 响应头, 响应体, 计时信息)
+
+        复用的连接可能已被服务器关闭，此时自动换用新连接重试一次。
+        """
+        path = urllib.parse.urlsplit(url)
+        target = path.path or "/"
+        if path.query:
+            target += "?" + path.query
+        for _ in range(2):
+            conn = self.acquire(url, timeout=timeout)
+            reused = conn.reused
+            try:
+                if conn.sock is None:
+                    conn.connect()
+                send_start = time.perf_counter()
+                conn.request(method, target, body=body, headers=headers or {})
+                response = conn.getresponse()
+                ttfb_ms = (time.perf_counter() - send_start) * 1000
+                data = response.read()
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                conn.close()
+                if reused:
+                    continue
+                raise
+            except Exception:
+                conn.close()
+                raise
+            timing = {
+                "connect_ms": 0.0 if reused else conn.connect_ms,
+                "tls_ms": 0.0 if reused else conn.tls_ms,
+                "ttfb_ms": ttfb_ms,
+                "reused": reused
+            }
+            self.release(conn, reusable=not response.will_close)
+            return response.status, response.headers, data, timing
+        raise ConnectionError("连接池中的连接均已失效")
+
+    def prewarm(self, url, timeout=10):
+        """预先建立一条连接放入连接池，返回握手耗时信息"""
+        conn = self.acquire(url, timeout=timeout)
+        if conn.reused:
+            self.release(conn)
+            return {"connect_ms": 0.0, "tls_ms": 0.0, "reused": True}
+        try:
+            conn.connect()
+        except Exception:
+            conn.close()
+            raise
+        self.release(conn)
+        return {"connect_ms": conn.connect_ms, "tls_ms": conn.tls_ms, "reused": False}
+
+    def close_all(self):
+        """关闭所有空闲连接"""
+        with self._lock:
+            for idle_list in self._idle.values():
+                for conn in idle_list:
+                    conn.close()
+            self._idle.clear()
+
+# 全局共享的连接池
+API_CONNECTION_POOL = HttpConnectionPool()
+
+def create_openai_client(api_key, base_url=DEEPSEEK_API_BASE_URL_V1):
+    """创建OpenAI客户端（重试由 call_with_retry 统一负责，关闭SDK自带重试）
+
+    httpx可用时把SDK连接池的keep-alive延长到 POOL_IDLE_TIMEOUT，
+    使预热的连接能保留到用户真正发送消息。
+    """
+    if httpx is not None:
+        http_client = DefaultHttpxClient(
+            limits=httpx.Limits(max_connections=100, max_keepalive_connections=20,
+                                keepalive_expiry=POOL_IDLE_TIMEOUT)
+        )
+        return OpenAI(api_key=api_key, base_url=base_url, http_client=http_client, max_retries=0)
+    return OpenAI(api_key=api_key, base_url=base_url, max_retries=0)
+
+class ConnectionPrewarmer:
+    """用户开始输入时在后台预热连接
+
+    空闲一段时间后的第一次按键会在后台建立并激活一条连接：
+    一方面通过全局连接池测量握手耗时，另一方面向SDK客户端发送一次轻量请求，
+    让随后的 chat.completions.create 直接使用已建立的连接。
+    """
+    def __init__(self, idle_threshold=PREWARM_IDLE_THRESHOLD, warm_window=POOL_IDLE_TIMEOUT):
+        self.idle_threshold = idle_threshold
+        self.warm_window = warm_window
+        self.last_network_use = 0.0
+        self.warm_until = 0.0
+        self.last_handshake_ms = None
+        self.saved_ms_total = 0.0
+        self.warm_sends = 0
+        self.reused_sends = 0
+        self.cold_sends = 0
+        self.last_send_reused = False
+        # 预热新建了连接且尚未被发送使用，只有此时发送才计入节省的握手延迟
+        self._prewarmed = False
+        self._warming = False
+        self._lock = threading.Lock()
+
+    def mark_network_use(self):
+        """记录一次网络请求，期间连接保持温热"""
+        now = time.monotonic()
+        self.last_network_use = now
+        self.warm_until = max(self.warm_until, now + self.warm_window)
+
+    def maybe_prewarm(self, client, base_url=DEEPSEEK_API_BASE_URL_V1):
+        """连接可能已冷却时启动后台预热，返回是否启动了预热"""
+        if client is None:
+            return False
+        with self._lock:
+            if self._warming or time.monotonic() - self.last_network_use < self.idle_threshold:
+                return False
+            self._warming = True
+        threading.Thread(target=self._warm, args=(client, base_url), daemon=True).start()
+        return True
+
+    def _warm(self, client, base_url):
+        try:
+            timing = API_CONNECTION_POOL.prewarm(base_url)
+            if not timing["reused"]:
+                self.last_handshake_ms = timing["connect_ms"] + timing["tls_ms"]
+            # 与其他请求一样经过调度器、限流器与熔断器
+            call_with_retry("prewarm", client.models.list)
+            self.mark_network_use()
+            if not timing["reused"]:
+                with self._lock:
+                    self._prewarmed = True
+        except Exception:
+            pass
+        finally:
+            with self._lock:
+                self._warming = False
+
+    def on_send(self):
+        """发送请求时调用，返回本次预计节省的握手延迟（毫秒）
+
+        只有预热新建的连接被本次发送使用时才计入节省；连接因上一轮请求仍保持温热时
+        记为复用（last_send_reused），不计入节省，避免夸大预热效果。
+        """
+        now = time.monotonic()
+        saved = 0.0
+        warm = now < self.warm_until
+        with self._lock:
+            prewarmed, self._prewarmed = self._prewarmed, False
+        self.last_send_reused = False
+        if warm and prewarmed and self.last_handshake_ms is not None:
+            saved = self.last_handshake_ms
+            self.saved_ms_total += saved
+            self.warm_sends += 1
+        elif warm:
+            self.reused_sends += 1
+            self.last_send_reused = True
+        else:
+            self.cold_sends += 1
+        self.mark_network_use()
+        return saved
+
+class LatencyStats:
+    """滚动窗口延迟统计，提供百分位数"""
+    def __init__(self, window=50):
+        self._samples = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def add(self, value_ms):
+        with self._lock:
+            self._samples.append(value_ms)
+
+    def percentile(self, p):
+        """最近邻秩法计算百分位数，无样本时返回None"""
+        with self._lock:
+            samples = sorted(self._samples)
+        if not samples:
+            return None
+        rank = max(1, math.ceil(p / 100.0 * len(samples)))
+        return samples[rank - 1]
+
+    def summary(self):
+        return {
+            "count": len(self._samples),
+            "p50": self.percentile(50),
+            "p90": self.percentile(90),
+            "p99": self.percentile(99)
+        }
+
+class HealthProber:
+    """复用连接池发送轻量请求的网络健康探测器
+
+    分别测量TCP连接、TLS握手和首字节时间，并根据空闲/最小化状态自适应调整探测间隔。
+    带密钥的探测计入限流器（limiter 为None时使用全局 API_RATE_LIMITER），
+    并用响应中的限流头与429校正限流器；调度名额由调用方以后台类别持有。
+    """
+    def __init__(self, pool, probe_url, headers_provider=None,
+                 interval=HEALTH_PROBE_INTERVAL, max_interval=HEALTH_PROBE_MAX_INTERVAL, limiter=None):
+        self.pool = pool
+        self.limiter = limiter
+        self.probe_url = probe_url
+        self.headers_provider = headers_provider
+        self.base_interval = interval
+        self.max_interval = max_interval
+        self.interval = interval
+        self.total_stats = LatencyStats()
+        self.ttfb_stats = LatencyStats()
+        self.connect_stats = LatencyStats()
+        self.tls_stats = LatencyStats()
+
+    def probe(self, cancel_check=None):
+        """执行一次探测，返回包含各阶段耗时的结果字典；在限流器排队时被取消则抛出 RequestCancelled"""
+        headers = {"Accept": "application/json"}
+        if self.headers_provider:
+            headers.update(self.headers_provider() or {})
+        result = {"ok": False, "status": None, "error": None,
+                  "connect_ms": 0.0, "tls_ms": 0.0, "ttfb_ms": 0.0, "total_ms": 0.0, "reused": False}
+        # 不带密钥的探测不占用账户的请求额度
+        limiter = (self.limiter or API_RATE_LIMITER) if "Authorization" in headers else None
+        if limiter is not None and limiter.acquire(0, cancel_check=cancel_check) is None:
+            raise RequestCancelled("probe")
+        try:
+            status, response_headers, _, timing = self.pool.request("GET", self.probe_url, headers=headers,
+                                                                    timeout=5)
+        except socket.timeout:
+            result["error"] = "timeout"
+            return result
+        except Exception as e:
+            result["error"] = str(e) or e.__class__.__name__
+            return result
+
+        if limiter is not None:
+            limiter.update_from_headers(response_headers)
+            if status == 429:
+                limiter.on_rate_limited(parse_retry_after(response_headers.get("Retry-After")))
+        result.update(timing)
+        result["ok"] = True
+        result["status"] = status
+        result["total_ms"] = timing["connect_ms"] + timing["tls_ms"] + timing["ttfb_ms"]
+        self.total_stats.add(result["total_ms"])
+        self.ttfb_stats.add(timing["ttfb_ms"])
+        if not timing["reused"]:
+            self.connect_stats.add(timing["connect_ms"])
+            self.tls_stats.add(timing["tls_ms"])
+        return result
+
+    def adapt_interval(self, idle=False, minimized=False):
+        """空闲或最小化时指数退避探测间隔，活跃时恢复基础间隔"""
+        if idle or minimized:
+            self.interval = min(self.interval * 2, self.max_interval)
+        else:
+            self.interval = self.base_interval
+        return self.interval
+
+# ===================== 客户端限流 =====================
+def estimate_tokens(text):
+    """粗略估算文本的token数：中日韩字符约0.6个token，其余字符约4个字符1个token"""
+    if not text:
+        return 0
+    cjk = sum(1 for ch in text if "⺀" <= ch <= "鿿" or "가" <= ch <= "힯")
+    return int(cjk * 0.6 + (len(text) - cjk) / 4) + 1
+
+def estimate_request_tokens(messages, max_tokens=0):
+    """估算一次聊天请求占用的token额度（提示词 + 预计回复）"""
+    prompt_tokens = API_TOKEN_COUNTER.count_messages(messages)
+    return prompt_tokens + min(max_tokens, RATE_LIMIT_REPLY_RESERVE)
+
+class TokenCounter:
+    """本地token计数：有分词器时精确计数，否则使用 estimate_tokens 启发式估算
+
+    每条消息的计数按内容记忆（LRU），对话历史只有新增的消息需要重新分词，
+    每轮的计数开销与新文本长度成正比。分词器在首次计数时才加载。
+    """
+    MESSAGE_OVERHEAD = 4              # 每条消息的角色与格式开销
+
+    def __init__(self, tokenizer_file=TOKENIZER_FILE, memo_size=TOKEN_COUNT_MEMO_SIZE):
+        self.tokenizer_file = tokenizer_file
+        self.memo_size = memo_size
+        self._tokenizer = None
+        self._loaded = False
+        self._memo = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def _load(self):
+        if not self._loaded:
+            self._loaded = True
+            if Tokenizer is not None and os.path.exists(self.tokenizer_file):
+                try:
+                    self._tokenizer = Tokenizer.from_file(self.tokenizer_file)
+                except Exception as e:
+                    print(f"加载分词器失败，使用估算: {e}", file=sys.stderr)
+        return self._tokenizer
+
+    @property
+    def exact(self):
+        """是否使用本地分词器精确计数"""
+        return self._load() is not None
+
+    def count_text(self, text):
+        """计算一段文本的token数（不记忆，适合输入框中不断变化的草稿）"""
+        if not text:
+            return 0
+        tokenizer = self._load()
+        if tokenizer is None:
+            return estimate_tokens(text)
+        return len(tokenizer.encode(text, add_special_tokens=False).ids)
+
+    def count_message(self, message):
+        content = str(message.get("content") or "")
+        with self._lock:
+            count = self._memo.get(content)
+            if count is not None:
+                self._memo.move_to_end(content)
+                return count + self.MESSAGE_OVERHEAD
+        count = self.count_text(content)
+        with self._lock:
+            self._memo[content] = count
+            while len(self._memo) > self.memo_size:
+                self._memo.popitem(last=False)
+        return count + self.MESSAGE_OVERHEAD
+
+    def count_messages(self, messages):
+        """对话历史的token数，已计数过的消息直接取记忆结果"""
+        return sum(self.count_message(m) for m in messages)
+
+# 全局token计数器
+API_TOKEN_COUNTER = TokenCounter()
+
+class TokenBucket:
+    """令牌桶：容量为每分钟额度，按秒匀速补充"""
+    def __init__(self, per_minute):
+        self.capacity = float(per_minute)
+        self.tokens = float(per_minute)
+        self.rate = per_minute / 60.0
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount):
+        """距离桶内有足够令牌还需等待的秒数"""
+        self._refill()
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) / self.rate if self.rate > 0 else float("inf")
+
+    def consume(self, amount):
+        self._refill()
+        self.tokens -= min(amount, self.capacity)
+
+    def set_rate(self, per_minute):
+        self._refill()
+        self.rate = per_minute / 60.0
+
+class RateLimiter:
+    """请求数/令牌数双令牌桶限流器
+
+    所有调用路径共享同一实例，排队请求按到达顺序依次放行而不是直接失败。
+    遇到429时成倍降低速率，之后随成功请求逐步恢复；响应中的限流头会校正桶的容量与余量。
+    """
+    def __init__(self, requests_per_minute=None, tokens_per_minute=None):
+        self.request_bucket = TokenBucket(requests_per_minute or RATE_LIMIT_RPM)
+        self.token_bucket = TokenBucket(tokens_per_minute or RATE_LIMIT_TPM)
+        self.throttle = 1.0
+        self.blocked_until = 0.0
+        self.rate_limited_count = 0
+        self._cond = threading.Condition()
+        self._next_ticket = 0
+        self._serving = 0
+        self._abandoned = set()
+
+    @property
+    def queue_depth(self):
+        """当前排队等待的请求数"""
+        with self._cond:
+            return self._next_ticket - self._serving - len(self._abandoned)
+
+    def _advance(self):
+        self._serving += 1
+        while self._serving in self._abandoned:
+            self._abandoned.discard(self._serving)
+            self._serving += 1
+        self._cond.notify_all()
+
+    def acquire(self, estimated_tokens=0, cancel_check=None):
+        """按先来先服务排队等待额度，返回等待秒数；cancel_check()为真时放弃排队并返回None"""
+        start = time.monotonic()
+        with self._cond:
+            ticket = self._next_ticket
+            self._next_ticket += 1
+            while True:
+                if cancel_check and cancel_check():
+                    if ticket == self._serving:
+                        self._advance()
+                    else:
+                        self._abandoned.add(ticket)
+                    return None
+                if ticket == self._serving:
+                    wait = max(self.blocked_until - time.monotonic(),
+                               self.request_bucket.wait_time(1),
+                               self.token_bucket.wait_time(estimated_tokens))
+                    if wait <= 0:
+                        self.request_bucket.consume(1)
+                        self.token_bucket.consume(estimated_tokens)
+                        self._advance()
+                        return time.monotonic() - start
+                    self._cond.wait(min(wait, 0.1))
+                else:
+                    self._cond.wait(0.1)
+
+    def _apply_throttle(self):
+        self.request_bucket.set_rate(self.request_bucket.capacity * self.throttle)
+        self.token_bucket.set_rate(self.token_bucket.capacity * self.throttle)
+
+    def on_rate_limited(self, retry_after=None):
+        """收到429：速率减半，并在 Retry-After 期间暂停放行"""
+        with self._cond:
+            self.rate_limited_count += 1
+            self.throttle = max(0.1, self.throttle * 0.5)
+            self._apply_throttle()
+            self.request_bucket.tokens = 0.0
+            if retry_after:
+                self.blocked_until = max(self.blocked_until, time.monotonic() + retry_after)
+
+    def on_success(self):
+        """请求成功：逐步恢复速率"""
+        with self._cond:
+            if self.throttle < 1.0:
+                self.throttle = min(1.0, self.throttle + 0.05)
+                self._apply_throttle()
+
+    def headroom(self):
+        """剩余额度比例（0~1）：两个桶取较小值并按降速系数折算；暂停放行时为0，排队越多越低"""
+        with self._cond:
+            if time.monotonic() < self.blocked_until:
+                return 0.0
+            ratios = []
+            for bucket in (self.request_bucket, self.token_bucket):
+                bucket._refill()
+                ratios.append(max(0.0, bucket.tokens) / bucket.capacity if bucket.capacity else 0.0)
+            queued = self._next_ticket - self._serving - len(self._abandoned)
+            return min(ratios) * self.throttle / (1 + queued)
+
+    def update_from_headers(self, headers):
+        """根据响应中的 x-ratelimit-* 头校正额度（服务端未返回时不做处理）"""
+        if not headers:
+            return
+        def header_int(name):
+            try:
+                return int(float(headers.get(name)))
+            except (TypeError, ValueError):
+                return None
+        with self._cond:
+            for bucket, kind in ((self.request_bucket, "requests"), (self.token_bucket, "tokens")):
+                limit = header_int(f"x-ratelimit-limit-{kind}")
+                remaining = header_int(f"x-ratelimit-remaining-{kind}")
+                if limit:
+                    bucket.capacity = float(limit)
+                    bucket.set_rate(limit * self.throttle)
+                if remaining is not None:
+                    bucket._refill()
+                    bucket.tokens = min(bucket.tokens, float(remaining))
+
+# 全局共享的限流器：GUI、CLI与基准测试的所有请求都经过它
+API_RATE_LIMITER = RateLimiter()
+
+# ===================== 请求调度 =====================
+class RequestScheduler:
+    """按优先级类别调度网络请求：每个类别有独立的并发上限，并共享总并发上限
+
+    高优先级类别有排队中且未达上限的请求时，低优先级类别的排队请求不会被放行，
+    因此交互式聊天总是先于排队中的后台请求执行（已在运行的后台请求不受影响）。
+    各类别的排队等待时间单独统计。
+    """
+    def __init__(self, classes=None, max_concurrency=None):
+        self.classes = {name: dict(config) for name, config in (classes or SCHEDULER_CLASSES).items()}
+        self.max_concurrency = max_concurrency or SCHEDULER_MAX_CONCURRENCY
+        self.wait_stats = {name: LatencyStats() for name in self.classes}
+        self._active = {name: 0 for name in self.classes}
+        self._waiting = {name: deque() for name in self.classes}
+        self._tickets = itertools.count()
+        self._cond = threading.Condition()
+
+    def _can_start(self, name, ticket):
+        config = self.classes[name]
+        if self._waiting[name][0] != ticket:
+            return False
+        if self._active[name] >= config["max_concurrency"] or sum(self._active.values()) >= self.max_concurrency:
+            return False
+        for other, other_config in self.classes.items():
+            if other_config["priority"] < config["priority"] and self._waiting[other] and \
+                    self._active[other] < other_config["max_concurrency"]:
+                return False
+        return True
+
+    def acquire(self, name, cancel_check=None):
+        """在该类别队列中等待执行名额，返回等待秒数；cancel_check()为真时放弃排队并返回None"""
+        start = time.monotonic()
+        with self._cond:
+            ticket = next(self._tickets)
+            self._waiting[name].append(ticket)
+            try:
+                while not self._can_start(name, ticket):
+                    if cancel_check and cancel_check():
+                        return None
+                    self._cond.wait(0.1 if cancel_check else None)
+                self._active[name] += 1
+            finally:
+                self._waiting[name].remove(ticket)
+                self._cond.notify_all()
+        waited = time.monotonic() - start
+        self.wait_stats[name].add(waited * 1000)
+        return waited
+
+    def release(self, name):
+        with self._cond:
+            self._active[name] -= 1
+            self._cond.notify_all()
+
+    @contextlib.contextmanager
+    def slot(self, name, cancel_check=None):
+        """在名额内执行一段代码：with API_REQUEST_SCHEDULER.slot("background") as waited: ..."""
+        waited = self.acquire(name, cancel_check)
+        if waited is None:
+            raise RequestCancelled(name)
+        try:
+            yield waited
+        finally:
+            self.release(name)
+
+    def set_limit(self, name, max_concurrency):
+        """调整某一类别的并发上限"""
+        with self._cond:
+            self.classes[name]["max_concurrency"] = max_concurrency
+            self._cond.notify_all()
+
+    def stats(self):
+        """各类别的运行数、排队数与排队等待分位数"""
+        with self._cond:
+            counts = {name: (self._active[name], len(self._waiting[name])) for name in self.classes}
+        return {name: {"active": active, "queued": queued, "wait_ms": self.wait_stats[name].summary()}
+                for name, (active, queued) in counts.items()}
+
+# 全局共享的请求调度器
+API_REQUEST_SCHEDULER = RequestScheduler()
+
+# ===================== API Key 池 =====================
+def mask_api_key(api_key):
+    """掩码显示API密钥：前后各保留2位明文"""
+    if not api_key:
+        return ""
+    if len(api_key) <= 4:
+        return "*" * len(api_key)
+    return api_key[:2] + "*" * (len(api_key) - 4) + api_key[-2:]
+
+class ApiKeySlot:
+    """密钥池中的单个密钥及其独立的限流、用量与隔离状态"""
+    def __init__(self, key, limiter=None):
+        self.key = key
+        self.limiter = limiter or RateLimiter()
+        self.quarantined_until = 0.0
+        self.quarantine_reason = None
+        self.requests = 0
+        self.failures = 0
+        self.estimated_tokens = 0
+
+    @property
+    def quarantined(self):
+        return time.monotonic() < self.quarantined_until
+
+class ApiKeyPool:
+    """多密钥调度：每次请求选用余量最多的密钥，401/402 的密钥暂时隔离
+
+    第一个密钥（主密钥）沿用全局限流器，只有一个密钥时行为与不使用密钥池完全一致。
+    """
+    def __init__(self):
+        self._slots = []
+        self._lock = threading.Lock()
+
+    @property
+    def size(self):
+        return len(self._slots)
+
+    def set_keys(self, keys):
+        """设置密钥列表（去重并保持顺序），已有密钥的状态保留"""
+        existing = {slot.key: slot for slot in self._slots}
+        slots = []
+        for key in keys:
+            if key and key not in (slot.key for slot in slots):
+                slots.append(existing.get(key) or ApiKeySlot(key))
+        if slots:
+            slots[0].limiter = API_RATE_LIMITER
+        with self._lock:
+            self._slots = slots
+
+    def select(self):
+        """选出未隔离且余量最多的密钥；全部被隔离时返回最早解除隔离的密钥"""
+        with self._lock:
+            slots = list(self._slots)
+        if not slots:
+            return None
+        available = [slot for slot in slots if not slot.quarantined]
+        if not available:
+            return min(slots, key=lambda slot: slot.quarantined_until)
+        return max(available, key=lambda slot: slot.limiter.headroom())
+
+    def available_count(self):
+        return sum(1 for slot in self._slots if not slot.quarantined)
+
+    def quarantine(self, slot, category):
+        """按错误类别隔离密钥一段时间"""
+        slot.quarantined_until = time.monotonic() + KEY_QUARANTINE_SECONDS.get(category, 300)
+        slot.quarantine_reason = category
+
+    def stats(self):
+        """各密钥的掩码、余量、用量与隔离状态"""
+        now = time.monotonic()
+        return [{
+            "key": mask_api_key(slot.key),
+            "headroom": slot.limiter.headroom(),
+            "requests": slot.requests,
+            "failures": slot.failures,
+            "estimated_tokens": slot.estimated_tokens,
+            "quarantine_in": max(0.0, slot.quarantined_until - now),
+            "quarantine_reason": slot.quarantine_reason if slot.quarantined else None
+        } for slot in self._slots]
+
+# 全局共享的密钥池：聊天请求经由它在多个密钥之间调度
+API_KEY_POOL = ApiKeyPool()
+
+# ===================== 错误分类 =====================
+# 错误类别对应的中文描述
+ERROR_CATEGORY_TEXT = {
+    "bad_request": "请求格式错误",
+    "auth": "认证失败",
+    "payment": "余额不足",
+    "permission": "访问被禁",
+    "not_found": "未找到",
+    "unprocessable": "参数错误",
+    "client": "客户端错误",
+    "rate_limit": "请求限制",
+    "overloaded": "服务器繁忙",
+    "server": "服务器错误",
+    "timeout": "超时",
+    "connection": "网络错误",
+    "stalled": "流式输出停滞",
+    "circuit_open": "熔断中",
+    "cancelled": "已取消",
+    "unknown": "未知错误"
+}
+
+# 说明服务端不健康、需要计入熔断统计的类别
+ENDPOINT_FAILURE_CATEGORIES = {"rate_limit", "overloaded", "server", "timeout", "connection", "stalled"}
+
+class ApiErrorInfo:
+    """结构化的API错误记录"""
+    def __init__(self, category, status=None, retryable=False, retry_after=None, message="", details=None):
+        self.category = category
+        self.status = status
+        self.retryable = retryable
+        self.retry_after = retry_after
+        self.message = message
+        self.details = details
+
+    @property
+    def endpoint_failure(self):
+        return self.category in ENDPOINT_FAILURE_CATEGORIES
+
+    def describe(self):
+        """适合直接展示给用户的一行描述"""
+        text = ERROR_CATEGORY_TEXT.get(self.category, "未知错误")
+        if self.status:
+            text += f" ({self.status})"
+        if self.message:
+            text += f": {self.message}"
+        return text
+
+    def __repr__(self):
+        return (f"ApiErrorInfo(category={self.category!r}, status={self.status!r}, "
+                f"retryable={self.retryable!r}, retry_after={self.retry_after!r})")
+
+def classify_status(status):
+    """把HTTP状态码映射到错误类别"""
+    status_categories = {
+        400: "bad_request", 401: "auth", 402: "payment", 403: "permission", 404: "not_found",
+        408: "timeout", 422: "unprocessable", 429: "rate_limit", 503: "overloaded"
+    }
+    if status in status_categories:
+        return status_categories[status]
+    if 400 <= status < 500:
+        return "client"
+    if status >= 500:
+        return "server"
+    return "unknown"
+
+def _response_details(response):
+    """尽量把响应体解析为JSON，用于错误对话框"""
+    try:
+        return response.json()
+    except Exception:
+        return getattr(response, "text", None) or None
+
+def classify_error(error):
+    """把 openai SDK 异常、requests 异常、套接字异常或HTTP响应对象统一映射为 ApiErrorInfo"""
+    if isinstance(error, CircuitBreakerOpen):
+        return ApiErrorInfo("circuit_open", retry_after=error.retry_in, message=str(error))
+    if isinstance(error, RequestCancelled):
+        return ApiErrorInfo("cancelled")
+    if isinstance(error, StreamStalled):
+        return ApiErrorInfo("stalled", message=str(error))
+
+    response = None
+    status = None
+    details = None
+    if isinstance(error, openai.APIStatusError):
+        status = error.status_code
+        response = error.response
+        details = error.body
+    elif isinstance(error, requests.exceptions.HTTPError):
+        response = error.response
+        status = response.status_code if response is not None else None
+    elif isinstance(error, RawStreamHTTPError):
+        status = error.status_code
+        response = types.SimpleNamespace(headers=error.headers)
+        details = error.body
+    elif not isinstance(error, BaseException) and isinstance(getattr(error, "status_code", None), int):
+        # 直接传入的HTTP响应对象（requests.Response 等）
+        response = error
+        status = error.status_code
+
+    if status is not None:
+        headers = getattr(response, "headers", None) or {}
+        if details is None and response is not None:
+            details = _response_details(response)
+        message = "" if response is error else str(error)
+        return ApiErrorInfo(classify_status(status), status=status,
+                            retryable=status in RETRYABLE_STATUS_CODES,
+                            retry_after=parse_retry_after(headers.get("retry-after")),
+                            message=message, details=details)
+
+    timeout_errors = (openai.APITimeoutError, requests.exceptions.Timeout, socket.timeout, TimeoutError)
+    connection_errors = (openai.APIConnectionError, requests.exceptions.ConnectionError,
+                         http.client.HTTPException, ConnectionError)
+    if httpx is not None:
+        # 流式读取过程中的网络错误不会被SDK包装，直接以httpx异常抛出
+        timeout_errors += (httpx.TimeoutException,)
+        connection_errors += (httpx.TransportError,)
+    if isinstance(error, timeout_errors):
+        return ApiErrorInfo("timeout", retryable=True, message=str(error))
+    if isinstance(error, connection_errors):
+        return ApiErrorInfo("connection", retryable=True, message=str(error))
+    return ApiErrorInfo("unknown", message=str(error))
+
+class ErrorMetrics:
+    """按类别统计错误次数"""
+    def __init__(self):
+        self.counts = {}
+        self._lock = threading.Lock()
+
+    def record(self, info):
+        with self._lock:
+            self.counts[info.category] = self.counts.get(info.category, 0) + 1
+
+    def summary(self, limit=3):
+        """出现次数最多的几个类别，例如 "请求限制 2 / 网络错误 1" """
+        with self._lock:
+            items = sorted(self.counts.items(), key=lambda item: -item[1])[:limit]
+        return " / ".join(f"{ERROR_CATEGORY_TEXT.get(k, k)} {v}" for k, v in items)
+
+# 全局错误统计
+API_ERROR_METRICS = ErrorMetrics()
+
+# ===================== 上下文缓存统计 =====================
+def model_price(model):
+    """模型的价格表项，未知模型按 deepseek-chat 计价"""
+    return MODEL_PRICES.get(model, DEFAULT_MODEL_PRICE)
+
+class ContextCacheStats:
+    """DeepSeek 服务端上下文缓存的命中统计
+
+    服务端按提示词前缀缓存，命中部分按较低价格计费。聊天历史只在末尾追加，
+    不改写、不重新格式化之前的轮次，使每次请求都以上一轮请求的全部内容为前缀。
+    每次上游请求结束时根据流末尾 usage 中的 prompt_cache_hit_tokens /
+    prompt_cache_miss_tokens 记录一轮。
+    """
+    def __init__(self, history=100):
+        self.turns = 0
+        self.hit_tokens = 0
+        self.miss_tokens = 0
+        self.saved = 0.0              # 相比全部未命中节省的费用（元）
+        self.recent = deque(maxlen=history)
+        self._lock = threading.Lock()
+
+    def record(self, model, usage):
+        """记录一次请求的缓存命中情况，usage 不含缓存字段时忽略"""
+        hit = getattr(usage, "prompt_cache_hit_tokens", None)
+        miss = getattr(usage, "prompt_cache_miss_tokens", None)
+        if hit is None and miss is None:
+            return
+        hit, miss = hit or 0, miss or 0
+        price = model_price(model)
+        saved = hit * (price["input_miss"] - price["input_hit"]) / 1e6
+        with self._lock:
+            self.turns += 1
+            self.hit_tokens += hit
+            self.miss_tokens += miss
+            self.saved += saved
+            self.recent.append({"model": model, "hit_tokens": hit, "miss_tokens": miss, "saved": saved})
+
+    def stats(self):
+        with self._lock:
+            total = self.hit_tokens + self.miss_tokens
+            return {
+                "turns": self.turns,
+                "hit_tokens": self.hit_tokens,
+                "miss_tokens": self.miss_tokens,
+                "hit_ratio": self.hit_tokens / total if total else None,
+                "saved": self.saved,
+                "last": self.recent[-1] if self.recent else None
+            }
+
+# 全局上下文缓存统计
+API_CONTEXT_CACHE_STATS = ContextCacheStats()
+
+# ===================== 用量账本 =====================
+def load_model_prices():
+    """从 model_prices.json 读取价格覆盖，格式与 MODEL_PRICES 相同；文件不存在或无效时返回空字典"""
+    if not os.path.exists(MODEL_PRICES_FILENAME):
+        return {}
+    try:
+        with open(MODEL_PRICES_FILENAME, "r", encoding="utf-8") as f:
+            prices = json.load(f)
+        return {model: dict(DEFAULT_MODEL_PRICE, **price) for model, price in prices.items()}
+    except (OSError, ValueError, TypeError, AttributeError) as e:
+        print(f"读取价格表失败，使用内置价格: {e}", file=sys.stderr)
+        return {}
+
+def _usage_value(usage, name):
+    """读取 usage 字段，兼容SDK对象与原始SSE路径的字典"""
+    if usage is None:
+        return None
+    if isinstance(usage, dict):
+        return usage.get(name)
+    return getattr(usage, name, None)
+
+def compute_usage_cost(model, prompt_tokens, completion_tokens, cache_hit_tokens=None, cache_miss_tokens=None):
+    """按价格表计算一次请求的费用（元）；未返回缓存字段时输入全部按未命中计价"""
+    price = model_price(model)
+    if cache_hit_tokens is None and cache_miss_tokens is None:
+        cache_hit_tokens, cache_miss_tokens = 0, prompt_tokens
+    return ((cache_hit_tokens or 0) * price["input_hit"] + (cache_miss_tokens or 0) * price["input_miss"] +
+            completion_tokens * price["output"]) / 1e6
+
+class UsageLedger:
+    """逐请求的用量与费用账本
+
+    每条记录包含 token 用量（输入/输出/推理/缓存命中）、各阶段延迟与按价格表算出的费用，
+    追加写入 JSONL 文件；按本次运行（会话）与按天汇总。按天汇总在首次查询时扫描一遍文件，
+    之后随新记录增量更新。
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.enabled = True
+        self.session_id = time.strftime("%Y%m%d-%H%M%S") + f"-{os.getpid()}"
+        self.session = self._empty_summary()
+        self._days = None             # {日期: 汇总}，延迟加载
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _empty_summary():
+        return {"requests": 0, "prompt_tokens": 0, "completion_tokens": 0, "reasoning_tokens": 0,
+                "cache_hit_tokens": 0, "cost": 0.0, "ttft_ms": 0.0, "total_ms": 0.0}
+
+    @staticmethod
+    def _accumulate(summary, entry):
+        summary["requests"] += 1
+        for field in ("prompt_tokens", "completion_tokens", "reasoning_tokens", "cache_hit_tokens"):
+            summary[field] += entry.get(field) or 0
+        summary["cost"] += entry.get("cost") or 0.0
+        summary["ttft_ms"] += entry.get("ttft_ms") or 0.0
+        summary["total_ms"] += entry.get("total_ms") or 0.0
+
+    def record(self, model, usage, queue_ms=0.0, ttft_ms=None, total_ms=None, resumes=0):
+        """记录一次请求；usage 为流末尾的用量分块（多段续传时为各段之和）"""
+        if not self.enabled or usage is None:
+            return None
+        prompt_tokens = _usage_value(usage, "prompt_tokens") or 0
+        completion_tokens = _usage_value(usage, "completion_tokens") or 0
+        details = _usage_value(usage, "completion_tokens_details")
+        hit = _usage_value(usage, "prompt_cache_hit_tokens")
+        miss = _usage_value(usage, "prompt_cache_miss_tokens")
+        now = time.time()
+        entry = {
+            "ts": round(now, 3),
+            "day": time.strftime("%Y-%m-%d", time.localtime(now)),
+            "session": self.session_id,
+            "model": model,
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "reasoning_tokens": _usage_value(details, "reasoning_tokens") or 0,
+            "cache_hit_tokens": hit,
+            "cache_miss_tokens": miss,
+            "queue_ms": round(queue_ms, 1),
+            "ttft_ms": round(ttft_ms, 1) if ttft_ms is not None else None,
+            "total_ms": round(total_ms, 1) if total_ms is not None else None,
+            "resumes": resumes,
+            "cost": round(compute_usage_cost(model, prompt_tokens, completion_tokens, hit, miss), 6)
+        }
+        with self._lock:
+            self._accumulate(self.session, entry)
+            if self._days is not None:
+                self._accumulate(self._days.setdefault(entry["day"], self._empty_summary()), entry)
+            try:
+                with open(self.filename, "a", encoding="utf-8") as f:
+                    f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+            except OSError as e:
+                print(f"写入用量账本失败: {e}", file=sys.stderr)
+        return entry
+
+    def _load_days(self):
+        days = {}
+        try:
+            with open(self.filename, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue      # 跳过写入中断留下的残行
+                    self._accumulate(days.setdefault(entry.get("day", "?"), self._empty_summary()), entry)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            print(f"读取用量账本失败: {e}", file=sys.stderr)
+        return days
+
+    def session_summary(self):
+        with self._lock:
+            return dict(self.session)
+
+    def daily_summaries(self, days=7):
+        """最近若干天的汇总，按日期倒序返回 [(日期, 汇总)]"""
+        with self._lock:
+            if self._days is None:
+                self._days = self._load_days()
+            return [(day, dict(summary)) for day, summary in sorted(self._days.items(), reverse=True)[:days]]
+
+    def today_summary(self):
+        today = time.strftime("%Y-%m-%d")
+        for day, summary in self.daily_summaries(days=1):
+            if day == today:
+                return summary
+        return self._empty_summary()
+
+def format_usage_summary(summary):
+    """把汇总格式化为一行文字"""
+    if not summary["requests"]:
+        return "0 次请求"
+    text = (f"{summary['requests']} 次请求，输入 {summary['prompt_tokens']} "
+            f"(缓存命中 {summary['cache_hit_tokens']}) / 输出 {summary['completion_tokens']} tokens")
+    if summary["reasoning_tokens"]:
+        text += f" (推理 {summary['reasoning_tokens']})"
+    text += (f"，平均首字 {summary['ttft_ms'] / summary['requests']:.0f}ms / "
+             f"总耗时 {summary['total_ms'] / summary['requests']:.0f}ms，费用 ¥{summary['cost']:.4f}")
+    return text
+
+def print_usage_report(days=7):
+    """打印本次运行与最近几天的用量汇总（--usage 与 CLI 的 usage 命令）"""
+    print(f"本次运行: {format_usage_summary(API_USAGE_LEDGER.session_summary())}")
+    daily = API_USAGE_LEDGER.daily_summaries(days)
+    if not daily:
+        print("用量账本中暂无记录。")
+    for day, summary in daily:
+        print(f"{day}: {format_usage_summary(summary)}")
+
+MODEL_PRICES.update(load_model_prices())
+
+# 全局用量账本
+API_USAGE_LEDGER = UsageLedger(USAGE_LEDGER_FILENAME)
+
+# ===================== 请求重试策略 =====================
+# 可以重试的HTTP状态码
+RETRYABLE_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504}
+# 非幂等请求（如聊天）只在服务器明确拒绝、尚未处理请求时重试
+NON_IDEMPOTENT_RETRYABLE_STATUS_CODES = {429, 503}
+
+class RetryPolicy:
+    """单个操作的重试策略：全抖动指数退避，并遵守 Retry-After"""
+    def __init__(self, max_attempts=3, base_delay=0.5, max_delay=8.0, budget=20.0, idempotent=True):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.budget = budget          # 单次调用允许用于等待重试的总秒数
+        self.idempotent = idempotent
+
+    def is_retryable(self, info):
+        """根据 ApiErrorInfo 判断是否值得重试"""
+        if not info.retryable:
+            return False
+        if info.status is not None and not self.idempotent:
+            return info.status in NON_IDEMPOTENT_RETRYABLE_STATUS_CODES
+        return True
+
+    def backoff_delay(self, attempt, info=None):
+        """第 attempt 次失败后的等待秒数；服务器给出 Retry-After 时以其为准"""
+        if info is not None and info.retry_after is not None:
+            return info.retry_after
+        return random.uniform(0, min(self.max_delay, self.base_delay * (2 ** (attempt - 1))))
+
+# 按操作划分的重试预算
+RETRY_POLICIES = {
+    "chat": RetryPolicy(max_attempts=3, base_delay=1.0, max_delay=10.0, budget=30.0, idempotent=False),
+    "models": RetryPolicy(max_attempts=4, base_delay=0.5, max_delay=8.0, budget=20.0),
+    "balance": RetryPolicy(max_attempts=4, base_delay=0.5, max_delay=8.0, budget=20.0),
+    "summary": RetryPolicy(max_attempts=3, base_delay=1.0, max_delay=10.0, budget=30.0),
+    # 预热只是优化，失败即放弃，不占用重试预算
+    "prewarm": RetryPolicy(max_attempts=1)
+}
+DEFAULT_RETRY_POLICY = RetryPolicy()
+
+def parse_retry_after(value):
+    """解析 Retry-After 头（秒数或HTTP日期），返回等待秒数"""
+    if not value:
+        return None
+    value = str(value).strip()
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        from email.utils import parsedate_to_datetime
+        import datetime
+        retry_at = parsedate_to_datetime(value)
+        return max(0.0, (retry_at - datetime.datetime.now(retry_at.tzinfo)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+class RequestCancelled(Exception):
+    """请求在排队或重试等待期间被用户取消"""
+
+def call_with_retry(operation, func, on_retry=None, cancel_check=None, policy=None, estimated_tokens=0,
+                    key_pool=None, response_time=None):
+    """按操作的重试策略执行 func()
+
+    每次尝试前先按 REQUEST_CLASS_BY_OPERATION 在请求调度器中取得名额（聊天的名额由
+    stream_chat_resumable 按整条流持有），再经过限流器排队；on_retry(attempt, max_attempts, delay, exc)
+    在每次等待重试前调用；cancel_check() 返回True时放弃排队与剩余重试。
+    传入非空的 key_pool 时每次尝试先选出余量最多的密钥，在该密钥自己的限流器上排队，
+    并以 func(slot) 调用；401/402 的密钥被隔离后立即换用其他密钥重试。
+    response_time() 返回计入熔断器慢请求统计的秒数（返回None时使用本次尝试的总耗时）。
+    最终抛出的异常带有 retry_attempts 与 error_info（ApiErrorInfo）属性。
+    """
+    def elapsed(started):
+        measured = response_time() if response_time else None
+        return measured if measured is not None else time.monotonic() - started
+
+    policy = policy or RETRY_POLICIES.get(operation, DEFAULT_RETRY_POLICY)
+    request_class = REQUEST_CLASS_BY_OPERATION.get(operation)
+    waited = 0.0
+    attempt = 1
+    while True:
+        trial = API_CIRCUIT_BREAKER.before_request(cancel_check)
+        recorded = False
+        try:
+            if request_class and API_REQUEST_SCHEDULER.acquire(request_class, cancel_check) is None:
+                raise RequestCancelled(operation)
+            slot = key_pool.select() if key_pool else None
+            limiter = slot.limiter if slot else API_RATE_LIMITER
+            started = time.monotonic()
+            try:
+                if limiter.acquire(estimated_tokens, cancel_check=cancel_check) is None:
+                    raise RequestCancelled(operation)
+                if slot:
+                    slot.requests += 1
+                    slot.estimated_tokens += estimated_tokens
+                started = time.monotonic()
+                result = func(slot) if slot else func()
+                limiter.on_success()
+                API_CIRCUIT_BREAKER.record_success(elapsed(started))
+                recorded = True
+                return result
+            except RequestCancelled:
+                raise
+            except Exception as e:
+                info = classify_error(e)
+                e.retry_attempts = attempt
+                e.error_info = info
+                API_ERROR_METRICS.record(info)
+                if info.endpoint_failure:
+                    API_CIRCUIT_BREAKER.record_failure()
+                else:
+                    API_CIRCUIT_BREAKER.record_success(elapsed(started))
+                recorded = True
+                if info.category == "rate_limit":
+                    limiter.on_rate_limited(info.retry_after)
+                if slot:
+                    slot.failures += 1
+                    if info.category in KEY_QUARANTINE_SECONDS:
+                        key_pool.quarantine(slot, info.category)
+                        if key_pool.available_count() and attempt < policy.max_attempts:
+                            # 其余密钥仍可用，不计退避直接换密钥
+                            attempt += 1
+                            continue
+                if attempt >= policy.max_attempts or not policy.is_retryable(info):
+                    raise
+                delay = policy.backoff_delay(attempt, info)
+                if waited + delay > policy.budget:
+                    raise
+                failure = e
+            finally:
+                # 名额只覆盖单次尝试，退避等待期间让给其他请求
+                if request_class:
+                    API_REQUEST_SCHEDULER.release(request_class)
+        finally:
+            # 半开试探请求在得出结果前被取消或排队失败时归还试探名额，避免熔断器一直卡在半开
+            if trial and not recorded:
+                API_CIRCUIT_BREAKER.release_trial()
+        if on_retry:
+            on_retry(attempt, policy.max_attempts, delay, failure)
+        deadline = time.monotonic() + delay
+        while time.monotonic() < deadline:
+            if cancel_check and cancel_check():
+                raise failure
+            time.sleep(min(0.1, max(0.0, deadline - time.monotonic())))
+        waited += delay
+        attempt += 1
+
+# ===================== 熔断器 =====================
+class CircuitBreakerOpen(Exception):
+    """熔断器打开期间的快速失败"""
+    def __init__(self, retry_in):
+        self.retry_in = retry_in
+        super().__init__(f"服务暂时不可用（熔断保护中），约 {retry_in:.0f} 秒后探测恢复")
+
+class CircuitBreaker:
+    """包裹所有出站请求的熔断器
+
+    最近 window 次请求中错误率或慢请求比例超过阈值时打开，打开期间请求快速失败
+    （或在 queue_timeout 内排队等待）。冷却结束后进入半开状态，由健康探测器或
+    一次试探请求决定关闭还是重新打开。
+    """
+    def __init__(self, window=BREAKER_WINDOW, min_requests=BREAKER_MIN_REQUESTS,
+                 error_rate=BREAKER_ERROR_RATE, slow_call_seconds=BREAKER_SLOW_CALL_SECONDS,
+                 slow_call_rate=BREAKER_SLOW_CALL_RATE, open_seconds=BREAKER_OPEN_SECONDS,
+                 queue_timeout=BREAKER_QUEUE_TIMEOUT):
+        self.min_requests = min_requests
+        self.error_rate = error_rate
+        self.slow_call_seconds = slow_call_seconds
+        self.slow_call_rate = slow_call_rate
+        self.open_seconds = open_seconds
+        self.queue_timeout = queue_timeout
+        self._outcomes = deque(maxlen=window)   # (是否失败, 是否慢请求)
+        self._state = "closed"
+        self._open_until = 0.0
+        self._trial_in_flight = False
+        self.open_count = 0
+        self._cond = threading.Condition()
+
+    @property
+    def state(self):
+        """closed / open / half_open（冷却结束时自动从open转为half_open）"""
+        with self._cond:
+            return self._current_state()
+
+    def _current_state(self):
+        if self._state == "open" and time.monotonic() >= self._open_until:
+            self._state = "half_open"
+            self._trial_in_flight = False
+        return self._state
+
+    def stats(self):
+        """返回 (状态, 最近错误率, 距离半开的秒数)"""
+        with self._cond:
+            state = self._current_state()
+            failures = sum(1 for failed, _ in self._outcomes if failed)
+            rate = failures / len(self._outcomes) if self._outcomes else 0.0
+            return state, rate, max(0.0, self._open_until - time.monotonic())
+
+    def before_request(self, cancel_check=None):
+        """请求前检查；熔断打开时抛出 CircuitBreakerOpen
+
+        返回本次请求是否为半开状态下的试探请求；试探请求未得出结果时须调用 release_trial()。
+        """
+        deadline = time.monotonic() + self.queue_timeout
+        with self._cond:
+            while True:
+                state = self._current_state()
+                if state == "closed":
+                    return False
+                if state == "half_open" and not self._trial_in_flight:
+                    # 半开状态只放行一个试探请求
+                    self._trial_in_flight = True
+                    return True
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or (cancel_check and cancel_check()):
+                    raise CircuitBreakerOpen(max(0.0, self._open_until - time.monotonic()))
+                self._cond.wait(min(remaining, 0.5))
+
+    def release_trial(self):
+        """归还未得出结果的试探名额（请求被取消或未能发出），允许下一个请求试探"""
+        with self._cond:
+            if self._state == "half_open" and self._trial_in_flight:
+                self._trial_in_flight = False
+                self._cond.notify_all()
+
+    def record_success(self, elapsed_seconds=0.0):
+        with self._cond:
+            if self._current_state() == "half_open":
+                self._close()
+                return
+            self._outcomes.append((False, elapsed_seconds >= self.slow_call_seconds))
+            self._evaluate()
+
+    def record_failure(self):
+        with self._cond:
+            if self._current_state() == "half_open":
+                self._open()
+                return
+            self._outcomes.append((True, False))
+            self._evaluate()
+
+    def record_probe(self, healthy):
+        """健康探测结果：半开状态下成功则关闭，失败则重新打开"""
+        with self._cond:
+            if self._current_state() != "half_open":
+                return
+            if healthy:
+                self._close()
+            else:
+                self._open()
+
+    def _evaluate(self):
+        if len(self._outcomes) < self.min_requests:
+            return
+        failures = sum(1 for failed, _ in self._outcomes if failed)
+        slow = sum(1 for _, is_slow in self._outcomes if is_slow)
+        if failures / len(self._outcomes) >= self.error_rate or slow / len(self._outcomes) >= self.slow_call_rate:
+            self._open()
+
+    def _open(self):
+        self._state = "open"
+        self._open_until = time.monotonic() + self.open_seconds
+        self._trial_in_flight = False
+        self.open_count += 1
+        self._cond.notify_all()
+
+    def _close(self):
+        self._state = "closed"
+        self._outcomes.clear()
+        self._trial_in_flight = False
+        self._cond.notify_all()
+
+# 全局共享的熔断器
+API_CIRCUIT_BREAKER = CircuitBreaker()
+
+# ===================== 原始SSE快速路径 =====================
+class RawStreamHTTPError(Exception):
+    """原始SSE路径收到的错误状态码"""
+    def __init__(self, status_code, headers, body):
+        self.status_code = status_code
+        self.headers = headers
+        try:
+            self.body = json.loads(body)
+        except ValueError:
+            self.body = body.decode("utf-8", "replace") or None
+        super().__init__(f"HTTP {status_code}")
+
+class SseChunk:
+    """原始SSE解析出的单个增量
+
+    只保留用到的字段，并通过 chunk.choices[0].delta.content、
+    chunk.choices[0].finish_reason 提供与SDK分块相同的访问方式，调用方无需区分两条路径。
+    """
+    __slots__ = ("content", "reasoning_content", "finish_reason", "usage", "choices")
+
+    def __init__(self, content=None, reasoning_content=None, finish_reason=None, usage=None):
+        self.content = content
+        self.reasoning_content = reasoning_content
+        self.finish_reason = finish_reason
+        self.usage = usage
+        # 与SDK一致：只携带用量的末尾分块没有 choices
+        self.choices = (self,) if content is not None or reasoning_content is not None \
+            or finish_reason is not None else ()
+
+    @property
+    def delta(self):
+        return self
+
+class SseStreamParser:
+    """从复用的字节缓冲区中按行切分SSE事件，只解析 data 行"""
+    def __init__(self):
+        self._buffer = bytearray()
+        self.done = False
+
+    def feed(self, data):
+        """追加读取到的字节，返回本次解析出的 SseChunk 列表"""
+        buf = self._buffer
+        buf += data
+        chunks = []
+        start = 0
+        while not self.done:
+            end = buf.find(b"\n", start)
+            if end < 0:
+                break
+            # 空行、注释行（": keep-alive"）与 event/id 行直接跳过
+            if buf.startswith(b"data:", start, end):
+                if buf.startswith(b"data: [DONE]", start, end):
+                    self.done = True
+                else:
+                    chunk = self._parse_event(json.loads(buf[start + 5:end]))
+                    if chunk is not None:
+                        chunks.append(chunk)
+            start = end + 1
+        # 原地丢弃已处理的部分，缓冲区本身在整个流中复用
+        del buf[:start]
+        return chunks
+
+    @staticmethod
+    def _parse_event(event):
+        usage = event.get("usage")
+        if usage is not None:
+            usage = types.SimpleNamespace(**usage)
+        choices = event.get("choices")
+        if not choices:
+            return SseChunk(usage=usage) if usage is not None else None
+        choice = choices[0]
+        delta = choice.get("delta") or {}
+        return SseChunk(delta.get("content"), delta.get("reasoning_content"),
+                        choice.get("finish_reason"), usage)
+
+class RawChatStream:
+    """通过共享连接池直接读取 /chat/completions 的SSE流
+
+    绕过SDK为每个token构造pydantic对象的开销，按需通过 --raw-sse 启用。
+    属性布局与SDK的流对象保持一致（response.headers、sock、close()），
+    可以直接交给 StreamWatchdog 与 abort_response 使用。
+    """
+    READ_SIZE = 65536
+
+    def __init__(self, base_url, api_key, params, timeouts):
+        url = str(base_url).rstrip("/") + "/chat/completions"
+        target = urllib.parse.urlsplit(url).path
+        body = json.dumps(dict(params, stream=True)).encode("utf-8")
+        headers = {
+            "Authorization": f"Bearer {api_key}",
+            "Content-Type": "application/json",
+            "Accept": "text/event-stream",
+        }
+        read_timeout = max(timeouts["first_token"], timeouts["idle"]) + 5
+        self._conn = None
+        self._parser = SseStreamParser()
+        for _ in range(2):
+            conn = API_CONNECTION_POOL.acquire(url, timeout=timeouts["connect"])
+            reused = conn.reused
+            try:
+                if conn.sock is None:
+                    conn.connect()
+                conn.sock.settimeout(read_timeout)
+                conn.request("POST", target, body=body, headers=headers)
+                response = conn.getresponse()
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                conn.close()
+                if reused:
+                    # 复用的连接已被服务器关闭，换新连接重试一次
+                    continue
+                raise
+            except Exception:
+                conn.close()
+                raise
+            break
+        else:
+            raise ConnectionError("连接池中的连接均已失效")
+        if response.status >= 400:
+            data = response.read()
+            API_CONNECTION_POOL.release(conn, reusable=not response.will_close)
+            raise RawStreamHTTPError(response.status, response.headers, data)
+        self._conn = conn
+        self.response = response
+        self.sock = conn.sock
+
+    def __iter__(self):
+        parser = self._parser
+        read1 = self.response.read1
+        while not parser.done:
+            data = read1(self.READ_SIZE)
+            if not data:
+                break
+            yield from parser.feed(data)
+        if parser.done:
+            # 读完分块结束标记后连接可以放回连接池
+            self.response.read()
+        self.close()
+
+    def close(self):
+        conn, self._conn = self._conn, None
+        if conn is None:
+            return
+        if self._parser.done and self.response.isclosed():
+            API_CONNECTION_POOL.release(conn, reusable=not self.response.will_close)
+        else:
+            # 中途关闭的连接上仍有未读数据，不能复用
+            conn.close()
+
+# ===================== 流式输出超时监控 =====================
+class StreamStalled(Exception):
+    """流式输出在某一阶段超时"""
+    PHASE_TEXT = {"first_token": "首个token超时", "idle": "分块间隔超时", "total": "总时长超限"}
+
+    def __init__(self, phase, limit_seconds):
+        self.phase = phase
+        self.limit_seconds = limit_seconds
+        super().__init__(f"{self.PHASE_TEXT.get(phase, phase)} ({limit_seconds:.0f}s)")
+
+def stream_timeouts_for(model):
+    """返回模型的分阶段超时配置（默认值与模型专属配置合并，按名称包含关系匹配）"""
+    timeouts = dict(STREAM_TIMEOUTS["default"])
+    for name, overrides in STREAM_TIMEOUTS.items():
+        if name != "default" and model and name in model:
+            timeouts.update(overrides)
+    return timeouts
+
+def request_timeout_for(timeouts):
+    """把分阶段超时转换为SDK的请求超时参数
+
+    读超时比监视器阈值略长，仅作兜底，正常情况下由 StreamWatchdog 先行判定停滞。
+    """
+    read_timeout = max(timeouts["first_token"], timeouts["idle"]) + 5
+    if httpx is not None:
+        return httpx.Timeout(read_timeout, connect=timeouts["connect"])
+    return float(read_timeout)
+
+def abort_response(response):
+    """从任意线程立即中止流式响应
+
+    单纯关闭响应对象无法打断另一线程中阻塞的读取，因此先对底层套接字执行
+    shutdown 让读取立即返回，再关闭响应释放连接。
+    """
+    http_response = getattr(response, "response", response)
+    extensions = getattr(http_response, "extensions", None) or {}
+    network_stream = extensions.get("network_stream")
+    sock = None
+    if network_stream is not None:
+        try:
+            sock = network_stream.get_extra_info("socket")
+        except Exception:
+            sock = None
+    if sock is None:
+        sock = getattr(response, "sock", None)
+    if sock is not None:
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
     try:
-        from cryptography.fernet import Fernet
-    except ImportError:
-        print("cryptography库未安装，API Key将无法加密。请使用 pip install cryptography 安装。")
-        # 继续执行，但加密功能将降级
+        response.close()
+    except Exception:
+        pass
+
+class StreamWatchdog:
+    """监视流式响应的首个token、分块间隔与总时长
+
+    检测到停滞时从监视线程关闭响应，使读取线程立即退出阻塞，
+    随后由读取方抛出 StreamStalled。
+    """
+    def __init__(self, timeouts):
+        self.timeouts = timeouts
+        self.started = time.monotonic()
+        self.last_chunk = None
+        self.stalled = None
+        self.response = None
+        self._stopped = threading.Event()
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def attach(self, response):
+        self.response = response
+
+    def mark_chunk(self):
+        self.last_chunk = time.monotonic()
+
+    def stop(self):
+        self._stopped.set()
+
+    def _run(self):
+        while not self._stopped.wait(0.25):
+            now = time.monotonic()
+            if now - self.started > self.timeouts["total"]:
+                stall = StreamStalled("total", self.timeouts["total"])
+            elif self.last_chunk is None and now - self.started > self.timeouts["first_token"]:
+                stall = StreamStalled("first_token", self.timeouts["first_token"])
+            elif self.last_chunk is not None and now - self.last_chunk > self.timeouts["idle"]:
+                stall = StreamStalled("idle", self.timeouts["idle"])
+            else:
+                continue
+            self.stalled = stall
+            if self.response is not None:
+                abort_response(self.response)
+            return
+
+def _watched_chunks(buffered, iterator, watchdog, response):
+    """依次产出已缓冲与后续的分块；停滞时记录指标并抛出 StreamStalled
+
+    无论正常结束、出错还是被调用方提前关闭（含生成器被回收），都会关闭响应释放HTTP连接。
+    """
+    try:
+        for chunk in buffered:
+            yield chunk
+        try:
+            for chunk in iterator:
+                watchdog.mark_chunk()
+                yield chunk
+        except Exception:
+            if watchdog.stalled is None:
+                raise
+        if watchdog.stalled is not None:
+            # 首个token之后的停滞不经过重试引擎，在这里单独计入指标与熔断统计
+            API_ERROR_METRICS.record(classify_error(watchdog.stalled))
+            API_CIRCUIT_BREAKER.record_failure()
+            raise watchdog.stalled
+    finally:
+        watchdog.stop()
+        response.close()
+
+def open_chat_stream(client, on_retry=None, cancel_check=None, raw_sse=None, **params):
+    """创建流式聊天请求并读到第一个内容块为止
+
+    首个内容块之前的错误交给重试引擎处理，之后不再重试以免重复输出。
+    每次尝试都由 StreamWatchdog 按模型的分阶段超时监视。
+    raw_sse 为 None 时按 RAW_SSE_STREAMING 决定是否走原始SSE快速路径。
+    返回 (response, 分块迭代器)；迭代器结束或被关闭时停止监视。
+    """
+    timeouts = stream_timeouts_for(params.get("model"))
+    if raw_sse is None:
+        raw_sse = RAW_SSE_STREAMING
+    # 熔断器的慢请求按首个分块（含推理内容）计时：推理模型的正文往往在长时间推理之后才开始
+    first_chunk = {}
+
+    def attempt(slot=None):
+        attempt_started = time.monotonic()
+        first_chunk.clear()
+        watchdog = StreamWatchdog(timeouts)
+        stream_client = client
+        if slot is not None and slot.key != client.api_key:
+            stream_client = client.with_options(api_key=slot.key)
+        try:
+            if raw_sse:
+                response = RawChatStream(stream_client.base_url, stream_client.api_key, params, timeouts)
+            else:
+                response = stream_client.chat.completions.create(stream=True, timeout=request_timeout_for(timeouts),
+                                                                 **params)
+        except Exception:
+            watchdog.stop()
+            raise
+        watchdog.attach(response)
+        limiter = slot.limiter if slot is not None else API_RATE_LIMITER
+        limiter.update_from_headers(getattr(getattr(response, "response", None), "headers", None))
+        iterator = iter(response)
+        buffered = []
+        try:
+            for chunk in iterator:
+                watchdog.mark_chunk()
+                first_chunk.setdefault("seconds", time.monotonic() - attempt_started)
+                buffered.append(chunk)
+                if chunk.choices and chunk.choices[0].delta.content:
+                    break
+            if watchdog.stalled is not None:
+                raise watchdog.stalled
+        except Exception as e:
+            watchdog.stop()
+            response.close()
+            if watchdog.stalled is not None and e is not watchdog.stalled:
+                raise watchdog.stalled from e
+            raise
+        return response, _watched_chunks(buffered, iterator, watchdog, response)
+    estimated = estimate_request_tokens(params.get("messages", []), params.get("max_tokens", 0))
+    return call_with_retry("chat", attempt, on_retry=on_retry, cancel_check=cancel_check,
+                           estimated_tokens=estimated, key_pool=API_KEY_POOL if API_KEY_POOL.size else None,
+                           response_time=lambda: first_chunk.get("seconds"))
+
+def _add_usage(total, usage):
+    """把一段流的 usage 累加到字典中（续传时各段分别计费）"""
+    for field in ("prompt_tokens", "completion_tokens", "prompt_cache_hit_tokens", "prompt_cache_miss_tokens"):
+        value = _usage_value(usage, field)
+        if value is not None:
+            total[field] = total.get(field, 0) + value
+    reasoning = _usage_value(_usage_value(usage, "completion_tokens_details"), "reasoning_tokens")
+    if reasoning:
+        details = total.setdefault("completion_tokens_details", {})
+        details["reasoning_tokens"] = details.get("reasoning_tokens", 0) + reasoning
+
+def beta_base_url(base_url):
+    """返回与客户端接口地址同一服务器的 beta 接口地址
+
+    默认接口使用 DEEPSEEK_API_BASE_URL_BETA；其他地址（模拟服务器、--bench-base-url 等）
+    把末尾的 /v1 换成 /beta，避免续传请求被发往生产环境。
+    """
+    base = str(base_url).rstrip("/")
+    if base == DEEPSEEK_API_BASE_URL_V1.rstrip("/"):
+        return DEEPSEEK_API_BASE_URL_BETA
+    if base.endswith("/v1"):
+        base = base[:-len("/v1")]
+    return base + "/beta"
+
+def stream_chat_resumable(client, on_retry=None, cancel_check=None, on_response=None, on_resume=None,
+                          request_class="interactive", **params):
+    """流式聊天，连接在回复中途中断时自动续传
+
+    逐个产出SDK分块。首个token之后连接断开或停滞时，把已收到的回复作为
+    assistant 前缀（prefix=True），通过 beta 接口的对话前缀续写继续生成，
+    续写内容直接接在原回复之后。
+    on_response(response) 在每次建立流后调用（便于外部中止）；
+    on_resume(resume_count, partial_text, exc) 在每次续传前调用。
+    整条流（含续传）期间占用请求调度器中 request_class 类别的一个名额。
+    默认请求流末尾的 usage 分块，用于统计服务端上下文缓存的命中情况；
+    完整结束后把各段用量之和与排队、首字、总耗时记入用量账本。
+    """
+    messages = params.pop("messages")
+    params.setdefault("stream_options", {"include_usage": True})
+    received = ""
+    resumes = 0
+    usage_total = {}
+    with API_REQUEST_SCHEDULER.slot(request_class, cancel_check) as queue_wait:
+        start = time.perf_counter()
+        first_token_at = None
+        while True:
+            if received:
+                stream_client = client.with_options(base_url=beta_base_url(client.base_url))
+                request_messages = list(messages) + [{"role": "assistant", "content": received, "prefix": True}]
+            else:
+                stream_client = client
+                request_messages = messages
+            response, chunks = open_chat_stream(stream_client, on_retry=on_retry, cancel_check=cancel_check,
+                                                messages=request_messages, **params)
+            if on_response:
+                on_response(response)
+            try:
+                for chunk in chunks:
+                    if chunk.choices and chunk.choices[0].delta.content:
+                        received += chunk.choices[0].delta.content
+                        if first_token_at is None:
+                            first_token_at = time.perf_counter()
+                    if getattr(chunk, "usage", None) is not None:
+                        API_CONTEXT_CACHE_STATS.record(params.get("model"), chunk.usage)
+                        _add_usage(usage_total, chunk.usage)
+                    yield chunk
+                if usage_total:
+                    API_USAGE_LEDGER.record(
+                        params.get("model"), usage_total, queue_ms=queue_wait * 1000,
+                        ttft_ms=(first_token_at - start) * 1000 if first_token_at is not None else None,
+                        total_ms=(time.perf_counter() - start) * 1000, resumes=resumes)
+                return
+            except Exception as e:
+                if cancel_check and cancel_check():
+                    raise
+                info = classify_error(e)
+                if info.category != "stalled":
+                    # 停滞已由监视器计入指标，这里记录其余的中途断开
+                    API_ERROR_METRICS.record(info)
+                    if info.endpoint_failure:
+                        API_CIRCUIT_BREAKER.record_failure()
+                resumable = info.category in ("connection", "timeout") or \
+                    (info.category == "stalled" and getattr(e, "phase", None) == "idle")
+                if not received or not resumable or resumes >= STREAM_RESUME_MAX_ATTEMPTS:
+                    raise
+                resumes += 1
+                if on_resume:
+                    on_resume(resumes, received, e)
+            finally:
+                chunks.close()
+
+def canonical_request_key(params):
+    """模型、消息与全部请求参数的规范化JSON哈希（请求合并与响应缓存共用）"""
+    canonical = json.dumps(params, sort_keys=True, ensure_ascii=False, separators=(",", ":"), default=str)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+class _CoalescedStream:
+    """一次上游流式请求及其全部订阅者共享的分块缓冲"""
+    def __init__(self, key):
+        self.key = key
+        self.chunks = []
+        self.done = False
+        self.error = None
+        self.subscribers = 0
+        self.response = None
+        self.cond = threading.Condition()
+
+class CoalescedSubscription:
+    """共享流的一个订阅者：按自己的进度读取分块，close() 只退订而不影响其他订阅者
+
+    最后一个订阅者退出时中止上游请求。属性布局与流式响应兼容，可直接交给 abort_response。
+    """
+    def __init__(self, shared):
+        self._shared = shared
+        self._index = 0
+        self.closed = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        shared = self._shared
+        with shared.cond:
+            while self._index >= len(shared.chunks) and not shared.done and not self.closed:
+                shared.cond.wait()
+            if self.closed:
+                raise StopIteration
+            if self._index < len(shared.chunks):
+                chunk = shared.chunks[self._index]
+                self._index += 1
+                return chunk
+        self.close()
+        if shared.error is not None:
+            raise shared.error
+        raise StopIteration
+
+    def close(self):
+        shared = self._shared
+        with shared.cond:
+            if self.closed:
+                return
+            self.closed = True
+            shared.subscribers -= 1
+            abandon = shared.subscribers == 0 and not shared.done
+            shared.cond.notify_all()
+        if abandon and shared.response is not None:
+            abort_response(shared.response)
+
+class StreamCoalescer:
+    """合并相同的进行中请求：规范化哈希相同的请求共享一次上游流式调用
+
+    只合并确定性请求（temperature 为0）。后加入的订阅者先回放已收到的分块，再跟随实时分块；
+    上游的重试与续传通知只发给发起请求的订阅者。
+    """
+    def __init__(self):
+        self._inflight = {}
+        self._lock = threading.Lock()
+        self.upstream_count = 0
+        self.coalesced_count = 0
+        self.upstream_cpu_seconds = 0.0
+
+    def stream(self, client, on_retry=None, cancel_check=None, on_response=None, on_resume=None, **params):
+        """与 stream_chat_resumable 参数相同；返回的订阅对象会先传给 on_response 以便外部停止"""
+        if params.get("temperature") != 0:
+            return stream_chat_resumable(client, on_retry=on_retry, cancel_check=cancel_check,
+                                         on_response=on_response, on_resume=on_resume, **params)
+        # 调用方之后可能修改消息列表，先做快照
+        params = dict(params, messages=list(params["messages"]))
+        key = canonical_request_key(params)
+        with self._lock:
+            shared = self._inflight.get(key)
+            leader = shared is None or shared.subscribers == 0
+            if leader:
+                shared = _CoalescedStream(key)
+                self._inflight[key] = shared
+                self.upstream_count += 1
+            else:
+                self.coalesced_count += 1
+            with shared.cond:
+                shared.subscribers += 1
+        subscription = CoalescedSubscription(shared)
+        if on_response:
+            on_response(subscription)
+        if leader:
+            threading.Thread(target=self._pump, args=(shared, client, on_retry, on_resume, params),
+                             daemon=True).start()
+        return subscription
+
+    def _pump(self, shared, client, on_retry, on_resume, params):
+        """在后台读取上游流并分发给所有订阅者"""
+        def on_response(response):
+            shared.response = response
+            if shared.subscribers == 0:
+                abort_response(response)
+
+        cpu_start = time.thread_time()
+        try:
+            for chunk in stream_chat_resumable(client, on_retry=on_retry, cancel_check=lambda: shared.subscribers == 0,
+                                               on_response=on_response, on_resume=on_resume, **params):
+                with shared.cond:
+                    shared.chunks.append(chunk)
+                    shared.cond.notify_all()
+                if shared.subscribers == 0:
+                    break
+        except Exception as e:
+            shared.error = e
+        finally:
+            with self._lock:
+                self.upstream_cpu_seconds += time.thread_time() - cpu_start
+                if self._inflight.get(shared.key) is shared:
+                    del self._inflight[shared.key]
+            with shared.cond:
+                shared.done = True
+                shared.cond.notify_all()
+
+# 全局共享的请求合并器：GUI、CLI与基准测试的聊天请求都经过它
+API_STREAM_COALESCER = StreamCoalescer()
+
+# ===================== 响应缓存 =====================
+class ResponseCache:
+    """确定性请求（temperature 为0）的磁盘响应缓存，按请求的规范化哈希精确匹配
+
+    每条完整回复保存为一个JSON文件；命中时以合成的流式分块全速回放。
+    总大小超过上限时按最近使用时间淘汰（文件修改时间记录最近一次命中），超过TTL的条目视为未命中。
+    """
+    REPLAY_CHUNK_CHARS = 256
+
+    def __init__(self, directory=RESPONSE_CACHE_DIR, max_bytes=RESPONSE_CACHE_MAX_BYTES, ttl=RESPONSE_CACHE_TTL):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.bypasses = 0
+        self.evictions = 0
+        self._index = None
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def is_cacheable(params):
+        return params.get("temperature") == 0
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + ".json")
+
+    def _load_index(self):
+        """首次使用时扫描缓存目录，按最近使用时间建立 LRU 索引（调用方持有锁）"""
+        if self._index is not None:
+            return
+        entries = []
+        if os.path.isdir(self.directory):
+            for name in os.listdir(self.directory):
+                if name.endswith(".json"):
+                    try:
+                        stat = os.stat(os.path.join(self.directory, name))
+                    except OSError:
+                        continue
+                    entries.append((stat.st_mtime, name[:-5], stat.st_size))
+        self._index = collections.OrderedDict((key, size) for _, key, size in sorted(entries))
+
+    def _remove(self, key):
+        self._index.pop(key, None)
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+
+    def get(self, key):
+        """读取缓存条目，未命中或已过期时返回None"""
+        with self._lock:
+            self._load_index()
+            if key not in self._index:
+                self.misses += 1
+                return None
+            try:
+                with open(self._path(key), "r", encoding="utf-8") as f:
+                    entry = json.load(f)
+            except (OSError, ValueError):
+                entry = None
+            if entry is None or time.time() - entry.get("created", 0) > self.ttl:
+                self._remove(key)
+                self.misses += 1
+                return None
+            self._index.move_to_end(key)
+            try:
+                os.utime(self._path(key))
+            except OSError:
+                pass
+            self.hits += 1
+            return entry
+
+    def put(self, key, entry):
+        """写入缓存条目（先写临时文件再替换），并按总大小淘汰最久未使用的条目"""
+        data = json.dumps(entry, ensure_ascii=False).encode("utf-8")
+        with self._lock:
+            self._load_index()
+            try:
+                os.makedirs(self.directory, exist_ok=True)
+                temp_path = self._path(key) + ".tmp"
+                with open(temp_path, "wb") as f:
+                    f.write(data)
+                os.replace(temp_path, self._path(key))
+            except OSError as e:
+                print(f"写入响应缓存失败: {e}", file=sys.stderr)
+                return
+            self._index[key] = len(data)
+            self._index.move_to_end(key)
+            total = sum(self._index.values())
+            while total > self.max_bytes and len(self._index) > 1:
+                oldest, size = next(iter(self._index.items()))
+                self._remove(oldest)
+                total -= size
+                self.evictions += 1
 
-from openai import OpenAI
+    def clear(self):
+        with self._lock:
+            self._load_index()
+            for key in list(self._index):
+                self._remove(key)
 
-DEEPSEEK_API_BASE_URL_V1 = "https://api.deepseek.com/v1"
-DEEPSEEK_BALANCE_URL = "https://api.deepseek.com/user/balance"
-# API Key 存储文件名 - 修改路径到用户主目录
-API_KEY_DIR = os.path.join(os.path.expanduser("~"), ".DS_API_CLI")
-API_KEY_FILENAME = os.path.join(API_KEY_DIR, "API_KEY")
+    def stats(self):
+        with self._lock:
+            self._load_index()
+            entries = len(self._index)
+            size = sum(self._index.values())
+        lookups = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "bypasses": self.bypasses, "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups else None, "entries": entries, "bytes": size}
 
-# ===================== API Key 存储加密功能 =====================
-def get_encryption_key():
-    """基于机器特定信息生成稳定的加密密钥"""
-    try:
-        # 使用机器ID作为密钥材料的一部分
-        import uuid
-        machine_id = uuid.getnode()
-        # 使用固定的盐值和机器ID创建密钥材料
-        key_material = f"deepseek-client-{machine_id}-salt-v1".encode()
-        # 生成符合Fernet要求的32字节密钥并进行base64编码
-        key = base64.urlsafe_b64encode(hashlib.sha256(key_material).digest())
-        return key
-    except Exception:
-        # 如果出错，使用一个默认密钥（这不够安全，但比没有加密好）
-        return base64.urlsafe_b64encode(hashlib.sha256(b"default-salt-key").digest())
+    def _replay(self, entry):
+        """把缓存的完整回复回放为合成分块（不计用量）"""
+        if entry.get("reasoning_content"):
+            yield SseChunk(reasoning_content=entry["reasoning_content"])
+        content = entry.get("content") or ""
+        for start in range(0, len(content), self.REPLAY_CHUNK_CHARS):
+            yield SseChunk(content=content[start:start + self.REPLAY_CHUNK_CHARS])
+        yield SseChunk(finish_reason=entry.get("finish_reason") or "stop")
 
-def encrypt_api_key(api_key):
-    """加密API密钥"""
-    if not api_key:
-        return None
-    try:
-        key = get_encryption_key()
-        f = Fernet(key)
-        return f.encrypt(api_key.encode()).decode()
-    except Exception as e:
-        print(f"加密API密钥时出错: {e}")
-        return None
+    def _record(self, key, model, chunks):
+        """透传上游分块，正常结束（finish_reason 为 stop）时写入缓存
 
-def decrypt_api_key(encrypted_api_key):
-    """解密API密钥"""
-    if not encrypted_api_key:
-        return None
-    try:
-        key = get_encryption_key()
-        f = Fernet(key)
-        return f.decrypt(encrypted_api_key.encode()).decode()
-    except Exception as e:
-        print(f"解密API密钥时出错: {e}")
-        return None
+        中途停止、出错或因 max_tokens 截断（length）等不完整的回复不写入，以免被当作完整回复回放。
+        """
+        content = []
+        reasoning = []
+        finish_reason = None
+        try:
+            for chunk in chunks:
+                if chunk.choices:
+                    delta = chunk.choices[0].delta
+                    if delta.content:
+                        content.append(delta.content)
+                    if getattr(delta, "reasoning_content", None):
+                        reasoning.append(delta.reasoning_content)
+                    if chunk.choices[0].finish_reason:
+                        finish_reason = chunk.choices[0].finish_reason
+                yield chunk
+        finally:
+            # 提前关闭时一并关闭上游（合并订阅或续传流），不等垃圾回收
+            close = getattr(chunks, "close", None)
+            if close:
+                close()
+        if finish_reason == "stop":
+            self.put(key, {"created": time.time(), "model": model, "content": "".join(content),
+                           "reasoning_content": "".join(reasoning) or None, "finish_reason": finish_reason})
 
-def save_api_key_to_file(api_key):
-    """将API密钥加密后保存到文件"""
-    try:
-        # 确保目录存在
-        if not os.path.exists(API_KEY_DIR):
-            os.makedirs(API_KEY_DIR)
-            
-        encrypted = encrypt_api_key(api_key)
-        if encrypted:
-            with open(API_KEY_FILENAME, "w") as f:
-                f.write(encrypted)
-            return True
-        return False
-    except Exception as e:
-        print(f"Error saving API key: {e}")
-        return False
+    def stream(self, client, bypass=False, on_cache_hit=None, **kwargs):
+        """带缓存的流式聊天：参数与 StreamCoalescer.stream 相同，bypass=True 时跳过查找但仍写入"""
+        params = {key: value for key, value in kwargs.items()
+                  if key not in ("on_retry", "cancel_check", "on_response", "on_resume")}
+        if not self.is_cacheable(params):
+            return API_STREAM_COALESCER.stream(client, **kwargs)
+        key = canonical_request_key(params)
+        if bypass:
+            self.bypasses += 1
+        else:
+            entry = self.get(key)
+            if entry is not None:
+                if on_cache_hit:
+                    on_cache_hit()
+                return self._replay(entry)
+        return self._record(key, params.get("model"), API_STREAM_COALESCER.stream(client, **kwargs))
 
-def load_api_key_from_file():
-    """从文件加载并解密API密钥"""
-    try:
-        if os.path.exists(API_KEY_FILENAME):
-            with open(API_KEY_FILENAME, "r") as f:
-                encrypted = f.read().strip()
-                return decrypt_api_key(encrypted)
-        return None
-    except Exception as e:
-        print(f"Error loading API key: {e}")
-        return None
+# 全局共享的响应缓存
+API_RESPONSE_CACHE = ResponseCache()
 
-def delete_api_key_file():
-    """删除存储API密钥的文件"""
-    if os.path.exists(API_KEY_FILENAME):
+# ===================== 相似问题缓存 =====================
+class SimilarPromptCache:
+    """基于 MinHash/LSH 的近似重复问题缓存（完全本地，内存占用有上限）
+
+    提示词归一化（小写、去掉空白与标点）后切分为字符3-gram，计算 MinHash 签名，
+    按 LSH 分段放入桶中；查询时只比较同桶候选，签名估计的 Jaccard 相似度达到阈值即命中。
+    只用于单轮提问（对话中只有一条用户消息），且只匹配同一模型的回答。
+    """
+    _MERSENNE_PRIME = (1 << 61) - 1
+
+    def __init__(self, num_perm=SIMILAR_CACHE_NUM_PERM, bands=SIMILAR_CACHE_BANDS,
+                 threshold=SIMILAR_CACHE_THRESHOLD, max_entries=SIMILAR_CACHE_MAX_ENTRIES):
+        self.num_perm = num_perm
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.enabled = False
+        self.hits = 0
+        self.lookups = 0
+        rng = random.Random(20240601)
+        self._perms = [(rng.randrange(1, self._MERSENNE_PRIME), rng.randrange(0, self._MERSENNE_PRIME))
+                       for _ in range(num_perm)]
+        self._entries = collections.OrderedDict()
+        self._buckets = {}
+        self._ids = itertools.count()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def normalize(text):
+        """小写并去掉全部空白与标点：中英文混排时空格有无不影响分片"""
+        return re.sub(r"[\W_]+", "", text.lower())
+
+    @staticmethod
+    def single_turn_prompt(messages):
+        """对话中只有一条用户消息时返回它，否则返回None"""
+        user_messages = [m for m in messages if m.get("role") == "user"]
+        if len(user_messages) != 1 or any(m.get("role") == "assistant" for m in messages):
+            return None
+        return user_messages[0].get("content") or None
+
+    def signature(self, text):
+        normalized = self.normalize(text)
+        if len(normalized) < 3:
+            shingles = {normalized}
+        else:
+            shingles = {normalized[i:i + 3] for i in range(len(normalized) - 2)}
+        hashes = [int.from_bytes(hashlib.blake2b(s.encode("utf-8"), digest_size=8).digest(), "big")
+                  for s in shingles]
+        prime = self._MERSENNE_PRIME
+        return tuple(min((a * h + b) % prime for h in hashes) for a, b in self._perms)
+
+    def _band_keys(self, model, signature):
+        rows = self.rows
+        return [(model, band, signature[band * rows:(band + 1) * rows]) for band in range(self.bands)]
+
+    def _best_match(self, model, signature):
+        """同桶候选中相似度达到阈值的最佳条目 (条目ID, 相似度)，没有时返回None（调用方持有锁）"""
+        candidates = set()
+        for key in self._band_keys(model, signature):
+            candidates.update(self._buckets.get(key, ()))
+        best = None
+        for entry_id in candidates:
+            entry = self._entries[entry_id]
+            similarity = sum(1 for x, y in zip(signature, entry["signature"]) if x == y) / self.num_perm
+            if similarity >= self.threshold and (best is None or similarity > best[1]):
+                best = (entry_id, similarity)
+        return best
+
+    def lookup(self, model, prompt):
+        """返回 (回答, 相似度)；没有达到阈值的候选时返回None"""
+        signature = self.signature(prompt)
+        with self._lock:
+            self.lookups += 1
+            best = self._best_match(model, signature)
+            if best is None:
+                return None
+            self._entries.move_to_end(best[0])
+            self.hits += 1
+            return self._entries[best[0]]["answer"], best[1]
+
+    def add(self, model, prompt, answer):
+        """记录一次完整回答，超过条目上限时淘汰最久未使用的条目
+
+        已有相似条目（如“仍然提问”后重新得到的回答）时更新该条目的回答，不再插入近似重复的条目。
+        """
+        signature = self.signature(prompt)
+        with self._lock:
+            best = self._best_match(model, signature)
+            if best is not None:
+                self._entries[best[0]]["answer"] = answer
+                self._entries.move_to_end(best[0])
+                return
+            entry_id = next(self._ids)
+            self._entries[entry_id] = {"model": model, "signature": signature, "answer": answer}
+            for key in self._band_keys(model, signature):
+                self._buckets.setdefault(key, set()).add(entry_id)
+            while len(self._entries) > self.max_entries:
+                old_id, old = self._entries.popitem(last=False)
+                for key in self._band_keys(old["model"], old["signature"]):
+                    bucket = self._buckets.get(key)
+                    if bucket is not None:
+                        bucket.discard(old_id)
+                        if not bucket:
+                            del self._buckets[key]
+
+    def stats(self):
+        return {"entries": len(self._entries), "lookups": self.lookups, "hits": self.hits}
+
+# 全局共享的相似问题缓存（默认关闭）
+API_SIMILAR_CACHE = SimilarPromptCache()
+
+# ===================== 上下文预算 =====================
+def model_context_tokens(model):
+    """模型的上下文长度，未知模型取保守默认值"""
+    return MODEL_CONTEXT_TOKENS.get(model, DEFAULT_CONTEXT_TOKENS)
+
+class ConversationSummarizer:
+    """在后台把较早的对话轮次总结为摘要（压缩模式）
+
+    摘要按被总结部分的完整前缀做键缓存，同一前缀只会总结一次；同一前缀的并发请求合并为一次调用。
+    增量总结：新摘要由上一份摘要加上之后新增的轮次生成。请求走调度器的后台类别，不占用聊天名额。
+    """
+    INSTRUCTION = ("你负责压缩对话历史。请用简洁的中文总结对话要点，保留用户的目标与偏好、已确认的事实与结论、"
+                   "重要的代码、数据和未解决的问题，省略寒暄与重复内容，不要编造。只输出摘要正文。")
+
+    def __init__(self, model=SUMMARY_MODEL, max_tokens=SUMMARY_MAX_TOKENS, cache_size=SUMMARY_CACHE_SIZE):
+        self.model = model
+        self.max_tokens = max_tokens
+        self.cache_size = cache_size
+        self.requests = 0
+        self.failures = 0
+        self.hits = 0
+        self._cache = collections.OrderedDict()   # 前缀哈希 -> 摘要
+        self._pending = {}                        # 前缀哈希 -> 等待结果的回调
+        self._lock = threading.Lock()
+
+    def summarize(self, client, messages, previous_count=0, previous_summary=None, on_done=None):
+        """总结 messages（对话前缀）；前 previous_count 条已由 previous_summary 概括
+
+        有缓存时立即回调，否则在后台线程中请求，完成后以 on_done(summary 或 None) 回调。
+        """
+        key = canonical_request_key({"model": self.model, "messages": messages})
+        with self._lock:
+            summary = self._cache.get(key)
+            if summary is not None:
+                self._cache.move_to_end(key)
+                self.hits += 1
+            elif key in self._pending:
+                self._pending[key].append(on_done)
+                return
+            else:
+                self._pending[key] = [on_done]
+        if summary is not None:
+            if on_done:
+                on_done(summary)
+            return
+        threading.Thread(target=self._run, args=(client, key, messages[previous_count:], previous_summary),
+                         daemon=True).start()
+
+    def _run(self, client, key, messages, previous_summary):
+        transcript = "\n\n".join(f"{'用户' if m.get('role') == 'user' else '助手'}: {m.get('content') or ''}"
+                                  for m in messages)
+        content = f"已有摘要：\n{previous_summary}\n\n之后的对话：\n{transcript}" if previous_summary \
+            else f"对话：\n{transcript}"
+        prompt = [{"role": "system", "content": self.INSTRUCTION}, {"role": "user", "content": content}]
+        summary = None
+        started = time.perf_counter()
         try:
-            os.remove(API_KEY_FILENAME)
-            return True
+            self.requests += 1
+            response = call_with_retry(
+                "summary",
+                lambda: client.chat.completions.create(model=self.model, messages=prompt,
+                                                       max_tokens=self.max_tokens, temperature=0),
+                estimated_tokens=estimate_request_tokens(prompt, self.max_tokens))
+            summary = (response.choices[0].message.content or "").strip() or None
+            if getattr(response, "usage", None) is not None:
+                API_CONTEXT_CACHE_STATS.record(self.model, response.usage)
+                API_USAGE_LEDGER.record(self.model, response.usage,
+                                        total_ms=(time.perf_counter() - started) * 1000)
         except Exception as e:
-            print(f"Error deleting API key file: {e}")
+            self.failures += 1
+            print(f"总结早期对话失败: {classify_error(e).describe()}", file=sys.stderr)
+        with self._lock:
+            callbacks = self._pending.pop(key, [])
+            if summary:
+                self._cache[key] = summary
+                while len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+        for callback in callbacks:
+            if callback:
+                callback(summary)
+
+    def stats(self):
+        return {"requests": self.requests, "failures": self.failures, "hits": self.hits,
+                "entries": len(self._cache), "pending": len(self._pending)}
+
+# 全局共享的对话摘要器
+API_CONVERSATION_SUMMARIZER = ConversationSummarizer()
+
+class ContextBudgeter:
+    """按模型上下文长度决定每轮发送哪些历史消息（滑动窗口）
+
+    system 消息始终保留；超出预算（提示词加上为回复预留的 max_tokens）时先把较早的长消息截断到
+    truncate_tokens，仍超出时从最早的整轮（以 user 消息开头）开始丢弃，一次裁剪到预算的 trim_ratio。
+    窗口起点只向前移动，此后几轮发送的历史前缀保持不变，仍能命中服务端上下文缓存。
+    压缩模式下，历史超过预算的 compact_threshold 时在后台总结较早的轮次，摘要就绪后
+    以一条 system 消息代替这些轮次发送；本地对话历史保持完整，等待摘要期间照常发送。
+    每个对话各用一个实例；last_report 记录最近一轮的裁剪情况。
+    """
+    TRUNCATED_MARK = "\n…（以下内容已省略）"
+
+    def __init__(self, policy=None):
+        self.policy = dict(CONTEXT_BUDGET_POLICY, **(policy or {}))
+        self.reset()
+
+    def reset(self):
+        self.start = 0                # 窗口起点，只向前移动
+        self.truncate = False         # 是否截断窗口内较早的长消息
+        self.compacted = None         # (被摘要代替的消息数, 摘要)
+        self._compacting = False
+        self.last_report = None
+        self._first = None            # 当前对话的第一条消息，用于发现新会话
+
+    def _maybe_compact(self, client, history, counts, budget, last_droppable):
+        """尚未总结的历史超过阈值时在后台总结较早的轮次，不阻塞本轮请求"""
+        previous_count, previous_summary = self.compacted or (0, None)
+        if self._compacting or sum(counts[previous_count:]) <= budget * self.policy["compact_threshold"]:
+            return
+        # 从末尾向前累计，找到保留部分不超过 compact_keep_ratio 的最早一条 user 消息
+        keep = budget * self.policy["compact_keep_ratio"]
+        cut = 0
+        tail = 0
+        for i in range(len(history) - 1, -1, -1):
+            tail += counts[i]
+            if tail > keep:
+                break
+            if i <= last_droppable and history[i].get("role") == "user":
+                cut = i
+        if cut <= previous_count:
+            return
+        self._compacting = True
+        first = self._first
+
+        def on_done(summary):
+            self._compacting = False
+            if summary and self._first is first:
+                self.compacted = (cut, summary)
+
+        API_CONVERSATION_SUMMARIZER.summarize(client, history[:cut], previous_count, previous_summary, on_done)
+
+    def budget(self, model, max_tokens):
+        """本轮提示词可用的token数：上下文长度扣除为回复预留的 max_tokens，且不超过 max_prompt_tokens"""
+        budget = model_context_tokens(model) - max_tokens
+        if self.policy["max_prompt_tokens"]:
+            budget = min(budget, self.policy["max_prompt_tokens"])
+        return max(0, budget)
+
+    def _truncate(self, message, count):
+        limit = self.policy["truncate_tokens"]
+        content = str(message.get("content") or "")
+        keep_chars = max(1, len(content) * limit // max(count, 1))
+        return dict(message, content=content[:keep_chars] + self.TRUNCATED_MARK)
+
+    def fit(self, messages, model, max_tokens=CHAT_MAX_TOKENS, client=None):
+        """返回本轮要发送的消息列表，并把裁剪情况记录到 last_report；压缩模式需要传入 client"""
+        system = [m for m in messages if m.get("role") == "system"]
+        history = [m for m in messages if m.get("role") != "system"]
+        if not history or history[0] is not self._first or self.start > len(history):
+            # 历史被清空或替换（新会话）
+            self.reset()
+            self._first = history[0] if history else None
+        counts = [API_TOKEN_COUNTER.count_message(m) for m in history]
+        budget = self.budget(model, max_tokens)
+        total = API_TOKEN_COUNTER.count_messages(system) + sum(counts)
+        keep_recent = max(1, self.policy["keep_recent_messages"])
+        last_droppable = max(0, len(history) - keep_recent)
+        limit = self.policy["truncate_tokens"]
+
+        summarized = 0
+        if self.policy["compaction"]:
+            if client is not None:
+                self._maybe_compact(client, history, counts, budget, last_droppable)
+            if self.compacted is not None:
+                summarized, summary = self.compacted
+                system = system + [{"role": "system", "content": f"以下是之前对话的摘要：\n{summary}"}]
+                self.start = max(self.start, summarized)
+        system_tokens = API_TOKEN_COUNTER.count_messages(system)
+
+        def sent_tokens(start, truncate):
+            sent = system_tokens
+            for i in range(start, len(history)):
+                long_message = truncate and i < last_droppable and counts[i] > limit + TokenCounter.MESSAGE_OVERHEAD
+                sent += limit + TokenCounter.MESSAGE_OVERHEAD if long_message else counts[i]
+            return sent
+
+        sent = sent_tokens(self.start, self.truncate)
+        if sent > budget:
+            # 先截断较早的长消息，仍超出时再整轮丢弃；两者一旦生效就保持，避免前缀来回变化
+            if limit and not self.truncate:
+                self.truncate = True
+                sent = sent_tokens(self.start, True)
+            if sent > budget:
+                target = budget * self.policy["trim_ratio"]
+                start = self.start
+                while sent > target and start < last_droppable:
+                    # 整轮丢弃：前进到下一条 user 消息
+                    start += 1
+                    while start < last_droppable and history[start].get("role") != "user":
+                        start += 1
+                    sent = sent_tokens(start, self.truncate)
+                self.start = start
+
+        window = []
+        truncated = 0
+        for i in range(self.start, len(history)):
+            message = history[i]
+            if self.truncate and i < last_droppable and counts[i] > limit + TokenCounter.MESSAGE_OVERHEAD:
+                message = self._truncate(message, counts[i])
+                truncated += 1
+            window.append(message)
+        sent = system_tokens + API_TOKEN_COUNTER.count_messages(window)
+
+        self.last_report = {
+            "budget": budget,
+            "prompt_tokens": sent,
+            "total_tokens": total,
+            "trimmed_tokens": total - sent,
+            "summarized_messages": summarized,
+            "dropped_messages": self.start - summarized,
+            "truncated_messages": truncated,
+            "over_budget": sent > budget
+        }
+        return system + window
+
+def describe_context_trim(report):
+    """裁剪情况的一行说明，没有裁剪时返回空字符串"""
+    if not report or not (report["summarized_messages"] or report["dropped_messages"] or
+                          report["truncated_messages"] or report["over_budget"]):
+        return ""
+    parts = []
+    if report["summarized_messages"]:
+        parts.append(f"最早的 {report['summarized_messages']} 条消息以摘要代替")
+    if report["dropped_messages"]:
+        parts.append(f"另省略 {report['dropped_messages']} 条消息" if report["summarized_messages"]
+                     else f"省略最早的 {report['dropped_messages']} 条消息")
+    if report["truncated_messages"]:
+        parts.append(f"截断 {report['truncated_messages']} 条较早的长消息")
+    text = f"（上下文预算 {report['budget']} tokens：{'，'.join(parts) or '无法再裁剪'}，"
+    text += f"本轮发送约 {report['prompt_tokens']} / 共 {report['total_tokens']} tokens"
+    if report["over_budget"]:
+        text += "，仍超出预算"
+    return text + "）"
+
+# ===================== 对话存储 =====================
+# 中日韩字符逐字切分后再交给 FTS5 的 unicode61 分词器，使任意长度的中文词都能按短语检索
+_FTS_CJK_PATTERN = re.compile(r"([\u2e80-\u9fff\uac00-\ud7af])")
+
+def _fts_text(text):
+    return _FTS_CJK_PATTERN.sub(r" \1 ", text)
+
+class ConversationStore:
+    """SQLite 对话存储：会话、消息、用量与时间戳
+
+    数据库使用 WAL 模式。所有写入放入队列，由独立的写线程批量提交，界面线程从不等待磁盘；
+    读取使用另一条连接，WAL 下读写互不阻塞。会话列表与消息列表只返回摘要信息（预览与长度），
+    消息正文在需要时再按会话或按条加载。
+    全文检索使用 FTS5 无内容表（只存索引，rowid 即消息ID），写线程插入消息时同步写入索引；
+    SQLite 不支持 FTS5 时退回 LIKE 查询。
+    """
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS sessions (
+            id TEXT PRIMARY KEY,
+            title TEXT NOT NULL DEFAULT '',
+            model TEXT,
+            created REAL NOT NULL,
+            updated REAL NOT NULL,
+            message_count INTEGER NOT NULL DEFAULT 0
+        );
+        CREATE TABLE IF NOT EXISTS messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            session_id TEXT NOT NULL REFERENCES sessions(id),
+            seq INTEGER NOT NULL,
+            role TEXT NOT NULL,
+            content TEXT NOT NULL,
+            created REAL NOT NULL,
+            prompt_tokens INTEGER,
+            completion_tokens INTEGER,
+            cache_hit_tokens INTEGER,
+            cost REAL
+        );
+        CREATE INDEX IF NOT EXISTS idx_messages_session ON messages(session_id, seq);
+        CREATE INDEX IF NOT EXISTS idx_sessions_updated ON sessions(updated);
+    """
+    FTS_SCHEMA = "CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(content, content='')"
+    PREVIEW_CHARS = 80
+    BATCH_SIZE = 200
+    SNIPPET_CHARS = 40
+    SEARCH_CANDIDATES = 2000      # 只在最近的若干条命中中按相关度排序，常见词的查询耗时因此有上限
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.enabled = True
+        self._queue = queue.Queue()
+        self._writer = None
+        self._reader = None
+        self._reader_lock = threading.Lock()
+        self._seq = {}                # 会话ID -> 下一条消息的序号
+        self._lock = threading.Lock()
+        self.write_errors = 0
+        self.fts_available = None     # 写线程启动后确定
+
+    def _connect(self):
+        conn = sqlite3.connect(self.filename, timeout=10, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def _ensure_writer(self):
+        with self._lock:
+            if self._writer is None:
+                self._writer = threading.Thread(target=self._write_loop, name="conversation-writer", daemon=True)
+                self._writer.start()
+
+    def _write_loop(self):
+        try:
+            conn = self._connect()
+            conn.executescript(self.SCHEMA)
+            self._init_fts(conn)
+        except sqlite3.Error as e:
+            print(f"打开对话数据库失败，对话将不会保存: {e}", file=sys.stderr)
+            self.enabled = False
+            conn = None
+        while True:
+            batch = [self._queue.get()]
+            # 把已经排队的写入合并为一个事务
+            while len(batch) < self.BATCH_SIZE:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            stop = False
+            try:
+                if conn is not None:
+                    with conn:
+                        for op in batch:
+                            if op is None:
+                                stop = True
+                            elif callable(op):
+                                op(conn)
+                            elif not isinstance(op, threading.Event):
+                                conn.execute(*op)
+            except sqlite3.Error as e:
+                self.write_errors += 1
+                print(f"写入对话数据库失败: {e}", file=sys.stderr)
+            finally:
+                for op in batch:
+                    if isinstance(op, threading.Event):
+                        op.set()
+                    self._queue.task_done()
+            if stop or any(op is None for op in batch):
+                if conn is not None:
+                    conn.close()
+                return
+
+    def _init_fts(self, conn):
+        """创建全文索引；索引是新建的则为已有消息补建（在写线程中进行，不阻塞界面）"""
+        existed = conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'messages_fts'").fetchone()
+        try:
+            conn.execute(self.FTS_SCHEMA)
+        except sqlite3.OperationalError as e:
+            print(f"SQLite 不支持 FTS5，搜索将使用较慢的逐条匹配: {e}", file=sys.stderr)
+            self.fts_available = False
+            return
+        self.fts_available = True
+        if existed:
+            return
+        with conn:
+            rows = conn.execute("SELECT id, content FROM messages")
+            while True:
+                batch = rows.fetchmany(1000)
+                if not batch:
+                    break
+                conn.executemany("INSERT INTO messages_fts (rowid, content) VALUES (?, ?)",
+                                 [(message_id, _fts_text(content)) for message_id, content in batch])
+
+    def _submit(self, sql, params=()):
+        if not self.enabled:
+            return
+        self._ensure_writer()
+        self._queue.put((sql, params) if isinstance(sql, str) else sql)
+
+    def new_session(self, model=None, title=""):
+        """新建会话并返回会话ID（写入在后台完成）"""
+        session_id = uuid.uuid4().hex
+        now = time.time()
+        with self._lock:
+            self._seq[session_id] = 0
+        self._submit("INSERT INTO sessions (id, title, model, created, updated) VALUES (?, ?, ?, ?, ?)",
+                     (session_id, title, model, now, now))
+        return session_id
+
+    def append_message(self, session_id, role, content, model=None, usage=None):
+        """追加一条消息；首条用户消息同时作为会话标题。usage 为流末尾的用量分块"""
+        now = time.time()
+        with self._lock:
+            seq = self._seq.get(session_id, 0)
+            self._seq[session_id] = seq + 1
+        prompt_tokens = completion_tokens = cache_hit_tokens = cost = None
+        if usage is not None:
+            prompt_tokens = _usage_value(usage, "prompt_tokens") or 0
+            completion_tokens = _usage_value(usage, "completion_tokens") or 0
+            cache_hit_tokens = _usage_value(usage, "prompt_cache_hit_tokens")
+            cost = compute_usage_cost(model, prompt_tokens, completion_tokens, cache_hit_tokens,
+                                      _usage_value(usage, "prompt_cache_miss_tokens"))
+        row = (session_id, seq, role, content, now, prompt_tokens, completion_tokens, cache_hit_tokens, cost)
+
+        def insert(conn):
+            cursor = conn.execute("INSERT INTO messages (session_id, seq, role, content, created, prompt_tokens, "
+                                  "completion_tokens, cache_hit_tokens, cost) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", row)
+            if self.fts_available:
+                # 索引随消息在同一事务中增量更新
+                conn.execute("INSERT INTO messages_fts (rowid, content) VALUES (?, ?)",
+                             (cursor.lastrowid, _fts_text(content)))
+
+        self._submit(insert)
+        self._submit("UPDATE sessions SET updated = ?, message_count = message_count + 1, "
+                     "title = CASE WHEN title = '' AND ? = 'user' THEN ? ELSE title END, "
+                     "model = COALESCE(?, model) WHERE id = ?",
+                     (now, role, " ".join(content.split())[:40], model, session_id))
+
+    def remove_last_message(self, session_id):
+        """删除会话中最后一条消息（例如放弃相似问题的缓存回答）"""
+        with self._lock:
+            seq = self._seq.get(session_id, 0) - 1
+            if seq < 0:
+                return
+            self._seq[session_id] = seq
+
+        def delete(conn):
+            row = conn.execute("SELECT id, content FROM messages WHERE session_id = ? AND seq = ?",
+                               (session_id, seq)).fetchone()
+            if row is None:
+                return
+            if self.fts_available:
+                # 无内容表须以原文本执行 delete 命令，与消息删除在同一事务中
+                conn.execute("INSERT INTO messages_fts (messages_fts, rowid, content) VALUES ('delete', ?, ?)",
+                             (row[0], _fts_text(row[1])))
+            conn.execute("DELETE FROM messages WHERE id = ?", (row[0],))
+
+        self._submit(delete)
+        self._submit("UPDATE sessions SET message_count = message_count - 1 WHERE id = ?", (session_id,))
+
+    def flush(self, timeout=5.0):
+        """等待此前提交的写入完成（退出前或需要立即读取时调用）"""
+        if self._writer is None or not self._writer.is_alive():
+            return True
+        done = threading.Event()
+        self._queue.put(done)
+        return done.wait(timeout)
+
+    def close(self):
+        if self._writer is not None and self._writer.is_alive():
+            self._queue.put(None)
+            self._writer.join(timeout=5.0)
+        with self._reader_lock:
+            if self._reader is not None:
+                self._reader.close()
+                self._reader = None
+
+    def _read(self, sql, params=()):
+        if not os.path.exists(self.filename):
+            return []
+        with self._reader_lock:
+            try:
+                if self._reader is None:
+                    self._reader = self._connect()
+                return self._reader.execute(sql, params).fetchall()
+            except sqlite3.Error as e:
+                print(f"读取对话数据库失败: {e}", file=sys.stderr)
+                return []
+
+    def list_sessions(self, limit=50, offset=0):
+        """按最近更新时间分页列出会话，不含消息正文"""
+        rows = self._read("SELECT id, title, model, created, updated, message_count FROM sessions "
+                          "WHERE message_count > 0 ORDER BY updated DESC LIMIT ? OFFSET ?", (limit, offset))
+        return [{"id": r[0], "title": r[1], "model": r[2], "created": r[3], "updated": r[4], "message_count": r[5]}
+                for r in rows]
+
+    def list_messages(self, session_id):
+        """会话中各消息的预览与长度，不加载完整正文"""
+        rows = self._read("SELECT id, seq, role, substr(content, 1, ?), length(content), created FROM messages "
+                          "WHERE session_id = ? ORDER BY seq", (self.PREVIEW_CHARS, session_id))
+        return [{"id": r[0], "seq": r[1], "role": r[2], "preview": r[3], "length": r[4], "created": r[5]}
+                for r in rows]
+
+    def message_content(self, message_id):
+        rows = self._read("SELECT content FROM messages WHERE id = ?", (message_id,))
+        return rows[0][0] if rows else None
+
+    def search(self, query, limit=30):
+        """全文检索全部消息，按相关度排序返回命中的消息（含所在会话与摘录）
+
+        查询按空白拆分为多个词，全部出现才算命中；中文词按相邻字的短语匹配。
+        一次扫描按消息ID倒序取最近的 SEARCH_CANDIDATES 条命中及其 bm25 分数（FTS5 可提前结束），
+        再在其中按相关度排序；几乎每条消息都包含的常见词也不必为全部命中计算相关度。
+        """
+        terms = query.split()
+        if not terms:
+            return []
+        columns = ("m.id, m.session_id, m.seq, m.role, m.created, s.title, "
+                   f"substr(m.content, 1, {self.PREVIEW_CHARS * 50})")
+        fts = self._read("SELECT 1 FROM sqlite_master WHERE name = 'messages_fts'") and self.fts_available is not False
+        if fts:
+            match = " AND ".join('"' + " ".join(_fts_text(term).split()).replace('"', '""') + '"' for term in terms)
+            candidates = self._read("SELECT rowid, rank FROM messages_fts WHERE messages_fts MATCH ? "
+                                    "ORDER BY rowid DESC LIMIT ?", (match, self.SEARCH_CANDIDATES))
+            ranked = [message_id for message_id, _ in sorted(candidates, key=lambda row: row[1])[:limit]]
+            if not ranked:
+                return []
+            rows = self._read(f"SELECT {columns} FROM messages m JOIN sessions s ON s.id = m.session_id "
+                              f"WHERE m.id IN ({','.join('?' * len(ranked))})", ranked)
+            order = {message_id: i for i, message_id in enumerate(ranked)}
+            rows.sort(key=lambda row: order[row[0]])
+        else:
+            condition = " AND ".join("m.content LIKE ? ESCAPE '\\'" for _ in terms)
+            patterns = ["%" + re.sub(r"([%_\\])", r"\\\1", term) + "%" for term in terms]
+            rows = self._read(f"SELECT {columns} FROM messages m JOIN sessions s ON s.id = m.session_id "
+                              f"WHERE {condition} ORDER BY m.created DESC LIMIT ?", (*patterns, limit))
+        return [{"message_id": r[0], "session_id": r[1], "seq": r[2], "role": r[3], "created": r[4],
+                 "title": r[5], "snippet": self._snippet(r[6], terms)} for r in rows]
+
+    def _snippet(self, content, terms):
+        """命中词附近的一段文字（与检索一致，词中各字之间允许有空白）"""
+        positions = []
+        for term in terms:
+            found = re.search(r"\s*".join(map(re.escape, term)), content, re.IGNORECASE)
+            if found:
+                positions.append(found.start())
+        position = min(positions, default=0)
+        start = max(0, position - self.SNIPPET_CHARS // 2)
+        text = " ".join(content[start:start + self.SNIPPET_CHARS * 2].split())
+        return ("…" if start else "") + text + ("…" if start + self.SNIPPET_CHARS * 2 < len(content) else "")
+
+    def load_session(self, session_id):
+        """加载会话的全部消息（继续该会话时使用），返回 (model, messages)"""
+        session = self._read("SELECT model FROM sessions WHERE id = ?", (session_id,))
+        rows = self._read("SELECT seq, role, content FROM messages WHERE session_id = ? ORDER BY seq", (session_id,))
+        with self._lock:
+            self._seq[session_id] = rows[-1][0] + 1 if rows else 0
+        return (session[0][0] if session else None), [{"role": role, "content": content} for _, role, content in rows]
+
+# 全局对话存储
+API_CONVERSATION_STORE = ConversationStore(CONVERSATION_DB_FILENAME)
+
+def print_search_results(query, limit=20):
+    """打印全文检索结果（--cli --search 与 CLI 的 search 命令），返回结果列表"""
+    started = time.perf_counter()
+    results = API_CONVERSATION_STORE.search(query, limit=limit)
+    print(f"“{query}”: {len(results)} 条结果，耗时 {(time.perf_counter() - started) * 1000:.1f}ms")
+    for i, result in enumerate(results, 1):
+        created = time.strftime("%Y-%m-%d %H:%M", time.localtime(result["created"]))
+        role = "您" if result["role"] == "user" else "助手"
+        print(f"  {i:>2}. {created}  {result['title'] or '(无标题)'}")
+        print(f"      {role}: {result['snippet']}")
+    return results
+
+# ===================== 本地模拟服务器 =====================
+class MockServerConfig:
+    """模拟服务器的行为参数
+
+    fail_statuses 为按 fail_rate 概率注入的错误状态码（401/402/429/503 等），
+    drop_rate 为流式回复在 drop_after 个token后被强行断开的概率（drop_after 为0时取回复长度的一半）。
+    同一 seed 下请求序列、回复内容与注入的错误均可复现。
+    """
+    def __init__(self, latency=0.2, token_rate=50.0, chunk_tokens=1, reply_tokens=120,
+                 fail_statuses=(), fail_rate=0.0, drop_rate=0.0, drop_after=0, seed=0):
+        self.latency = latency
+        self.token_rate = token_rate
+        self.chunk_tokens = max(1, chunk_tokens)
+        self.reply_tokens = reply_tokens
+        self.fail_statuses = tuple(fail_statuses)
+        self.fail_rate = fail_rate
+        self.drop_rate = drop_rate
+        self.drop_after = drop_after
+        self.seed = seed
+
+MOCK_MODELS = ["deepseek-chat", "deepseek-reasoner"]
+MOCK_VOCABULARY = ["模拟", "回复", "内容", "测试", "数据", "网络", "延迟", "流式", "输出",
+                   " the", " quick", " token", " stream", " local", " server", "，", "。"]
+MOCK_ERROR_BODIES = {
+    401: ("authentication_error", "Authentication Fails, Your api key is invalid"),
+    402: ("unknown_error", "Insufficient Balance"),
+    429: ("rate_limit_error", "Rate Limit Reached"),
+    503: ("server_error", "Server Overloaded"),
+}
+
+class MockDeepSeekHandler(http.server.BaseHTTPRequestHandler):
+    """兼容 DeepSeek 接口的本地模拟实现（/v1/models、/v1/chat/completions、/beta、/user/balance）"""
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    @property
+    def config(self):
+        return self.server.mock_config
+
+    def _send_json(self, status, payload, headers=None):
+        body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _check_request(self):
+        """校验密钥并按配置注入错误，请求已被处理时返回 False"""
+        if not self.headers.get("Authorization", "").startswith("Bearer ") or \
+                not self.headers["Authorization"][7:].strip():
+            self._send_error_status(401)
             return False
-    return True
+        status = self.server.next_injected_status()
+        if status:
+            self._send_error_status(status)
+            return False
+        time.sleep(self.config.latency)
+        return True
+
+    def _send_error_status(self, status):
+        error_type, message = MOCK_ERROR_BODIES.get(status, ("server_error", "Injected Error"))
+        headers = {"Retry-After": "1"} if status in (429, 503) else None
+        self._send_json(status, {"error": {"message": message, "type": error_type, "code": str(status)}}, headers)
+
+    def do_GET(self):
+        path = urllib.parse.urlsplit(self.path).path.rstrip("/")
+        if path in ("/v1/models", "/models"):
+            if self._check_request():
+                self._send_json(200, {"object": "list", "data": [
+                    {"id": model, "object": "model", "owned_by": "deepseek"} for model in MOCK_MODELS]})
+        elif path == "/user/balance":
+            if self._check_request():
+                self._send_json(200, {"is_available": True, "balance_infos": [{
+                    "currency": "CNY", "total_balance": "110.00",
+                    "granted_balance": "10.00", "topped_up_balance": "100.00"}]})
+        else:
+            self._send_json(404, {"error": {"message": "Not Found", "type": "invalid_request_error"}})
+
+    def do_POST(self):
+        path = urllib.parse.urlsplit(self.path).path.rstrip("/")
+        length = int(self.headers.get("Content-Length") or 0)
+        try:
+            request = json.loads(self.rfile.read(length) or b"{}")
+        except ValueError:
+            self._send_json(400, {"error": {"message": "Invalid JSON", "type": "invalid_request_error"}})
+            return
+        if path not in ("/v1/chat/completions", "/chat/completions", "/beta/chat/completions"):
+            self._send_json(404, {"error": {"message": "Not Found", "type": "invalid_request_error"}})
+            return
+        if not self._check_request():
+            return
+        messages = request.get("messages") or []
+        prefix = ""
+        if messages and messages[-1].get("role") == "assistant" and messages[-1].get("prefix"):
+            if not path.startswith("/beta"):
+                self._send_json(400, {"error": {"message": "prefix is only supported on /beta",
+                                                "type": "invalid_request_error"}})
+                return
+            prefix = messages[-1].get("content") or ""
+            messages = messages[:-1]
+        model = request.get("model") or MOCK_MODELS[0]
+        reasoning, tokens = self.server.reply_for(model, messages)
+        # 前缀续写：跳过与确定性回复重合的部分，只生成剩余内容
+        consumed = 0
+        for i, token in enumerate(tokens):
+            if consumed + len(token) > len(prefix):
+                tokens = tokens[i:]
+                break
+            consumed += len(token)
+        else:
+            tokens = []
+        if prefix:
+            reasoning = []
+        usage = self.server.usage_for(messages, prefix, len(reasoning) + len(tokens), len(reasoning))
+        if request.get("stream"):
+            include_usage = bool((request.get("stream_options") or {}).get("include_usage"))
+            self._stream_reply(model, reasoning, tokens, usage if include_usage else None)
+        else:
+            self._send_json(200, {
+                "id": f"mock-{self.server.next_id()}", "object": "chat.completion",
+                "created": int(time.time()), "model": model,
+                "choices": [{"index": 0, "finish_reason": "stop", "message": {
+                    "role": "assistant", "content": "".join(tokens),
+                    "reasoning_content": "".join(reasoning) or None}}],
+                "usage": usage})
+
+    def _write_chunk(self, data):
+        self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+        self.wfile.flush()
+
+    def _stream_reply(self, model, reasoning, tokens, usage):
+        completion_id = f"mock-{self.server.next_id()}"
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        def event(delta=None, finish_reason=None, usage=None):
+            payload = {"id": completion_id, "object": "chat.completion.chunk", "created": int(time.time()),
+                       "model": model,
+                       "choices": [] if delta is None else [{"index": 0, "delta": delta,
+                                                             "finish_reason": finish_reason}]}
+            if usage is not None:
+                payload["usage"] = usage
+            return b"data: " + json.dumps(payload, ensure_ascii=False).encode("utf-8") + b"\n\n"
+
+        config = self.config
+        drop_at = None
+        if self.server.should_drop():
+            drop_at = config.drop_after or max(1, len(tokens) // 2)
+        interval = config.chunk_tokens / config.token_rate if config.token_rate > 0 else 0
+        self._write_chunk(event({"role": "assistant", "content": ""}))
+        sent = 0
+        for field, items in (("reasoning_content", reasoning), ("content", tokens)):
+            for start in range(0, len(items), config.chunk_tokens):
+                if interval:
+                    time.sleep(interval)
+                if field == "content" and drop_at is not None and sent >= drop_at:
+                    # 模拟连接中途断开：不写分块结束标记直接关闭
+                    self.close_connection = True
+                    self.connection.shutdown(socket.SHUT_RDWR)
+                    return
+                self._write_chunk(event({field: "".join(items[start:start + config.chunk_tokens])}))
+                if field == "content":
+                    sent += config.chunk_tokens
+        self._write_chunk(event({}, finish_reason="stop"))
+        if usage is not None:
+            self._write_chunk(event(usage=usage))
+        self._write_chunk(b"data: [DONE]\n\n")
+        self.wfile.write(b"0\r\n\r\n")
+        self.wfile.flush()
+
+class MockDeepSeekServer(http.server.ThreadingHTTPServer):
+    """持有模拟配置与可复现随机状态的本地服务器"""
+    daemon_threads = True
+
+    def __init__(self, address, config):
+        super().__init__(address, MockDeepSeekHandler)
+        self.mock_config = config
+        self._rng = random.Random(config.seed)
+        self._lock = threading.Lock()
+        self._request_count = 0
+        self._seen_prefixes = set()
+
+    def handle_error(self, request, client_address):
+        # 客户端中途断开（停止、超时中止、请求合并退订）属于正常情况，不打印堆栈
+        if isinstance(sys.exc_info()[1], (ConnectionError, socket.timeout)):
+            return
+        super().handle_error(request, client_address)
+
+    @property
+    def base_url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def next_id(self):
+        with self._lock:
+            self._request_count += 1
+            return self._request_count
+
+    def next_injected_status(self):
+        with self._lock:
+            if self.mock_config.fail_statuses and self._rng.random() < self.mock_config.fail_rate:
+                return self._rng.choice(self.mock_config.fail_statuses)
+        return None
+
+    def should_drop(self):
+        with self._lock:
+            return self.mock_config.drop_rate > 0 and self._rng.random() < self.mock_config.drop_rate
+
+    def reply_for(self, model, messages):
+        """按对话内容生成确定性的回复（推理模型额外带思考内容）"""
+        digest = hashlib.sha256(json.dumps(messages, sort_keys=True, ensure_ascii=False).encode("utf-8")).digest()
+        rng = random.Random(int.from_bytes(digest[:8], "big") ^ self.mock_config.seed)
+        count = self.mock_config.reply_tokens
+        tokens = [rng.choice(MOCK_VOCABULARY) for _ in range(count)]
+        reasoning = [rng.choice(MOCK_VOCABULARY) for _ in range(count // 4)] if "reasoner" in model else []
+        return reasoning, tokens
+
+    def usage_for(self, messages, prefix, completion_tokens, reasoning_tokens=0):
+        """估算用量；与之前请求相同的消息前缀计为上下文缓存命中"""
+        prompt_tokens = 0
+        hit_tokens = 0
+        with self._lock:
+            for i, message in enumerate(messages):
+                prompt_tokens += estimate_tokens(str(message.get("content") or "")) + 4
+                key = hashlib.sha256(json.dumps(messages[:i + 1], sort_keys=True).encode("utf-8")).hexdigest()
+                if key in self._seen_prefixes:
+                    hit_tokens = prompt_tokens
+                self._seen_prefixes.add(key)
+        prompt_tokens += estimate_tokens(prefix)
+        usage = {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                 "total_tokens": prompt_tokens + completion_tokens,
+                 "prompt_cache_hit_tokens": hit_tokens, "prompt_cache_miss_tokens": prompt_tokens - hit_tokens}
+        if reasoning_tokens:
+            usage["completion_tokens_details"] = {"reasoning_tokens": reasoning_tokens}
+        return usage
+
+def start_mock_server(config=None, host="127.0.0.1", port=0):
+    """在后台线程启动模拟服务器并返回服务器对象（port 为0时自动分配）"""
+    server = MockDeepSeekServer((host, port), config or MockServerConfig())
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def _argv_value(name, default, cast=str):
+    """读取 "--name 值" 形式的命令行参数"""
+    if name in sys.argv:
+        index = sys.argv.index(name)
+        if index + 1 < len(sys.argv):
+            try:
+                return cast(sys.argv[index + 1])
+            except ValueError:
+                print(f"参数 {name} 的值无效，使用默认值 {default}", file=sys.stderr)
+    return default
+
+def mock_config_from_argv():
+    """从 --mock-* 命令行参数构造模拟配置"""
+    fail_statuses = _argv_value("--mock-fail", "")
+    return MockServerConfig(
+        latency=_argv_value("--mock-latency", 0.2, float),
+        token_rate=_argv_value("--mock-token-rate", 50.0, float),
+        chunk_tokens=_argv_value("--mock-chunk-tokens", 1, int),
+        reply_tokens=_argv_value("--mock-reply-tokens", 120, int),
+        fail_statuses=[int(code) for code in fail_statuses.split(",") if code.strip().isdigit()],
+        fail_rate=_argv_value("--mock-fail-rate", 0.0, float),
+        drop_rate=_argv_value("--mock-drop-rate", 0.0, float),
+        drop_after=_argv_value("--mock-drop-after", 0, int),
+        seed=_argv_value("--mock-seed", 0, int),
+    )
+
+def run_mock_server():
+    """以前台方式运行模拟服务器，直到 Ctrl+C"""
+    server = MockDeepSeekServer(("127.0.0.1", _argv_value("--mock-port", 8765, int)), mock_config_from_argv())
+    base_url = server.base_url
+    print(f"DeepSeek 模拟服务器已启动: {base_url}")
+    print("将客户端指向模拟服务器:")
+    print(f"  DEEPSEEK_API_BASE_URL_V1={base_url}/v1")
+    print(f"  DEEPSEEK_API_BASE_URL_BETA={base_url}/beta")
+    print(f"  DEEPSEEK_BALANCE_URL={base_url}/user/balance")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("\n模拟服务器已停止")
+    finally:
+        server.server_close()
+
+# ===================== 负载基准测试 =====================
+def run_load_benchmark():
+    """--bench：并发驱动多路流式聊天，输出吞吐、延迟分位数、CPU与错误率（JSON）
+
+    --bench-concurrency 并发数，--bench-duration 持续秒数，--bench-base-url 目标地址，
+    --bench-mock 在进程内启动模拟服务器（此时 --mock-* 参数生效，并默认解除客户端限流），
+    --bench-rpm/--bench-tpm 覆盖客户端限流额度，--bench-output 额外写入JSON文件，
+    --bench-prompts N 让请求在N个固定提示词间循环（默认每个请求都不同），用于观察相同请求的合并。
+    进度信息输出到 stderr，stdout 只包含JSON结果。
+    """
+    global API_RATE_LIMITER
+    concurrency = _argv_value("--bench-concurrency", 4, int)
+    duration = _argv_value("--bench-duration", 30.0, float)
+    model = _argv_value("--bench-model", "deepseek-chat")
+    max_tokens = _argv_value("--bench-max-tokens", 256, int)
+    output_path = _argv_value("--bench-output", None)
+    prompt_variants = _argv_value("--bench-prompts", 0, int)
+
+    mock_server = None
+    if "--bench-mock" in sys.argv:
+        mock_server = start_mock_server(mock_config_from_argv())
+        base_url = mock_server.base_url + "/v1"
+        api_key = "mock-key"
+        default_rpm, default_tpm = 10 ** 6, 10 ** 9
+        # 模拟服务器不产生费用，不写入用量账本
+        API_USAGE_LEDGER.enabled = False
+    else:
+        base_url = _argv_value("--bench-base-url", DEEPSEEK_API_BASE_URL_V1)
+        api_key = load_api_key_from_file() or os.environ.get("DEEPSEEK_API_KEY")
+        default_rpm, default_tpm = RATE_LIMIT_RPM, RATE_LIMIT_TPM
+        if not api_key:
+            print("未找到API密钥，请先在客户端中保存密钥或设置 DEEPSEEK_API_KEY", file=sys.stderr)
+            return
+    API_RATE_LIMITER = RateLimiter(_argv_value("--bench-rpm", default_rpm, int),
+                                   _argv_value("--bench-tpm", default_tpm, int))
+    client = create_openai_client(api_key, base_url=base_url)
+    # 基准测试的并发由 --bench-concurrency 决定，放宽交互类别的调度上限
+    API_REQUEST_SCHEDULER.set_limit("interactive", concurrency)
+    API_REQUEST_SCHEDULER.max_concurrency = concurrency + SCHEDULER_CLASSES["background"]["max_concurrency"]
+
+    ttft_stats = LatencyStats(window=None)
+    itl_stats = LatencyStats(window=None)
+    errors = {}
+    totals = {"requests": 0, "ok": 0, "tokens": 0, "cpu": 0.0}
+    lock = threading.Lock()
+    deadline = time.monotonic() + duration
+
+    def worker(index):
+        sequence = 0
+        while time.monotonic() < deadline:
+            sequence += 1
+            if prompt_variants:
+                prompt = f"基准测试请求 {(index + sequence) % prompt_variants}"
+            else:
+                prompt = f"基准测试请求 {index}-{sequence}"
+            messages = [{"role": "user", "content": prompt}]
+            cpu_start = time.thread_time()
+            start = time.perf_counter()
+            last = start
+            tokens = 0
+            usage_tokens = None
+            try:
+                chunks = API_STREAM_COALESCER.stream(client, model=model, messages=messages, max_tokens=max_tokens,
+                                                     temperature=0, stream_options={"include_usage": True})
+                for chunk in chunks:
+                    if chunk.choices and chunk.choices[0].delta.content:
+                        now = time.perf_counter()
+                        if tokens:
+                            itl_stats.add((now - last) * 1000)
+                        else:
+                            ttft_stats.add((now - start) * 1000)
+                        last = now
+                        tokens += 1
+                    if getattr(chunk, "usage", None) is not None:
+                        usage_tokens = chunk.usage.completion_tokens
+                category = None
+            except Exception as e:
+                category = classify_error(e).category
+            cpu = time.thread_time() - cpu_start
+            with lock:
+                totals["requests"] += 1
+                totals["cpu"] += cpu
+                if category is None:
+                    totals["ok"] += 1
+                    totals["tokens"] += usage_tokens if usage_tokens is not None else tokens
+                else:
+                    errors[category] = errors.get(category, 0) + 1
+
+    print(f"基准测试: {base_url}，模型 {model}，并发 {concurrency}，持续 {duration:.0f} 秒", file=sys.stderr)
+    upstream_cpu_start = API_STREAM_COALESCER.upstream_cpu_seconds
+    upstream_count_start = API_STREAM_COALESCER.upstream_count
+    coalesced_start = API_STREAM_COALESCER.coalesced_count
+    started = time.perf_counter()
+    threads = [threading.Thread(target=worker, args=(i,), daemon=True) for i in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    if mock_server is not None:
+        mock_server.shutdown()
+
+    def rounded(summary):
+        return {key: round(value, 2) if isinstance(value, float) else value for key, value in summary.items()}
+
+    # 上游流在合并器的后台线程中读取与解析，其CPU时间同样计入客户端开销
+    totals["cpu"] += API_STREAM_COALESCER.upstream_cpu_seconds - upstream_cpu_start
+    failed = totals["requests"] - totals["ok"]
+    result = {
+        "config": {"base_url": base_url, "model": model, "concurrency": concurrency, "duration_s": duration,
+                   "max_tokens": max_tokens, "raw_sse": RAW_SSE_STREAMING, "mock": mock_server is not None,
+                   "prompt_variants": prompt_variants},
+        "elapsed_s": round(elapsed, 3),
+        "requests": {"total": totals["requests"], "ok": totals["ok"], "failed": failed,
+                     "per_second": round(totals["ok"] / elapsed, 3),
+                     "upstream": API_STREAM_COALESCER.upstream_count - upstream_count_start,
+                     "coalesced": API_STREAM_COALESCER.coalesced_count - coalesced_start},
+        "tokens": {"total": totals["tokens"], "per_second": round(totals["tokens"] / elapsed, 1)},
+        "ttft_ms": rounded(ttft_stats.summary()),
+        "itl_ms": rounded(itl_stats.summary()),
+        "cpu_us_per_token": round(totals["cpu"] / totals["tokens"] * 1e6, 2) if totals["tokens"] else None,
+        "errors": {"rate": round(failed / totals["requests"], 4) if totals["requests"] else 0.0,
+                   "by_category": errors},
+        "rate_limited": API_RATE_LIMITER.rate_limited_count,
+        "queue_wait_ms": {name: rounded(stat["wait_ms"]) for name, stat in API_REQUEST_SCHEDULER.stats().items()},
+    }
+    report = json.dumps(result, ensure_ascii=False, indent=2)
+    print(report)
+    if output_path:
+        with open(output_path, "w", encoding="utf-8") as f:
+            f.write(report + "\n")
 
 # ===================== GUI 部分 =====================
 if USE_GUI:
@@ -561,6 +4025,9 @@ if USE_GUI:
             self.client = None
             self.selected_model = None
             self.messages = []
+            self.session_id = None  # 对话存储中的当前会话，首条消息时创建
+            self.similar_offer_pending = False  # 最后一条回答是否为尚未处理的相似问题缓存回答
+            self.context_budgeter = ContextBudgeter()  # 决定每轮发送哪些历史消息
             self.available_models = []  # 添加模型列表存储
 
             # ========== 新增：输出栏字体大小相关 ==========
@@ -676,6 +4143,28 @@ if USE_GUI:
             self.input_btn_frame = tk.Frame(master)
             self.input_btn_frame.pack(side=tk.TOP, fill=tk.X, padx=5, pady=(0, 4))
 
+            # 确定性回复（temperature=0）才会合并相同请求并使用本地响应缓存
+            self.deterministic_var = tk.BooleanVar(value=False)
+            self.deterministic_check = tk.Checkbutton(self.input_btn_frame, text="确定性回复(可缓存)",
+                                                      variable=self.deterministic_var)
+            self.deterministic_check.pack(side=tk.LEFT)
+
+            self.bypass_cache_var = tk.BooleanVar(value=False)
+            self.bypass_cache_check = tk.Checkbutton(self.input_btn_frame, text="跳过缓存",
+                                                     variable=self.bypass_cache_var)
+            self.bypass_cache_check.pack(side=tk.LEFT, padx=(5, 0))
+
+            self.similar_cache_var = tk.BooleanVar(value=API_SIMILAR_CACHE.enabled)
+            self.similar_cache_check = tk.Checkbutton(
+                self.input_btn_frame, text="相似问题缓存", variable=self.similar_cache_var,
+                command=lambda: setattr(API_SIMILAR_CACHE, "enabled", self.similar_cache_var.get()))
+            self.similar_cache_check.pack(side=tk.LEFT, padx=(5, 0))
+
+            # 实时token计数：输入框草稿 + 对话历史
+            self.token_count_label = tk.Label(self.input_btn_frame, text="", fg="gray")
+            self.token_count_label.pack(side=tk.LEFT, padx=(10, 0))
+            self.token_count_job = None
+
             self.btn_spacer = tk.Label(self.input_btn_frame)
             self.btn_spacer.pack(side=tk.LEFT, fill=tk.X, expand=True)
 
@@ -686,14 +4175,18 @@ if USE_GUI:
             self.stop_btn = tk.Button(self.input_btn_frame, text="停止", command=self.stop_streaming, state=tk.DISABLED)
             self.stop_btn.pack(side=tk.RIGHT, padx=(5, 0))
 
+            # 给出相似问题的缓存回答后才显示
+            self.ask_anyway_btn = tk.Button(self.input_btn_frame, text="仍然提问", command=self.ask_anyway)
+
             self.new_btn = tk.Button(self.input_btn_frame, text="新会话", command=self.start_new_session, state=tk.DISABLED)
             self.new_btn.pack(side=tk.RIGHT, padx=(5, 0))
 
             self.end_btn = tk.Button(self.input_btn_frame, text="结束聊天", command=self.end_chat, state=tk.NORMAL)
             self.end_btn.pack(side=tk.RIGHT, padx=(8, 0))
             
-            # 添加停止标志
+            # 添加停止标志与当前流式响应（用于从界面线程中止）
             self.streaming_stopped = False
+            self.active_response = None
 
             # ========== 版权信息（放在最底部） ==========
             self.footer_label = tk.Label(
@@ -729,19 +4222,93 @@ if USE_GUI:
             self.clear_apikey_btn = tk.Button(self.api_manage_frame, text="清除API密钥", command=self.clear_api_key, state=tk.DISABLED)
             self.clear_apikey_btn.pack(side=tk.LEFT)
 
+            self.key_pool_btn = tk.Button(self.api_manage_frame, text="密钥池...", command=self.manage_key_pool)
+            self.key_pool_btn.pack(side=tk.LEFT, padx=(5, 0))
+
+            self.usage_btn = tk.Button(self.api_manage_frame, text="用量...", command=self.show_usage_summary)
+            self.usage_btn.pack(side=tk.LEFT, padx=(5, 0))
+
+            self.context_budget_btn = tk.Button(self.api_manage_frame, text="上下文预算...",
+                                                command=self.configure_context_budget)
+            self.context_budget_btn.pack(side=tk.LEFT, padx=(5, 0))
+
+            self.compaction_var = tk.BooleanVar(value=CONTEXT_BUDGET_POLICY["compaction"])
+            self.compaction_check = tk.Checkbutton(
+                self.api_manage_frame, text="压缩早期对话", variable=self.compaction_var,
+                command=lambda: self.context_budgeter.policy.update(compaction=self.compaction_var.get()))
+            self.compaction_check.pack(side=tk.LEFT, padx=(5, 0))
+
+            self.sessions_btn = tk.Button(self.api_manage_frame, text="历史会话/搜索...", command=self.browse_sessions)
+            self.sessions_btn.pack(side=tk.LEFT, padx=(5, 0))
+
             # ========== 独立状态监控窗口相关 ==========
             self.status_window = None
             self.status_indicators = {}
 
+            # 状态监控窗口中的行：(状态键, 显示名称)
+            self.status_rows = [
+                ("client", "客户端"),
+                ("network", "网络"),
+                ("latency", "延迟分解"),
+                ("latency_pct", "首字节分布"),
+                ("dns", "DNS解析"),
+                ("prewarm", "连接预热"),
+                ("ratelimit", "限流队列"),
+                ("keys", "密钥池"),
+                ("scheduler", "请求调度"),
+                ("cache", "响应缓存"),
+                ("context_cache", "上下文缓存"),
+                ("context_budget", "上下文预算"),
+                ("usage", "用量费用"),
+                ("breaker", "熔断器"),
+                ("errors", "错误统计"),
+                ("model", "模型"),
+                ("http", "HTTP"),
+                ("chat", "聊天")
+            ]
+
             # 初始化状态监控数据
             self.status_data = {
                 "client": {"text": "无API密钥", "color": "red"},
                 "network": {"text": "检查中...", "color": "gray"},
+                "latency": {"text": "暂无数据", "color": "gray"},
+                "latency_pct": {"text": "暂无数据", "color": "gray"},
+                "dns": {"text": "解析中...", "color": "gray"},
+                "prewarm": {"text": "未触发", "color": "gray"},
+                "ratelimit": {"text": "排队 0 / 速率 100%", "color": "green"},
+                "keys": {"text": "未配置", "color": "gray"},
+                "scheduler": {"text": "空闲", "color": "green"},
+                "cache": {"text": "暂无查询", "color": "gray"},
+                "context_cache": {"text": "暂无数据", "color": "gray"},
+                "context_budget": {"text": "暂无数据", "color": "gray"},
+                "usage": {"text": "暂无数据", "color": "gray"},
+                "breaker": {"text": "关闭 (正常)", "color": "green"},
+                "errors": {"text": "无", "color": "green"},
                 "model": {"text": "未选择", "color": "red"},
                 "http": {"text": "正常", "color": "green"},  # 默认HTTP状态设为绿色
                 "chat": {"text": "未就绪", "color": "red"}
             }
 
+            # 用户活动与窗口最小化跟踪（供健康探测自适应退避）
+            self.last_activity_time = time.monotonic()
+            self.window_minimized = False
+            master.bind("<Unmap>", self._on_window_unmap, add="+")
+            master.bind("<Map>", self._on_window_map, add="+")
+
+            # 启动时在后台预解析API主机名
+            self.api_host = urllib.parse.urlsplit(DEEPSEEK_API_BASE_URL_V1).hostname
+            DNS_CACHE.prefetch([self.api_host])
+
+            # 输入时预热连接
+            self.prewarmer = ConnectionPrewarmer()
+
+            # 复用全局连接池的网络健康探测器
+            self.health_prober = HealthProber(
+                API_CONNECTION_POOL,
+                f"{DEEPSEEK_API_BASE_URL_V1}/models",
+                headers_provider=lambda: {"Authorization": f"Bearer {self.api_key}"} if self.api_key else {}
+            )
+
             # 初始化状态
             self.update_client_status()
             self.update_network_status()
@@ -756,6 +4323,9 @@ if USE_GUI:
             self.network_thread = threading.Thread(target=self.network_status_loop, daemon=True)
             self.network_thread.start()
 
+            # 定时刷新限流队列与熔断器显示
+            self.master.after(1000, self.refresh_flow_control_status)
+
             # 在创建完所有指示灯控件后再初始化状态
             # 初始化状态
             self.update_client_status()
@@ -814,7 +4384,9 @@ if USE_GUI:
             """创建独立的状态监控窗口"""
             self.status_window = tk.Toplevel(self.master)
             self.status_window.title("状态监控")
-            self.status_window.geometry("320x160")  # 稍微增加宽度以容纳延迟数据
+            # 窗口高度随状态行数变化：标题栏25像素，每行约27像素
+            window_height = 30 + 27 * len(self.status_rows)
+            self.status_window.geometry(f"320x{window_height}")  # 稍微增加宽度以容纳延迟数据
             self.status_window.resizable(False, False)
             
             # 隐藏窗口的关闭按钮和标题栏
@@ -824,7 +4396,7 @@ if USE_GUI:
             main_x = self.master.winfo_x()
             main_y = self.master.winfo_y()
             main_width = self.master.winfo_width()
-            self.status_window.geometry(f"320x160+{main_x + main_width + 10}+{main_y}")
+            self.status_window.geometry(f"320x{window_height}+{main_x + main_width + 10}+{main_y}")
             
             # 添加标题栏
             title_frame = tk.Frame(self.status_window, bg="darkgray", height=25)
@@ -839,20 +4411,9 @@ if USE_GUI:
             content_frame.pack(fill=tk.BOTH, expand=True, padx=2, pady=2)
             
             # 创建状态指示器
-            self.status_indicators["client"] = StatusIndicator(content_frame, "客户端")
-            self.status_indicators["client"].pack(fill=tk.X, padx=5, pady=2)
-
-            self.status_indicators["network"] = StatusIndicator(content_frame, "网络")
-            self.status_indicators["network"].pack(fill=tk.X, padx=5, pady=2)
-
-            self.status_indicators["model"] = StatusIndicator(content_frame, "模型")
-            self.status_indicators["model"].pack(fill=tk.X, padx=5, pady=2)
-
-            self.status_indicators["http"] = StatusIndicator(content_frame, "HTTP")
-            self.status_indicators["http"].pack(fill=tk.X, padx=5, pady=2)
-
-            self.status_indicators["chat"] = StatusIndicator(content_frame, "聊天")
-            self.status_indicators["chat"].pack(fill=tk.X, padx=5, pady=2)
+            for key, label_text in self.status_rows:
+                self.status_indicators[key] = StatusIndicator(content_frame, label_text)
+                self.status_indicators[key].pack(fill=tk.X, padx=5, pady=2)
 
             # 更新所有状态显示
             for key, data in self.status_data.items():
@@ -934,64 +4495,50 @@ if USE_GUI:
                 self.update_status_display("client", "初始化中...", "yellow")
                 
                 # 创建客户端
-                test_client = OpenAI(api_key=api_key, base_url=DEEPSEEK_API_BASE_URL_V1)
+                test_client = create_openai_client(api_key)
                 
                 # 测试客户端连接 - 尝试获取模型列表来验证API Key
                 self.print_out("正在测试客户端连接...")
-                try:
-                    models_response = test_client.models.list()
-                    # 如果成功获取模型列表，说明初始化成功
-                    self.update_http_status(200, "初始化")
-                    
-                except Exception as test_error:
-                    # 解析测试连接时的HTTP错误
-                    error_msg = str(test_error)
-                    
-                    # 尝试从错误消息中提取HTTP状态码
-                    import re
-                    status_match = re.search(r'status_code:\s*(\d+)', error_msg)
-                    if status_match:
-                        status_code = int(status_match.group(1))
-                        self.update_http_status(status_code, "初始化")
-                        
-                        # 显示HTTP错误对话框
-                        self.show_http_error_dialog(status_code, "客户端初始化")
-                        
-                        # 更新客户端状态为初始化失败
-                        self.update_status_display("client", "初始化失败", "red")
-                        self.print_out(f"客户端初始化失败: HTTP {status_code}")
-                        return
-                    else:
-                        # 根据错误类型推断状态码
-                        if "401" in error_msg or "Unauthorized" in error_msg:
-                            self.update_http_status(401, "初始化")
-                            self.show_http_error_dialog(401, "客户端初始化")
-                            status_text = "认证失败"
-                        elif "403" in error_msg or "Forbidden" in error_msg:
-                            self.update_http_status(403, "初始化")
-                            self.show_http_error_dialog(403, "客户端初始化")
-                            status_text = "访问被禁"
-                        elif "429" in error_msg or "rate" in error_msg.lower():
-                            self.update_http_status(429, "初始化")
-                            self.show_http_error_dialog(429, "客户端初始化")
-                            status_text = "请求限制"
-                        elif "timeout" in error_msg.lower() or "connection" in error_msg.lower():
-                            self.update_http_status(0, "初始化")
-                            status_text = "网络错误"
-                            self.print_out(f"初始化时网络错误: {error_msg}")
-                        else:
-                            self.update_http_status(0, "初始化")
-                            status_text = "未知错误"
-                            self.print_out(f"初始化时未知错误: {error_msg}")
-                        
-                        # 更新客户端状态为初始化失败
-                        self.update_status_display("client", status_text, "red")
-                        self.print_out(f"客户端初始化失败: {status_text}")
-                        return
-                        
+                self.init_btn.config(state=tk.DISABLED)
+                # 验证请求及重试等待放到后台线程，避免阻塞界面
+                threading.Thread(target=self._initialize_client_worker, args=(test_client, api_key),
+                                 daemon=True).start()
+
+            except Exception as e:
+                self._on_client_init_error(e)
+
+        def _initialize_client_worker(self, test_client, api_key):
+            """客户端验证工作线程"""
+            try:
+                call_with_retry("models", test_client.models.list, on_retry=self._make_retry_reporter("初始化"))
+            except Exception as e:
+                self.master.after(0, lambda err=e: self._on_client_validation_failed(err))
+            else:
+                self.master.after(0, lambda: self._on_client_validated(test_client, api_key))
+
+        def _on_client_validation_failed(self, test_error):
+            """在主线程中处理验证失败"""
+            self.init_btn.config(state=tk.NORMAL)
+            # 统一分类测试连接时的错误
+            info = self.handle_api_error("客户端初始化", test_error)
+
+            # 更新客户端状态为初始化失败
+            self.update_status_display("client", ERROR_CATEGORY_TEXT.get(info.category, "初始化失败"), "red")
+            self.print_out(f"客户端初始化失败: {info.describe()}")
+
+        def _on_client_validated(self, test_client, api_key):
+            """在主线程中完成初始化"""
+            try:
+                # 如果成功获取模型列表，说明初始化成功
+                self.update_http_status(200, "初始化")
+
                 # 如果测试连接成功，设置客户端
+                self.init_btn.config(state=tk.NORMAL)
                 self.client = test_client
                 self.api_key = api_key
+                API_KEY_POOL.set_keys([api_key] + load_api_key_pool_from_file())
+                if API_KEY_POOL.size > 1:
+                    self.print_out(f"已加载密钥池，共 {API_KEY_POOL.size} 个密钥，聊天请求将在其间调度。")
                 
                 # 保存API Key
                 if save_api_key_to_file(api_key):
@@ -1021,18 +4568,21 @@ if USE_GUI:
                 self.refresh_models()
                 
             except Exception as e:
-                # 捕获其他初始化异常
-                error_msg = str(e)
-                self.update_http_status(0, "初始化")
-                self.update_status_display("client", "初始化失败", "red")
-                
-                # 恢复API Key输入框状态
-                self.api_key_entry.config(state=tk.NORMAL)
-                self.init_btn.config(state=tk.NORMAL, text="初始化")
-                
-                messagebox.showerror("错误", f"客户端初始化失败: {error_msg}")
-                self.print_out(f"客户端初始化失败: {error_msg}")
-                self.update_buttons_state()
+                self._on_client_init_error(e)
+
+        def _on_client_init_error(self, e):
+            """处理验证请求之外的初始化异常"""
+            error_msg = str(e)
+            self.update_http_status(0, "初始化")
+            self.update_status_display("client", "初始化失败", "red")
+
+            # 恢复API Key输入框状态
+            self.api_key_entry.config(state=tk.NORMAL)
+            self.init_btn.config(state=tk.NORMAL, text="初始化")
+
+            messagebox.showerror("错误", f"客户端初始化失败: {error_msg}")
+            self.print_out(f"客户端初始化失败: {error_msg}")
+            self.update_buttons_state()
 
         def change_api_key(self):
             """修改API Key"""
@@ -1070,11 +4620,7 @@ if USE_GUI:
 
         def mask_api_key(self, api_key):
             """掩码API Key，前后各保留2位明文"""
-            if not api_key:
-                return ""
-            if len(api_key) <= 4:
-                return "*" * len(api_key)  # 如果长度小于等于4，全部掩码
-            return api_key[:2] + "*" * (len(api_key) - 4) + api_key[-2:]
+            return mask_api_key(api_key)
 
         def update_buttons_state(self):
             """更新按钮状态"""
@@ -1116,52 +4662,97 @@ if USE_GUI:
             else:
                 self.update_status_display("client", "无API密钥", "red")
 
+        def _on_window_unmap(self, event):
+            """主窗口最小化"""
+            if event.widget is self.master:
+                self.window_minimized = True
+
+        def _on_window_map(self, event):
+            """主窗口恢复显示"""
+            if event.widget is self.master:
+                self.window_minimized = False
+                self.mark_user_activity()
+
+        def mark_user_activity(self):
+            """记录用户活动时间"""
+            self.last_activity_time = time.monotonic()
+
+        def is_user_idle(self):
+            """判断用户是否处于空闲状态"""
+            return time.monotonic() - self.last_activity_time > USER_IDLE_THRESHOLD
+
         def network_status_loop(self):
-            """网络状态检查循环"""
+            """网络状态检查循环（基于连接池的健康探测）"""
             while not self.network_thread_stop:
+                # 探测属于后台请求，交互式聊天排队时让行
                 try:
-                    # 测量网络延迟
-                    import socket
-                    import time
-                    
-                    start_time = time.time()
-                    socket.create_connection(("api.deepseek.com", 443), timeout=5)
-                    end_time = time.time()
-                    
-                    # 计算延迟（毫秒）
-                    latency_ms = round((end_time - start_time) * 1000, 1)
-                    
-                    # 根据延迟确定状态颜色
-                    if latency_ms < 200:
-                        color = "green"
-                    elif latency_ms < 500:
-                        color = "yellow"
-                    else:
-                        color = "red"
-                    
-                    status_text = f"已连接 ({latency_ms}ms)"
-                    
-                    # 修复lambda闭包问题 - 使用函数而不是lambda
-                    def update_network_status(text, c):
-                        self.update_status_display("network", text, c)
-                    
-                    self.master.after(0, lambda: update_network_status(status_text, color))
-                    
-                    # 网络连接成功时也更新HTTP状态为连接正常
-                    self.master.after(0, lambda: self.update_http_status(200, "网络"))
-                    
-                except socket.timeout:
-                    self.master.after(0, lambda: self.update_status_display("network", "超时", "red"))
-                    self.master.after(0, lambda: self.update_http_status(0, "网络"))
-                except Exception:
-                    self.master.after(0, lambda: self.update_status_display("network", "已断开", "red"))
-                    self.master.after(0, lambda: self.update_http_status(0, "网络"))
-                
-                # 等待30秒再次检查
-                for _ in range(30):
-                    if self.network_thread_stop:
+                    with API_REQUEST_SCHEDULER.slot("background", lambda: self.network_thread_stop):
+                        result = self.health_prober.probe(lambda: self.network_thread_stop)
+                except RequestCancelled:
+                    break
+                # 熔断器半开时由探测结果决定是否恢复
+                API_CIRCUIT_BREAKER.record_probe(result["ok"] and result["status"] < 500)
+                self.master.after(0, lambda r=result: self._apply_probe_result(r))
+
+                # 空闲或最小化时退避探测间隔，用户恢复活动后立即回到基础间隔
+                interval = self.health_prober.adapt_interval(self.is_user_idle(), self.window_minimized)
+                waited = 0
+                while waited < interval and not self.network_thread_stop:
+                    if interval > self.health_prober.base_interval and \
+                            not self.is_user_idle() and not self.window_minimized:
+                        break
+                    if API_CIRCUIT_BREAKER.state == "half_open":
+                        # 熔断冷却结束，立即探测
                         break
                     time.sleep(1)
+                    waited += 1
+
+        def _apply_probe_result(self, result):
+            """在主线程中将探测结果更新到状态显示"""
+            if not result["ok"]:
+                if result["error"] == "timeout":
+                    self.update_status_display("network", "超时", "red")
+                else:
+                    self.update_status_display("network", "已断开", "red")
+                self.update_http_status(0, "网络")
+                return
+
+            total_ms = round(result["total_ms"], 1)
+            p50 = self.health_prober.total_stats.percentile(50)
+            # 根据滚动中位数确定状态颜色，避免单次抖动导致指示灯闪烁
+            if p50 < 300:
+                color = "green"
+            elif p50 < 800:
+                color = "yellow"
+            else:
+                color = "red"
+            self.update_status_display("network", f"已连接 ({total_ms}ms)", color)
+
+            if result["reused"]:
+                breakdown = f"复用连接 / 首字节 {result['ttfb_ms']:.0f}ms"
+            else:
+                breakdown = (f"TCP {result['connect_ms']:.0f} / TLS {result['tls_ms']:.0f} / "
+                             f"首字节 {result['ttfb_ms']:.0f}ms")
+            self.update_status_display("latency", breakdown, color)
+
+            pct = self.health_prober.ttfb_stats.summary()
+            self.update_status_display(
+                "latency_pct",
+                f"p50 {pct['p50']:.0f} / p90 {pct['p90']:.0f} / p99 {pct['p99']:.0f}ms",
+                color
+            )
+
+            dns_stats = DNS_CACHE.stats(self.api_host)
+            if dns_stats["resolve_ms"] is not None:
+                self.update_status_display(
+                    "dns",
+                    f"{dns_stats['resolve_ms']:.0f}ms / 命中{dns_stats['hits']}次 / {dns_stats['preferred']}",
+                    "green" if dns_stats["resolve_ms"] < 200 else "yellow"
+                )
+
+            # 网络连接成功时也更新HTTP状态为连接正常（未授权的探测不影响HTTP状态）
+            if result["status"] < 400:
+                self.update_http_status(200, "网络")
 
         def update_model_status(self, status=None):
             """更新模型状态"""
@@ -1231,6 +4822,138 @@ if USE_GUI:
                 operation_text = f" ({operation})" if operation else ""
                 self.update_status_display("http", f"状态 {status_code}{operation_text}", "yellow")
 
+        def refresh_flow_control_status(self):
+            """每秒刷新一次限流队列深度、当前速率与熔断器状态"""
+            depth = API_RATE_LIMITER.queue_depth
+            throttle = API_RATE_LIMITER.throttle
+            text = f"排队 {depth} / 速率 {throttle * 100:.0f}% / 429共{API_RATE_LIMITER.rate_limited_count}次"
+            if depth == 0 and throttle >= 1.0:
+                color = "green"
+            elif throttle > 0.25:
+                color = "yellow"
+            else:
+                color = "red"
+            if self.status_data.get("ratelimit") != {"text": text, "color": color}:
+                self.update_status_display("ratelimit", text, color)
+
+            state, error_rate, retry_in = API_CIRCUIT_BREAKER.stats()
+            if state == "closed":
+                text, color = f"关闭 (错误率 {error_rate * 100:.0f}%)", "green"
+            elif state == "open":
+                text, color = f"打开 ({retry_in:.0f}s后半开探测)", "red"
+            else:
+                text, color = "半开 (探测中)", "yellow"
+            if self.status_data.get("breaker") != {"text": text, "color": color}:
+                self.update_status_display("breaker", text, color)
+
+            if API_KEY_POOL.size:
+                available = API_KEY_POOL.available_count()
+                text = f"{API_KEY_POOL.size}个密钥 / 可用{available}个"
+                color = "green" if available == API_KEY_POOL.size else ("yellow" if available else "red")
+                if self.status_data.get("keys") != {"text": text, "color": color}:
+                    self.update_status_display("keys", text, color)
+
+            stats = API_REQUEST_SCHEDULER.stats()
+            interactive, background = stats["interactive"], stats["background"]
+            wait_p90 = interactive["wait_ms"]["p90"]
+            text = (f"交互 {interactive['active']}/{interactive['queued']} · "
+                    f"后台 {background['active']}/{background['queued']} (运行/排队)")
+            if wait_p90 is not None:
+                text += f" · 等待p90 {wait_p90:.0f}ms"
+            color = "yellow" if interactive["queued"] or background["queued"] else "green"
+            if self.status_data.get("scheduler") != {"text": text, "color": color}:
+                self.update_status_display("scheduler", text, color)
+
+            cache_stats = API_RESPONSE_CACHE.stats()
+            if cache_stats["hit_rate"] is not None:
+                text = (f"命中率 {cache_stats['hit_rate'] * 100:.0f}% ({cache_stats['hits']}/"
+                        f"{cache_stats['hits'] + cache_stats['misses']}) · {cache_stats['entries']}条 "
+                        f"{cache_stats['bytes'] / 1024:.0f}KB")
+                color = "green"
+            else:
+                text, color = f"暂无查询 · {cache_stats['entries']}条", "gray"
+            if API_SIMILAR_CACHE.enabled:
+                similar = API_SIMILAR_CACHE.stats()
+                text += f" · 相似命中 {similar['hits']}/{similar['lookups']}"
+            if self.status_data.get("cache") != {"text": text, "color": color}:
+                self.update_status_display("cache", text, color)
+
+            context_stats = API_CONTEXT_CACHE_STATS.stats()
+            if context_stats["hit_ratio"] is not None:
+                last = context_stats["last"]
+                text = (f"命中率 {context_stats['hit_ratio'] * 100:.0f}% · 本轮 {last['hit_tokens']}/"
+                        f"{last['hit_tokens'] + last['miss_tokens']} · 累计节省约 ¥{context_stats['saved']:.4f}")
+                color = "green" if context_stats["hit_ratio"] >= 0.5 else "yellow"
+            else:
+                text, color = "暂无数据", "gray"
+            if self.status_data.get("context_cache") != {"text": text, "color": color}:
+                self.update_status_display("context_cache", text, color)
+
+            report = self.context_budgeter.last_report
+            if report is not None:
+                text = f"发送 {report['prompt_tokens']} / 共 {report['total_tokens']} tokens (预算 {report['budget']})"
+                if report["summarized_messages"]:
+                    text += f" · 摘要代替 {report['summarized_messages']} 条"
+                if report["dropped_messages"] or report["truncated_messages"]:
+                    text += f" · 省略 {report['dropped_messages']} 条 / 截断 {report['truncated_messages']} 条"
+                color = "red" if report["over_budget"] else "yellow" if report["trimmed_tokens"] else "green"
+            else:
+                text, color = "暂无数据", "gray"
+            if self.status_data.get("context_budget") != {"text": text, "color": color}:
+                self.update_status_display("context_budget", text, color)
+
+            session = API_USAGE_LEDGER.session_summary()
+            today = API_USAGE_LEDGER.today_summary()
+            text = (f"本次 {session['requests']}次 {session['prompt_tokens'] + session['completion_tokens']}tokens "
+                    f"¥{session['cost']:.4f} · 今日 ¥{today['cost']:.4f}")
+            color = "green" if session["requests"] else "gray"
+            if self.status_data.get("usage") != {"text": text, "color": color}:
+                self.update_status_display("usage", text, color)
+
+            error_summary = API_ERROR_METRICS.summary()
+            text, color = (error_summary, "yellow") if error_summary else ("无", "green")
+            if self.status_data.get("errors") != {"text": text, "color": color}:
+                self.update_status_display("errors", text, color)
+
+            if not self.network_thread_stop:
+                self.master.after(1000, self.refresh_flow_control_status)
+
+        def handle_api_error(self, operation, error):
+            """统一处理API错误（异常或HTTP响应）：更新HTTP指示灯，不可重试的HTTP错误弹出对话框
+
+            返回 ApiErrorInfo，供调用方决定后续提示。必须在主线程中调用。
+            """
+            info = getattr(error, "error_info", None) or classify_error(error)
+            if info.category == "cancelled":
+                return info
+            if info.category == "circuit_open":
+                self.show_circuit_open(operation, error)
+                return info
+
+            attempts = getattr(error, "retry_attempts", 1)
+            operation_text = f"{operation}, 尝试{attempts}次" if attempts > 1 else operation
+            self.update_http_status(info.status if info.status is not None else 0, operation_text)
+            if info.status is not None and not info.retryable:
+                self.show_http_error_dialog(info.status, operation, info.details)
+            else:
+                # 可重试的错误在重试耗尽后只在指示灯和输出区提示，不弹出对话框
+                self.print_out(f"{operation}失败: {info.describe()}")
+            return info
+
+        def show_circuit_open(self, operation, exc):
+            """熔断打开时给出即时反馈，不再等待超时"""
+            self.update_status_display("http", f"熔断中, 快速失败 ({operation})", "red")
+            self.print_out(f"{operation}失败: {exc}")
+
+        def _make_retry_reporter(self, operation):
+            """返回供工作线程使用的重试回调，把尝试次数显示在HTTP指示灯上"""
+            def report(attempt, max_attempts, delay, exc):
+                info = getattr(exc, "error_info", None) or classify_error(exc)
+                reason = f"HTTP {info.status}" if info.status else ERROR_CATEGORY_TEXT.get(info.category, "网络错误")
+                text = f"重试 {attempt + 1}/{max_attempts} ({reason}, {delay:.1f}s后) ({operation})"
+                self.master.after(0, lambda: self.update_status_display("http", text, "yellow"))
+            return report
+
         def update_chat_status(self, status):
             """更新聊天状态"""
             status_map = {
@@ -1274,15 +4997,38 @@ if USE_GUI:
             if not self.client or not self.api_key:
                 messagebox.showerror("错误", "请先初始化客户端")
                 return
-                
-            try:
-                self.print_out("正在查询账户余额...")
-                headers = {
-                    "Authorization": f"Bearer {self.api_key}",
-                    "Accept": "application/json"
-                }
+
+            self.print_out("正在查询账户余额...")
+            self.balance_btn.config(state=tk.DISABLED)
+            threading.Thread(target=self._query_balance_worker, args=(self.api_key,), daemon=True).start()
+
+        def _query_balance_worker(self, api_key):
+            """余额查询工作线程"""
+            headers = {
+                "Authorization": f"Bearer {api_key}",
+                "Accept": "application/json"
+            }
+
+            def fetch():
                 response = requests.get(DEEPSEEK_BALANCE_URL, headers=headers, timeout=10)
-                
+                API_RATE_LIMITER.update_from_headers(response.headers)
+                # 可重试的状态码转为异常交给重试引擎处理
+                if response.status_code in RETRYABLE_STATUS_CODES:
+                    raise requests.exceptions.HTTPError(f"HTTP {response.status_code}", response=response)
+                return response
+
+            try:
+                response = call_with_retry("balance", fetch, on_retry=self._make_retry_reporter("余额查询"))
+            except Exception as e:
+                self.master.after(0, lambda err=e: self._on_balance_failed(err))
+            else:
+                self.master.after(0, lambda: self._on_balance_response(response))
+            finally:
+                self.master.after(0, self.update_buttons_state)
+
+        def _on_balance_response(self, response):
+            """在主线程中显示余额查询结果"""
+            try:
                 # 更新HTTP状态
                 self.update_http_status(response.status_code, "余额查询")
                 
@@ -1317,32 +5063,8 @@ if USE_GUI:
                 else:
                     # 处理非200状态码 - 弹出错误对话框而不是在输出区域显示JSON
                     self.print_out(f"查询余额失败: HTTP {response.status_code}")
-                    
-                    try:
-                        error_details = response.json()
-                        self.show_http_error_dialog(response.status_code, "余额查询", error_details)
-                    except json.JSONDecodeError:
-                        self.show_http_error_dialog(response.status_code, "余额查询")
-                    
-            except requests.exceptions.HTTPError as http_err:
-                code = http_err.response.status_code if http_err.response is not None else None
-                self.update_http_status(code, "余额查询")
-                
-                if http_err.response is not None:
-                    try:
-                        error_details = http_err.response.json()
-                        self.show_http_error_dialog(http_err.response.status_code, "余额查询", error_details)
-                    except json.JSONDecodeError:
-                        self.show_http_error_dialog(http_err.response.status_code, "余额查询")
-                else:
-                    error_msg = f"HTTP error: {http_err}"
-                    self.print_out(error_msg)
-                
-            except requests.exceptions.RequestException as e:
-                self.update_http_status(0, "余额查询")
-                error_msg = f"请求失败: {e}"
-                self.print_out(error_msg)
-                
+                    self.handle_api_error("余额查询", response)
+
             except json.JSONDecodeError:
                 self.update_http_status(0, "余额查询")
                 error_msg = "余额响应不是有效的JSON。"
@@ -1353,6 +5075,10 @@ if USE_GUI:
                 error_msg = f"未知错误: {e}"
                 self.print_out(error_msg)
 
+        def _on_balance_failed(self, e):
+            """在主线程中处理余额查询失败（重试已耗尽）"""
+            self.handle_api_error("余额查询", e)
+
         def clear_output(self):
             """清空输出区域"""
             if hasattr(self.output, 'clear_all'):
@@ -1397,6 +5123,7 @@ if USE_GUI:
                 if event.state & 0x1:  # Shift+Enter，插入换行
                     return "break"
             
+            self.mark_user_activity()
             user_message = self.user_input.get("1.0", tk.END).strip()
             if not user_message:
                 return "break"
@@ -1407,18 +5134,86 @@ if USE_GUI:
                 
             # 清空输入框
             self.user_input.delete("1.0", tk.END)
+            self.dismiss_similar_offer()
             
             # 添加用户消息到对话历史
             self.messages.append({"role": "user", "content": user_message})
+            self.record_message("user", user_message)
             
             # 显示用户输入
             self.print_out(f"您: {user_message}")
+            self.update_token_count()
+
+            if self.offer_similar_answer():
+                return "break"
             
+            # 统计预热节省的握手延迟
+            saved_ms = self.prewarmer.on_send()
+            self.update_prewarm_status(saved_ms)
+
             # 开始流式对话
             self.start_streaming_chat()
             
             return "break"
 
+        def offer_similar_answer(self):
+            """相似问题缓存命中时直接给出缓存回答并显示“仍然提问”按钮，返回是否命中"""
+            if not API_SIMILAR_CACHE.enabled:
+                return False
+            prompt = SimilarPromptCache.single_turn_prompt(self.messages)
+            match = API_SIMILAR_CACHE.lookup(self.selected_model, prompt) if prompt else None
+            if match is None:
+                return False
+            answer, similarity = match
+            self.messages.append({"role": "assistant", "content": answer})
+            self.record_message("assistant", answer)
+            self.print_out(f"助手: {answer}")
+            self.print_out(f"（相似问题的缓存回答，相似度 {similarity * 100:.0f}%，未产生API调用；"
+                           f"点击“仍然提问”重新向模型提问）")
+            self.ask_anyway_btn.pack(side=tk.RIGHT, padx=(5, 0), before=self.stop_btn)
+            self.similar_offer_pending = True
+            self.update_token_count()
+            return True
+
+        def dismiss_similar_offer(self):
+            """隐藏“仍然提问”按钮并放弃待处理的相似问题缓存回答（发送新消息或切换会话时调用）"""
+            self.ask_anyway_btn.pack_forget()
+            self.similar_offer_pending = False
+
+        def record_message(self, role, content, usage=None):
+            """把一条消息交给对话存储（后台写入，不等待磁盘）"""
+            if self.session_id is None:
+                self.session_id = API_CONVERSATION_STORE.new_session(self.selected_model)
+            API_CONVERSATION_STORE.append_message(self.session_id, role, content, model=self.selected_model,
+                                                  usage=usage)
+
+        def ask_anyway(self):
+            """丢弃相似问题的缓存回答，重新向模型提问"""
+            pending = self.similar_offer_pending
+            self.dismiss_similar_offer()
+            if not pending:
+                return
+            if self.messages and self.messages[-1]["role"] == "assistant":
+                self.messages.pop()
+                if self.session_id:
+                    API_CONVERSATION_STORE.remove_last_message(self.session_id)
+            self.print_out("正在重新向模型提问...")
+            self.start_streaming_chat()
+
+        def update_prewarm_status(self, saved_ms):
+            """更新连接预热统计显示"""
+            prewarmer = self.prewarmer
+            if saved_ms > 0:
+                text = f"本次节省 {saved_ms:.0f}ms / 累计 {prewarmer.saved_ms_total:.0f}ms"
+                color = "green"
+            elif prewarmer.last_send_reused:
+                text = f"连接复用 / 累计节省 {prewarmer.saved_ms_total:.0f}ms ({prewarmer.warm_sends}次)"
+                color = "green"
+            else:
+                text = f"冷启动 / 累计节省 {prewarmer.saved_ms_total:.0f}ms ({prewarmer.warm_sends}次)"
+                color = "yellow"
+            self.update_status_display("prewarm", text, color)
+
         def start_streaming_chat(self):
             """开始流式聊天"""
             self.streaming_stopped = False
@@ -1428,74 +5223,113 @@ if USE_GUI:
             self.send_btn.config(state=tk.DISABLED)
             self.stop_btn.config(state=tk.NORMAL)
             
-            # 在新线程中进行API调用
-            thread = threading.Thread(target=self._streaming_chat_worker, daemon=True)
+            # 在新线程中进行API调用（界面变量在主线程读取）
+            temperature = 0 if self.deterministic_var.get() else 0.7
+            thread = threading.Thread(target=self._streaming_chat_worker,
+                                      args=(temperature, self.bypass_cache_var.get()), daemon=True)
             thread.start()
 
-        def _streaming_chat_worker(self):
+        def _streaming_chat_worker(self, temperature=0.7, bypass_cache=False):
             """流式聊天工作线程"""
+            chunks = None
+            assistant_message = ""
+            usage = None
+            resume_info = {"count": 0, "saved_tokens": 0}
+            cache_hit = []
+
+            def on_response(response):
+                self.active_response = response
+                if self.streaming_stopped:
+                    # 请求建立期间用户已按下停止
+                    abort_response(response)
+
+            def on_resume(count, partial, exc):
+                # 续传不打断当前消息的渲染，只在HTTP指示灯上提示
+                resume_info["count"] = count
+                resume_info["saved_tokens"] += estimate_tokens(partial)
+                text = f"续传 {count}/{STREAM_RESUME_MAX_ATTEMPTS} ({classify_error(exc).describe()[:20]})"
+                self.master.after(0, lambda: self.update_status_display("http", text, "yellow"))
+
             try:
-                response = self.client.chat.completions.create(
+                request_messages = self.context_budgeter.fit(self.messages, self.selected_model, CHAT_MAX_TOKENS,
+                                                             client=self.client)
+                trim_note = describe_context_trim(self.context_budgeter.last_report)
+                if trim_note:
+                    self.master.after(0, lambda: self.print_out(trim_note))
+                chunks = API_RESPONSE_CACHE.stream(
+                    self.client,
+                    bypass=bypass_cache,
+                    on_cache_hit=lambda: cache_hit.append(True),
+                    on_retry=self._make_retry_reporter("聊天"),
+                    cancel_check=lambda: self.streaming_stopped,
+                    on_response=on_response,
+                    on_resume=on_resume,
                     model=self.selected_model,
-                    messages=self.messages,
-                    stream=True,
-                    max_tokens=4096,
-                    temperature=0.7
+                    messages=request_messages,
+                    max_tokens=CHAT_MAX_TOKENS,
+                    temperature=temperature
                 )
+                first_chunk = next(chunks, None)
                 
                 # 更新HTTP状态 - 聊天请求成功
                 self.master.after(0, lambda: self.update_http_status(200, "聊天"))
                 
-                assistant_message = ""
                 self.master.after(0, lambda: self.print_out("助手: ", end=""))
+                pending = itertools.chain([first_chunk], chunks) if first_chunk is not None else ()
                 
-                for chunk in response:
-                    if self.streaming_stopped:
-                        break
-                        
-                    if chunk.choices[0].delta.content is not None:
-                        content = chunk.choices[0].delta.content
-                        assistant_message += content
-                        # 在主线程中更新UI
-                        self.master.after(0, lambda c=content: self._append_streaming_content(c))
+                try:
+                    for chunk in pending:
+                        if self.streaming_stopped:
+                            break
+                            
+                        if chunk.choices and chunk.choices[0].delta.content is not None:
+                            content = chunk.choices[0].delta.content
+                            assistant_message += content
+                            # 在主线程中更新UI
+                            self.master.after(0, lambda c=content: self._append_streaming_content(c))
+                        if getattr(chunk, "usage", None) is not None:
+                            usage = chunk.usage
+                except Exception:
+                    # 停止操作关闭了底层连接，读取方抛出的异常属于正常的取消流程
+                    if not self.streaming_stopped:
+                        raise
                 
-                if not self.streaming_stopped:
+                if self.streaming_stopped:
+                    # 记录已收到的部分回复，保持对话历史连贯
+                    if assistant_message:
+                        self.messages.append({"role": "assistant", "content": assistant_message})
+                        self.record_message("assistant", assistant_message)
+                        self.master.after(0, lambda n=len(assistant_message): self.print_out(
+                            f"（回复已中断，已保留 {n} 个字符）"))
+                else:
+                    if API_SIMILAR_CACHE.enabled and assistant_message:
+                        prompt = SimilarPromptCache.single_turn_prompt(self.messages)
+                        if prompt:
+                            API_SIMILAR_CACHE.add(self.selected_model, prompt, assistant_message)
                     # 添加助手回复到对话历史
                     self.messages.append({"role": "assistant", "content": assistant_message})
+                    self.record_message("assistant", assistant_message, usage)
                     self.master.after(0, lambda: self.print_out("", end="\n"))  # 换行
+                    if resume_info["count"]:
+                        self.master.after(0, lambda: self.print_out(
+                            f"（连接中断后已自动续传 {resume_info['count']} 次，"
+                            f"相比完整重发节省约 {resume_info['saved_tokens']} 个输出token）"))
+                    if cache_hit:
+                        self.master.after(0, lambda: self.print_out("（来自本地响应缓存，未产生API调用）"))
                     
             except Exception as e:
-                # 捕获聊天API的异常并解析HTTP状态
-                error_msg = str(e)
-                
-                # 尝试从错误消息中提取HTTP状态码
-                import re
-                status_match = re.search(r'status_code:\s*(\d+)', error_msg)
-                if status_match:
-                    status_code = int(status_match.group(1))
-                    self.master.after(0, lambda: self.update_http_status(status_code, "聊天"))
-                    self.master.after(0, lambda: self.show_http_error_dialog(status_code, "聊天"))
-                else:
-                    # 根据错误类型推断状态码
-                    if "401" in error_msg or "Unauthorized" in error_msg:
-                        self.master.after(0, lambda: self.update_http_status(401, "聊天"))
-                        self.master.after(0, lambda: self.show_http_error_dialog(401, "聊天"))
-                    elif "403" in error_msg or "Forbidden" in error_msg:
-                        self.master.after(0, lambda: self.update_http_status(403, "聊天"))
-                        self.master.after(0, lambda: self.show_http_error_dialog(403, "聊天"))
-                    elif "429" in error_msg or "rate" in error_msg.lower():
-                        self.master.after(0, lambda: self.update_http_status(429, "聊天"))
-                        self.master.after(0, lambda: self.show_http_error_dialog(429, "聊天"))
-                    elif "timeout" in error_msg.lower() or "connection" in error_msg.lower():
-                        self.master.after(0, lambda: self.update_http_status(0, "聊天"))
-                        self.master.after(0, lambda: self.print_out(f"网络错误: {error_msg}"))
-                    else:
-                        self.master.after(0, lambda: self.update_http_status(0, "聊天"))
-                        self.master.after(0, lambda: self.print_out(f"未知错误: {error_msg}"))
-                
+                if self.streaming_stopped:
+                    # 用户在重试等待期间停止了请求
+                    return
+                self.master.after(0, lambda err=e: self.handle_api_error("聊天", err))
                 self.master.after(0, lambda: self.print_out("聊天发生错误"))
                 
             finally:
+                self.active_response = None
+                if chunks is not None:
+                    # 停止超时监视
+                    chunks.close()
+                self.prewarmer.mark_network_use()
                 # 恢复按钮状态
                 self.master.after(0, self._restore_chat_buttons)
 
@@ -1517,23 +5351,33 @@ if USE_GUI:
             self.send_btn.config(state=tk.NORMAL)
             self.stop_btn.config(state=tk.DISABLED)
             self.update_chat_status("ready")
+            self.update_token_count()
 
         def stop_streaming(self):
-            """停止流式输出"""
+            """停止流式输出：立即关闭底层HTTP响应，服务器随即停止生成"""
             self.streaming_stopped = True
+            response = self.active_response
+            if response is not None:
+                abort_response(response)
             self.print_out("用户停止了流式输出。")
 
         def start_new_session(self):
             """开始新会话"""
+            self.dismiss_similar_offer()
             self.messages = []
+            self.session_id = None
+            self.update_token_count()
             self.print_out("开始新聊天会话。")
             if self.selected_model:
                 self.print_out(f"当前模型: {self.selected_model}")
 
         def end_chat(self):
             """结束聊天"""
+            self.dismiss_similar_offer()
             self.messages = []
+            self.session_id = None
             self.user_input.config(state=tk.DISABLED)
+            self.update_token_count()
             self.update_chat_status("not_ready")
             self.update_buttons_state()
             self.print_out("聊天已结束。")
@@ -1589,6 +5433,9 @@ if USE_GUI:
 
         def on_input_change(self, event=None):
             """输入框内容改变事件"""
+            self.mark_user_activity()
+            if self.prewarmer.maybe_prewarm(self.client):
+                self.update_status_display("prewarm", "预热中...", "yellow")
             # 检查输入框是否有内容来控制发送按钮
             content = ""
             try:
@@ -1601,72 +5448,87 @@ if USE_GUI:
             else:
                 self.send_btn.config(state=tk.DISABLED)
 
+            # 连续输入时合并为一次计数
+            if self.token_count_job is not None:
+                self.master.after_cancel(self.token_count_job)
+            self.token_count_job = self.master.after(250, self.update_token_count)
+
+        def update_token_count(self):
+            """更新输入框旁的token计数（历史部分按消息记忆，只有草稿需要重新计数）"""
+            self.token_count_job = None
+            try:
+                draft = self.user_input.get("1.0", tk.END).strip()
+            except tk.TclError:
+                return
+            history_tokens = API_TOKEN_COUNTER.count_messages(self.messages)
+            draft_tokens = API_TOKEN_COUNTER.count_text(draft)
+            approx = "" if API_TOKEN_COUNTER.exact else "约"
+            if not history_tokens and not draft_tokens:
+                self.token_count_label.config(text="")
+                return
+            self.token_count_label.config(
+                text=f"{approx}{history_tokens + draft_tokens} tokens (输入 {draft_tokens} + 历史 {history_tokens})")
+
         def refresh_models(self):
             """刷新模型列表（GUI版本）"""
             if not self.client:
                 messagebox.showerror("错误", "请先初始化客户端")
                 return
-                
+
+            self.print_out("正在获取可用模型...")
+            self.refresh_models_btn.config(state=tk.DISABLED)
+            # 网络请求及重试等待放到后台线程，避免阻塞界面
+            threading.Thread(target=self._refresh_models_worker, args=(self.client,), daemon=True).start()
+
+        def _refresh_models_worker(self, client):
+            """模型列表获取工作线程"""
             try:
-                self.print_out("正在获取可用模型...")
-                models_response = self.client.models.list()
-                
-                # 更新HTTP状态
-                self.update_http_status(200, "模型获取")
-                
-                # 过滤模型
-                available_models = [model.id for model in models_response.data if
-                                  "chat" in model.id.lower() or "coder" in model.id.lower() or len(models_response.data) < 10]
-                
-                if not available_models:
-                    available_models = [model.id for model in models_response.data]
-                
-                if not available_models:
-                    self.print_out("未找到模型。请检查您的API密钥。")
-                    self.update_model_status("fetch_fail")
-                    return
-                
-                self.available_models = available_models
-                self.model_combobox['values'] = available_models
-                
-                # 如果当前选择的模型不在新列表中，则重置为未选择状态
-                if self.selected_model and self.selected_model not in available_models:
-                    self.selected_model = None
-                    self.model_var.set("请选择一个模型...")
-                
-                # 更新模型状态
-                self.update_model_status()
-                
-                self.print_out(f"找到 {len(available_models)} 个模型。请选择一个以继续。")
-                self.update_buttons_state()
-                
+                models_response = call_with_retry("models", client.models.list,
+                                                  on_retry=self._make_retry_reporter("模型获取"))
             except Exception as e:
-                error_msg = str(e)
-                
-                # 尝试从错误消息中提取HTTP状态码
-                import re
-                status_match = re.search(r'status_code:\s*(\d+)', error_msg)
-                if status_match:
-                    status_code = int(status_match.group(1))
-                    self.update_http_status(status_code, "模型获取")
-                    self.show_http_error_dialog(status_code, "模型获取")
-                else:
-                    # 根据错误类型推断状态码
-                    if "401" in error_msg or "Unauthorized" in error_msg:
-                        self.update_http_status(401, "模型获取")
-                        self.show_http_error_dialog(401, "模型获取")
-                    elif "403" in error_msg or "Forbidden" in error_msg:
-                        self.update_http_status(403, "模型获取")
-                        self.show_http_error_dialog(403, "模型获取")
-                    elif "429" in error_msg or "rate" in error_msg.lower():
-                        self.update_http_status(429, "模型获取")
-                        self.show_http_error_dialog(429, "模型获取")
-                    else:
-                        self.update_http_status(0, "模型获取")
-                        self.print_out(f"获取模型时发生错误: {error_msg}")
-                
-                self.print_out(f"获取模型失败: {error_msg}")
+                self.master.after(0, lambda err=e: self._on_models_failed(err))
+            else:
+                self.master.after(0, lambda: self._on_models_loaded(models_response))
+            finally:
+                self.master.after(0, lambda: self.refresh_models_btn.config(
+                    state=tk.NORMAL if self.client else tk.DISABLED))
+
+        def _on_models_loaded(self, models_response):
+            """在主线程中处理获取到的模型列表"""
+            # 更新HTTP状态
+            self.update_http_status(200, "模型获取")
+            self.prewarmer.mark_network_use()
+
+            # 过滤模型
+            available_models = [model.id for model in models_response.data if
+                              "chat" in model.id.lower() or "coder" in model.id.lower() or len(models_response.data) < 10]
+
+            if not available_models:
+                available_models = [model.id for model in models_response.data]
+
+            if not available_models:
+                self.print_out("未找到模型。请检查您的API密钥。")
                 self.update_model_status("fetch_fail")
+                return
+
+            self.available_models = available_models
+            self.model_combobox['values'] = available_models
+
+            # 如果当前选择的模型不在新列表中，则重置为未选择状态
+            if self.selected_model and self.selected_model not in available_models:
+                self.selected_model = None
+                self.model_var.set("请选择一个模型...")
+
+            # 更新模型状态
+            self.update_model_status()
+
+            self.print_out(f"找到 {len(available_models)} 个模型。请选择一个以继续。")
+            self.update_buttons_state()
+
+        def _on_models_failed(self, e):
+            """在主线程中处理模型获取失败"""
+            self.handle_api_error("模型获取", e)
+            self.update_model_status("fetch_fail")
 
         def on_model_selected(self, event=None):
             """模型选择事件处理"""
@@ -1686,7 +5548,9 @@ if USE_GUI:
                 messagebox.showerror("错误", "请先选择一个模型")
                 return
 
+            self.dismiss_similar_offer()
             self.messages = []
+            self.session_id = None
             self.user_input.config(state=tk.NORMAL)
             self.user_input.focus_set()
             self.update_chat_status("ready")
@@ -1694,6 +5558,250 @@ if USE_GUI:
             self.print_out(f"开始与模型 {self.selected_model} 聊天")
             self.print_out("输入您的消息并按发送或回车键开始对话。")
 
+        def browse_sessions(self):
+            """浏览与搜索已保存的会话：列表只含标题与预览，选中消息时才加载正文，可继续任一会话"""
+            dialog = tk.Toplevel(self.master)
+            dialog.title("历史会话")
+            dialog.geometry("820x480")
+            dialog.transient(self.master)
+
+            search_frame = tk.Frame(dialog)
+            search_frame.pack(fill=tk.X, padx=5, pady=(5, 0))
+            tk.Label(search_frame, text="搜索:").pack(side=tk.LEFT)
+            search_entry = tk.Entry(search_frame)
+            search_entry.pack(side=tk.LEFT, fill=tk.X, expand=True, padx=(2, 5))
+            tk.Button(search_frame, text="搜索", command=lambda: run_search()).pack(side=tk.LEFT)
+            search_status = tk.Label(search_frame, text="", fg="gray")
+            search_status.pack(side=tk.RIGHT)
+
+            panes = tk.PanedWindow(dialog, orient=tk.HORIZONTAL)
+            panes.pack(fill=tk.BOTH, expand=True, padx=5, pady=5)
+            session_list = tk.Listbox(panes, font=("Consolas", 9), exportselection=False)
+            right = tk.PanedWindow(panes, orient=tk.VERTICAL)
+            message_list = tk.Listbox(right, font=("Consolas", 9), exportselection=False)
+            body = scrolledtext.ScrolledText(right, wrap="word", height=8, font=("Consolas", 9))
+            body.tag_configure("hit", background="yellow")
+            right.add(message_list)
+            right.add(body)
+            panes.add(session_list, width=300)
+            panes.add(right)
+
+            # 左侧列表的条目：会话（浏览时）或命中的消息（搜索时），均含 session_id
+            entries = []
+            messages = []
+            state = {"terms": []}
+            page_size = 50
+
+            def load_more():
+                page = API_CONVERSATION_STORE.list_sessions(limit=page_size, offset=len(entries))
+                for session in page:
+                    updated = time.strftime("%m-%d %H:%M", time.localtime(session["updated"]))
+                    session_list.insert(tk.END, f"{updated} [{session['message_count']}] {session['title'] or '(无标题)'}")
+                    entries.append({"session_id": session["id"], "message_id": None})
+                more_btn.config(state=tk.NORMAL if len(page) == page_size else tk.DISABLED)
+
+            def run_search(event=None):
+                query = search_entry.get().strip()
+                session_list.delete(0, tk.END)
+                message_list.delete(0, tk.END)
+                body.delete("1.0", tk.END)
+                entries.clear()
+                state["terms"] = query.split()
+                if not query:
+                    search_status.config(text="")
+                    load_more()
+                    return
+                API_CONVERSATION_STORE.flush(timeout=1.0)
+                started = time.perf_counter()
+                results = API_CONVERSATION_STORE.search(query, limit=100)
+                search_status.config(text=f"{len(results)} 条结果，{(time.perf_counter() - started) * 1000:.0f}ms")
+                for result in results:
+                    created = time.strftime("%m-%d %H:%M", time.localtime(result["created"]))
+                    role = "您" if result["role"] == "user" else "助手"
+                    session_list.insert(tk.END, f"{created} {result['title'] or '(无标题)'} | {role}: {result['snippet']}")
+                    entries.append({"session_id": result["session_id"], "message_id": result["message_id"]})
+                more_btn.config(state=tk.DISABLED)
+
+            def show_body(index):
+                body.delete("1.0", tk.END)
+                body.insert(tk.END, API_CONVERSATION_STORE.message_content(messages[index]["id"]) or "")
+                # 高亮搜索词并滚动到第一个命中处
+                first = None
+                for term in state["terms"]:
+                    start = "1.0"
+                    while True:
+                        start = body.search(term, start, stopindex=tk.END, nocase=True)
+                        if not start:
+                            break
+                        end = f"{start}+{len(term)}c"
+                        body.tag_add("hit", start, end)
+                        first = first or start
+                        start = end
+                if first:
+                    body.see(first)
+
+            def on_session_select(event=None):
+                selection = session_list.curselection()
+                if not selection:
+                    return
+                entry = entries[selection[0]]
+                message_list.delete(0, tk.END)
+                body.delete("1.0", tk.END)
+                messages[:] = API_CONVERSATION_STORE.list_messages(entry["session_id"])
+                for message in messages:
+                    role = "您" if message["role"] == "user" else "助手"
+                    preview = " ".join(message["preview"].split())
+                    suffix = "…" if message["length"] > len(message["preview"]) else ""
+                    message_list.insert(tk.END, f"{role}: {preview}{suffix}")
+                # 搜索结果：定位到命中的消息
+                for index, message in enumerate(messages):
+                    if message["id"] == entry["message_id"]:
+                        message_list.selection_set(index)
+                        message_list.see(index)
+                        show_body(index)
+                        break
+
+            def on_message_select(event=None):
+                selection = message_list.curselection()
+                if selection:
+                    show_body(selection[0])
+
+            def continue_session():
+                selection = session_list.curselection()
+                if not selection:
+                    messagebox.showinfo("提示", "请先选择一个会话。", parent=dialog)
+                    return
+                if not (self.client and self.selected_model):
+                    messagebox.showerror("错误", "请先初始化客户端并选择模型。", parent=dialog)
+                    return
+                self.resume_session(entries[selection[0]]["session_id"])
+                dialog.destroy()
+
+            search_entry.bind("<Return>", run_search)
+            session_list.bind("<<ListboxSelect>>", on_session_select)
+            message_list.bind("<<ListboxSelect>>", on_message_select)
+
+            button_frame = tk.Frame(dialog)
+            button_frame.pack(fill=tk.X, padx=5, pady=(0, 5))
+            more_btn = tk.Button(button_frame, text="加载更多", command=load_more)
+            more_btn.pack(side=tk.LEFT)
+            tk.Button(button_frame, text="继续该会话", command=continue_session).pack(side=tk.LEFT, padx=(5, 0))
+            tk.Button(button_frame, text="关闭", command=dialog.destroy).pack(side=tk.RIGHT)
+            load_more()
+            search_entry.focus_set()
+
+        def resume_session(self, session_id):
+            """从对话存储载入会话并继续聊天"""
+            model, messages = API_CONVERSATION_STORE.load_session(session_id)
+            self.dismiss_similar_offer()
+            self.messages = messages
+            self.session_id = session_id
+            self.user_input.config(state=tk.NORMAL)
+            self.user_input.focus_set()
+            self.update_chat_status("ready")
+            self.update_buttons_state()
+            self.update_token_count()
+            self.print_out(f"已载入历史会话，共 {len(messages)} 条消息。")
+            if model and model != self.selected_model:
+                self.print_out(f"该会话原使用 {model}，将以当前模型 {self.selected_model} 继续。")
+            # 只回显最近一轮，长会话也能立即打开
+            for message in messages[-2:]:
+                self.print_out(f"{'您' if message['role'] == 'user' else '助手'}: {message['content']}")
+
+        def configure_context_budget(self):
+            """设置每轮发送的提示词token上限（0 表示只受模型上下文长度限制）"""
+            policy = self.context_budgeter.policy
+            value = simpledialog.askinteger(
+                "上下文预算", "提示词最多发送多少 tokens（0 表示按模型上下文长度）：\n"
+                "超出时先截断较早的长消息，再从最早的轮次开始省略。",
+                initialvalue=policy["max_prompt_tokens"] or 0, minvalue=0, parent=self.master)
+            if value is None:
+                return
+            policy["max_prompt_tokens"] = value or None
+            budget = self.context_budgeter.budget(self.selected_model, CHAT_MAX_TOKENS)
+            self.print_out(f"上下文预算已设为每轮最多 {budget} tokens（另为回复预留 {CHAT_MAX_TOKENS}）。")
+
+        def show_usage_summary(self):
+            """显示本次运行与最近几天的用量、延迟与费用汇总"""
+            dialog = tk.Toplevel(self.master)
+            dialog.title("用量与费用")
+            dialog.geometry("560x260")
+            dialog.transient(self.master)
+
+            listbox = tk.Listbox(dialog, font=("Consolas", 9))
+            listbox.pack(fill=tk.BOTH, expand=True, padx=5, pady=5)
+            listbox.insert(tk.END, f"本次运行: {format_usage_summary(API_USAGE_LEDGER.session_summary())}")
+            for day, summary in API_USAGE_LEDGER.daily_summaries(days=14):
+                listbox.insert(tk.END, f"{day}: {format_usage_summary(summary)}")
+            listbox.insert(tk.END, f"账本文件: {API_USAGE_LEDGER.filename}")
+
+            tk.Button(dialog, text="关闭", command=dialog.destroy).pack(pady=(0, 5))
+
+        def manage_key_pool(self):
+            """管理备用密钥：查看各密钥的余量、用量与隔离状态，添加或移除备用密钥"""
+            dialog = tk.Toplevel(self.master)
+            dialog.title("密钥池")
+            dialog.geometry("460x260")
+            dialog.transient(self.master)
+
+            listbox = tk.Listbox(dialog, font=("Consolas", 9))
+            listbox.pack(fill=tk.BOTH, expand=True, padx=5, pady=5)
+
+            def refresh():
+                listbox.delete(0, tk.END)
+                if not API_KEY_POOL.size:
+                    for key in ([self.api_key] if self.api_key else []) + load_api_key_pool_from_file():
+                        listbox.insert(tk.END, f"{mask_api_key(key)}  (未初始化)")
+                    return
+                for i, stat in enumerate(API_KEY_POOL.stats()):
+                    role = "主" if i == 0 else "备"
+                    state = (f"隔离中 {stat['quarantine_in']:.0f}s "
+                             f"({ERROR_CATEGORY_TEXT.get(stat['quarantine_reason'], stat['quarantine_reason'])})"
+                             if stat["quarantine_reason"] else f"余量 {stat['headroom'] * 100:.0f}%")
+                    listbox.insert(tk.END, f"[{role}] {stat['key']}  {state}  "
+                                           f"请求 {stat['requests']} / 失败 {stat['failures']}")
+
+            def add_key():
+                if Fernet is None:
+                    messagebox.showerror("错误", "cryptography库未安装，无法加密保存密钥池。", parent=dialog)
+                    return
+                key = simpledialog.askstring("添加备用密钥", "请输入备用API密钥:", show="*", parent=dialog)
+                key = (key or "").strip()
+                if not key:
+                    return
+                backups = load_api_key_pool_from_file()
+                if key == self.api_key or key in backups:
+                    messagebox.showinfo("提示", "该密钥已在密钥池中。", parent=dialog)
+                    return
+                backups.append(key)
+                if not save_api_key_pool_to_file(backups):
+                    messagebox.showerror("错误", "保存密钥池失败。", parent=dialog)
+                    return
+                if self.api_key:
+                    API_KEY_POOL.set_keys([self.api_key] + backups)
+                refresh()
+
+            def remove_key():
+                selection = listbox.curselection()
+                offset = 1 if self.api_key else 0
+                if not selection or selection[0] < offset:
+                    messagebox.showinfo("提示", "请选择一个备用密钥（主密钥请使用“清除API密钥”）。", parent=dialog)
+                    return
+                backups = load_api_key_pool_from_file()
+                del backups[selection[0] - offset]
+                save_api_key_pool_to_file(backups)
+                if self.api_key:
+                    API_KEY_POOL.set_keys([self.api_key] + backups)
+                refresh()
+
+            button_frame = tk.Frame(dialog)
+            button_frame.pack(fill=tk.X, padx=5, pady=(0, 5))
+            tk.Button(button_frame, text="添加备用密钥", command=add_key).pack(side=tk.LEFT)
+            tk.Button(button_frame, text="移除所选", command=remove_key).pack(side=tk.LEFT, padx=(5, 0))
+            tk.Button(button_frame, text="刷新", command=refresh).pack(side=tk.LEFT, padx=(5, 0))
+            tk.Button(button_frame, text="关闭", command=dialog.destroy).pack(side=tk.RIGHT)
+            refresh()
+
         def clear_api_key(self):
             """清除API密钥"""
             result = messagebox.askyesno("确认", "您确定要清除保存的API密钥吗？")
@@ -1712,7 +5820,11 @@ class DeepSeekCLI:
         self.client = None
         self.selected_model = None
         self.messages = []
+        self.session_id = None
+        self.similar_offer_pending = False
+        self.context_budgeter = ContextBudgeter()
         self.available_models = []
+        self.temperature = 0.7
 
     def load_api_key(self):
         """加载API密钥"""
@@ -1741,8 +5853,11 @@ class DeepSeekCLI:
     def initialize_client(self):
         """初始化客户端"""
         try:
-            self.client = OpenAI(api_key=self.api_key, base_url=DEEPSEEK_API_BASE_URL_V1)
+            self.client = create_openai_client(self.api_key)
+            API_KEY_POOL.set_keys([self.api_key] + load_api_key_pool_from_file())
             print("客户端初始化成功!")
+            if API_KEY_POOL.size > 1:
+                print(f"已加载密钥池，共 {API_KEY_POOL.size} 个密钥。")
             return True
         except Exception as e:
             print(f"客户端初始化失败: {e}")
@@ -1752,7 +5867,7 @@ class DeepSeekCLI:
         """获取可用模型"""
         try:
             print("正在获取可用模型...")
-            models_response = self.client.models.list()
+            models_response = call_with_retry("models", self.client.models.list, on_retry=self._report_retry)
 
             
             # 过滤模型
@@ -1769,9 +5884,42 @@ class DeepSeekCLI:
             
             return True
         except Exception as e:
-            print(f"获取模型失败: {e}")
+            print(f"获取模型失败: {classify_error(e).describe()}")
             return False
 
+    def show_key_pool(self):
+        """打印密钥池中各密钥的状态"""
+        for i, stat in enumerate(API_KEY_POOL.stats()):
+            role = "主" if i == 0 else "备"
+            state = f"隔离中 {stat['quarantine_in']:.0f}s" if stat["quarantine_reason"] \
+                else f"余量 {stat['headroom'] * 100:.0f}%"
+            print(f"  [{role}] {stat['key']}  {state}  请求 {stat['requests']} / 失败 {stat['failures']}")
+
+    def add_backup_key(self):
+        """添加一个备用密钥到密钥池并保存"""
+        if Fernet is None:
+            print("cryptography库未安装，无法加密保存密钥池。请使用 pip install cryptography 安装。")
+            return
+        key = input("请输入备用API密钥: ").strip()
+        if not key:
+            return
+        backups = load_api_key_pool_from_file()
+        if key == self.api_key or key in backups:
+            print("该密钥已在密钥池中。")
+            return
+        backups.append(key)
+        if save_api_key_pool_to_file(backups):
+            API_KEY_POOL.set_keys([self.api_key] + backups)
+            print(f"已添加，密钥池共 {API_KEY_POOL.size} 个密钥。")
+        else:
+            print("保存密钥池失败。")
+
+    def _report_retry(self, attempt, max_attempts, delay, exc):
+        """打印重试信息"""
+        info = getattr(exc, "error_info", None) or classify_error(exc)
+        reason = f"HTTP {info.status}" if info.status else ERROR_CATEGORY_TEXT.get(info.category, "网络错误")
+        print(f"\n请求失败 ({reason})，{delay:.1f}秒后进行第 {attempt + 1}/{max_attempts} 次尝试...")
+
     def select_model(self):
         """选择模型"""
         while True:
@@ -1793,7 +5941,11 @@ class DeepSeekCLI:
     def start_chat(self):
         """开始聊天会话"""
         print(f"开始与 {self.selected_model} 聊天")
-        print("输入 'quit' 退出，'new' 开始新会话")
+        print("输入 'quit' 退出，'new' 开始新会话，'keys' 查看密钥池，'addkey' 添加备用密钥")
+        print("'temp 0' 切换为确定性回复（可使用本地响应缓存），'cache' 查看缓存统计，'cache clear' 清空缓存；"
+              "消息以 '!' 开头时跳过缓存；'similar on/off' 开关相似问题缓存；'usage' 查看用量与费用；"
+              "'budget N/off' 设置提示词token上限，'compact on/off' 开关早期对话压缩；"
+              "'sessions' 列出历史会话，'search 关键词' 搜索全部会话，'open N' 继续列出的第N个")
         print("-" * 50)
         
         while True:
@@ -1804,41 +5956,238 @@ class DeepSeekCLI:
                     break
                 elif user_input.lower() == 'new':
                     self.messages = []
+                    self.session_id = None
+                    self.similar_offer_pending = False
                     print("开始新聊天会话。")
                     continue
+                elif user_input.lower() == 'keys':
+                    self.show_key_pool()
+                    continue
+                elif user_input.lower() == 'addkey':
+                    self.add_backup_key()
+                    continue
+                elif user_input.lower().startswith('temp '):
+                    try:
+                        self.temperature = float(user_input[5:])
+                        print(f"temperature 已设为 {self.temperature:g}")
+                    except ValueError:
+                        print("请输入有效数字，例如 temp 0")
+                    continue
+                elif user_input.lower() == 'cache':
+                    stats = API_RESPONSE_CACHE.stats()
+                    hit_rate = f"{stats['hit_rate'] * 100:.0f}%" if stats["hit_rate"] is not None else "-"
+                    print(f"响应缓存: 命中 {stats['hits']} / 未命中 {stats['misses']} / 跳过 {stats['bypasses']}，"
+                          f"命中率 {hit_rate}，{stats['entries']} 条 {stats['bytes'] / 1024:.0f}KB，"
+                          f"淘汰 {stats['evictions']} 条")
+                    similar = API_SIMILAR_CACHE.stats()
+                    print(f"相似问题缓存({'开启' if API_SIMILAR_CACHE.enabled else '关闭'}): "
+                          f"命中 {similar['hits']} / 查询 {similar['lookups']}，{similar['entries']} 条")
+                    context = API_CONTEXT_CACHE_STATS.stats()
+                    if context["hit_ratio"] is not None:
+                        print(f"服务端上下文缓存: 命中 {context['hit_tokens']} / 未命中 {context['miss_tokens']} tokens，"
+                              f"命中率 {context['hit_ratio'] * 100:.0f}%，累计节省约 ¥{context['saved']:.4f}")
+                    continue
+                elif user_input.lower() == 'usage':
+                    print_usage_report()
+                    continue
+                elif user_input.lower() == 'sessions':
+                    self.list_sessions()
+                    continue
+                elif user_input.lower().startswith('search '):
+                    API_CONVERSATION_STORE.flush()
+                    results = print_search_results(user_input[7:].strip())
+                    # open N 打开第 N 条结果所在的会话并定位到命中的消息
+                    self._listed_sessions = [{"id": r["session_id"], "title": r["title"], "focus_seq": r["seq"]}
+                                             for r in results]
+                    continue
+                elif user_input.lower().startswith('open '):
+                    self.open_session(user_input[5:].strip())
+                    continue
+                elif user_input.lower() in ('compact on', 'compact off'):
+                    self.context_budgeter.policy["compaction"] = user_input.lower().endswith('on')
+                    print(f"早期对话压缩已{'开启' if self.context_budgeter.policy['compaction'] else '关闭'}。")
+                    continue
+                elif user_input.lower() == 'budget' or user_input.lower().startswith('budget '):
+                    self.configure_context_budget(user_input[6:].strip().lower())
+                    continue
+                elif user_input.lower() == 'cache clear':
+                    API_RESPONSE_CACHE.clear()
+                    print("响应缓存已清空。")
+                    continue
+                elif user_input.lower() in ('similar on', 'similar off'):
+                    API_SIMILAR_CACHE.enabled = user_input.lower().endswith('on')
+                    print(f"相似问题缓存已{'开启' if API_SIMILAR_CACHE.enabled else '关闭'}。")
+                    continue
+                elif user_input.lower() == 'ask':
+                    # 丢弃相似问题的缓存回答，重新向模型提问
+                    if self.similar_offer_pending and self.messages and self.messages[-1]["role"] == "assistant":
+                        self.similar_offer_pending = False
+                        self.messages.pop()
+                        if self.session_id:
+                            API_CONVERSATION_STORE.remove_last_message(self.session_id)
+                        self._stream_reply()
+                    else:
+                        print("没有可重新提问的问题。")
+                    continue
+
+                bypass_cache = user_input.startswith('!')
+                if bypass_cache:
+                    user_input = user_input[1:].strip()
+                    if not user_input:
+                        continue
                 elif not user_input:
                     continue
                 
                 # 添加用户消息
+                self.similar_offer_pending = False
                 self.messages.append({"role": "user", "content": user_input})
+                self.record_message("user", user_input)
                 
-                # 获取AI回复
-                print("助手: ", end="", flush=True)
-                response = self.client.chat.completions.create(
-                    model=self.selected_model,
-                    messages=self.messages,
-                    stream=True,
-                    max_tokens=4096,
-                    temperature=0.7
-                )
-                
-                assistant_message = ""
-                for chunk in response:
-                    if chunk.choices[0].delta.content is not None:
-                        content = chunk.choices[0].delta.content
-                        print(content, end="", flush=True)
-                        assistant_message += content
-                
-                print()  # 换行
-                
-                # 添加助手回复到对话历史
-                self.messages.append({"role": "assistant", "content": assistant_message})
+                if self.offer_similar_answer():
+                    continue
+                self._stream_reply(bypass_cache)
                 
             except KeyboardInterrupt:
                 print("\n再见!")
                 break
             except Exception as e:
-                print(f"错误: {e}")
+                print(f"\n错误: {classify_error(e).describe()}")
+
+    def _stream_reply(self, bypass_cache=False):
+        """流式获取并打印助手回复，追加到对话历史"""
+        request_messages = self.context_budgeter.fit(self.messages, self.selected_model, CHAT_MAX_TOKENS,
+                                                     client=self.client)
+        trim_note = describe_context_trim(self.context_budgeter.last_report)
+        if trim_note:
+            print(trim_note)
+
+        # 获取AI回复
+        print("助手: ", end="", flush=True)
+        stream = {"response": None, "resumes": 0, "saved_tokens": 0, "cache_hit": False}
+
+        def on_resume(count, partial, exc):
+            stream["resumes"] = count
+            stream["saved_tokens"] += estimate_tokens(partial)
+
+        chunks = API_RESPONSE_CACHE.stream(
+            self.client,
+            bypass=bypass_cache,
+            on_cache_hit=lambda: stream.update(cache_hit=True),
+            on_retry=self._report_retry,
+            on_response=lambda response: stream.update(response=response),
+            on_resume=on_resume,
+            model=self.selected_model,
+            messages=request_messages,
+            max_tokens=CHAT_MAX_TOKENS,
+            temperature=self.temperature
+        )
+        
+        assistant_message = ""
+        usage = None
+        try:
+            for chunk in chunks:
+                if chunk.choices and chunk.choices[0].delta.content is not None:
+                    content = chunk.choices[0].delta.content
+                    print(content, end="", flush=True)
+                    assistant_message += content
+                if getattr(chunk, "usage", None) is not None:
+                    usage = chunk.usage
+        except KeyboardInterrupt:
+            # Ctrl+C 只中断当前回复：关闭连接并保留已收到的部分
+            if stream["response"] is not None:
+                abort_response(stream["response"])
+            chunks.close()
+            print("\n（回复已中断）")
+            if assistant_message:
+                self.messages.append({"role": "assistant", "content": assistant_message})
+                self.record_message("assistant", assistant_message)
+            return
+        
+        print()  # 换行
+        if stream["resumes"]:
+            print(f"（连接中断后已自动续传 {stream['resumes']} 次，"
+                  f"相比完整重发节省约 {stream['saved_tokens']} 个输出token）")
+        if stream["cache_hit"]:
+            print("（来自本地响应缓存，未产生API调用）")
+        
+        if API_SIMILAR_CACHE.enabled and assistant_message:
+            prompt = SimilarPromptCache.single_turn_prompt(self.messages)
+            if prompt:
+                API_SIMILAR_CACHE.add(self.selected_model, prompt, assistant_message)
+        # 添加助手回复到对话历史
+        self.messages.append({"role": "assistant", "content": assistant_message})
+        self.record_message("assistant", assistant_message, usage)
+
+    def record_message(self, role, content, usage=None):
+        """把一条消息交给对话存储（后台写入）"""
+        if self.session_id is None:
+            self.session_id = API_CONVERSATION_STORE.new_session(self.selected_model)
+        API_CONVERSATION_STORE.append_message(self.session_id, role, content, model=self.selected_model, usage=usage)
+
+    def list_sessions(self, limit=20):
+        """列出最近的会话，编号用于 open 命令"""
+        API_CONVERSATION_STORE.flush()
+        self._listed_sessions = API_CONVERSATION_STORE.list_sessions(limit=limit)
+        if not self._listed_sessions:
+            print("暂无保存的会话。")
+        for i, session in enumerate(self._listed_sessions, 1):
+            updated = time.strftime("%Y-%m-%d %H:%M", time.localtime(session["updated"]))
+            print(f"  {i:>2}. {updated}  [{session['message_count']}条] {session['title'] or '(无标题)'}")
+
+    def open_session(self, value):
+        """open N：继续 sessions 列表中的第 N 个会话"""
+        listed = getattr(self, "_listed_sessions", None) or API_CONVERSATION_STORE.list_sessions(limit=20)
+        try:
+            session = listed[int(value) - 1]
+        except (ValueError, IndexError):
+            print("请输入 sessions 列表中的编号，例如 open 1")
+            return
+        model, self.messages = API_CONVERSATION_STORE.load_session(session["id"])
+        self.session_id = session["id"]
+        self.similar_offer_pending = False
+        print(f"已载入会话「{session['title']}」，共 {len(self.messages)} 条消息。")
+        if model and model != self.selected_model:
+            print(f"该会话原使用 {model}，将以当前模型 {self.selected_model} 继续。")
+        focus = session.get("focus_seq")
+        if focus is not None and 0 <= focus < len(self.messages):
+            # 来自搜索结果：显示命中的消息及其前一条
+            print(f"（第 {focus + 1} 条消息命中搜索）")
+            shown = self.messages[max(0, focus - 1):focus + 1]
+        else:
+            shown = self.messages[-2:]
+        for message in shown:
+            print(f"{'您' if message['role'] == 'user' else '助手'}: {message['content']}")
+
+    def configure_context_budget(self, value):
+        """budget 命令：不带参数时显示当前预算，N 设置提示词token上限，off 恢复为按模型上下文长度"""
+        policy = self.context_budgeter.policy
+        if value == "off":
+            policy["max_prompt_tokens"] = None
+        elif value:
+            try:
+                policy["max_prompt_tokens"] = max(0, int(value)) or None
+            except ValueError:
+                print("请输入有效数字，例如 budget 16000")
+                return
+        budget = self.context_budgeter.budget(self.selected_model, CHAT_MAX_TOKENS)
+        print(f"上下文预算: 提示词最多 {budget} tokens（模型上下文 {model_context_tokens(self.selected_model)}，"
+              f"为回复预留 {CHAT_MAX_TOKENS}），当前历史约 {API_TOKEN_COUNTER.count_messages(self.messages)} tokens")
+
+    def offer_similar_answer(self):
+        """相似问题缓存命中时直接打印缓存回答，返回是否命中"""
+        if not API_SIMILAR_CACHE.enabled:
+            return False
+        prompt = SimilarPromptCache.single_turn_prompt(self.messages)
+        match = API_SIMILAR_CACHE.lookup(self.selected_model, prompt) if prompt else None
+        if match is None:
+            return False
+        answer, similarity = match
+        self.messages.append({"role": "assistant", "content": answer})
+        self.record_message("assistant", answer)
+        print(f"助手: {answer}")
+        print(f"（相似问题的缓存回答，相似度 {similarity * 100:.0f}%，未产生API调用；输入 'ask' 仍然向模型提问）")
+        self.similar_offer_pending = True
+        return True
 
     def run(self):
         """运行CLI版本"""
@@ -1862,11 +6211,58 @@ class DeepSeekCLI:
             return
         
         # 开始聊天
-        self.start_chat()
+        try:
+            self.start_chat()
+        finally:
+            API_CONVERSATION_STORE.close()
+
+    def run_sse_benchmark(self, rounds=3, model="deepseek-chat"):
+        """对比SDK路径与原始SSE路径处理每个token的CPU耗时"""
+        if not self.load_api_key() or not self.initialize_client():
+            return
+        prompt = [{"role": "user", "content": "请从1数到300，数字之间用空格分隔，不要输出其他内容。"}]
+        results = {}
+        for label, raw_sse in (("SDK", False), ("原始SSE", True)):
+            cpu_total = 0.0
+            chunk_total = 0
+            for i in range(rounds):
+                try:
+                    response, chunks = open_chat_stream(self.client, on_retry=self._report_retry, raw_sse=raw_sse,
+                                                        model=model, messages=prompt, max_tokens=2048,
+                                                        temperature=0)
+                    # 只统计本线程读取与解析分块的CPU时间，不含连接建立、等待首字节与监视线程；
+                    # 首个内容块已在 open_chat_stream 中缓冲，会由迭代器再次产出，计数从0开始
+                    cpu_start = time.thread_time()
+                    count = 0
+                    for chunk in chunks:
+                        if chunk.choices and chunk.choices[0].delta.content:
+                            count += 1
+                    cpu_total += time.thread_time() - cpu_start
+                    chunk_total += count
+                except Exception as e:
+                    print(f"{label} 第 {i + 1} 轮失败: {classify_error(e).describe()}")
+            if chunk_total:
+                results[label] = cpu_total / chunk_total * 1e6
+                print(f"{label}: {chunk_total} 个分块，CPU {cpu_total * 1000:.1f} ms，"
+                      f"每分块 {results[label]:.1f} µs")
+        if len(results) == 2 and results["原始SSE"] > 0:
+            print(f"原始SSE路径每分块CPU耗时为SDK路径的 {results['原始SSE'] / results['SDK']:.0%}")
 
 # ===================== 主程序入口 =====================
 def main():
-    if USE_GUI:
+    if "--mock-server" in sys.argv:
+        run_mock_server()
+    elif "--bench" in sys.argv:
+        run_load_benchmark()
+    elif "--usage" in sys.argv:
+        print_usage_report()
+    elif "--search" in sys.argv:
+        query = _argv_value("--search", "")
+        if query:
+            print_search_results(query)
+        else:
+            print('用法: --cli --search "关键词"')
+    elif USE_GUI:
         root = tk.Tk()
         app = DeepSeekGUI(root)
         
@@ -1874,13 +6270,18 @@ def main():
         def on_closing():
             if hasattr(app, 'network_thread_stop'):
                 app.network_thread_stop = True
+            API_CONNECTION_POOL.close_all()
+            API_CONVERSATION_STORE.close()
             root.destroy()
         
         root.protocol("WM_DELETE_WINDOW", on_closing)
         root.mainloop()
     else:
         cli = DeepSeekCLI()
-        cli.run()
+        if "--bench-sse" in sys.argv:
+            cli.run_sse_benchmark()
+        else:
+            cli.run()
 
 if __name__ == "__main__":
     main()